@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+callqw 桥接开销基准测试
+
+把 qwen_cli_path 指向 benchmarks/stub_qwen.py，在临时目录中运行真实的 callqw 进程，测量:
+
+  overhead    单次调用端到端耗时减去直接运行替身的耗时，即桥接自身的开销
+  throughput  多个 callqw 进程并发调用时的吞吐量
+  context     上下文记忆从 1 KB 增长到 50 MB 时的延迟和峰值内存
+  response    回应大小增长时的延迟和峰值内存
+  pool        批处理在启用与不启用预热进程池（worker_pool_size）时的单次调用耗时
+  backend     同一批请求分别通过 CLI 后端和 HTTP 后端（benchmarks/stub_openai.py）执行的耗时
+
+结果写入 JSON，便于对比不同版本:
+  python benchmarks/bench_bridge.py --output bench.json
+  python benchmarks/bench_bridge.py --quick --scenario overhead context
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+SCRIPT = BENCH_DIR.parent / "callqw.py"
+STUB = BENCH_DIR / "stub_qwen.py"
+STUB_SERVER = BENCH_DIR / "stub_openai.py"
+
+SIZES = [1 << 10, 100 << 10, 1 << 20, 10 << 20, 50 << 20]
+QUICK_SIZES = [1 << 10, 100 << 10, 1 << 20]
+
+
+def percentile(samples, pct):
+    """最近秩法百分位数"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "min_ms": round(min(samples) * 1000, 2),
+    }
+
+
+class Workspace:
+    """临时项目目录：生成指向替身的配置文件"""
+
+    def __init__(self, root, context_budget=0, **config):
+        self.dir = Path(tempfile.mkdtemp(prefix="callqw-bench-", dir=root))
+        settings = {
+            "qwen_cli_path": str(STUB),
+            "logs_dir": "./callqw-logs",
+            "context_memory_file": "./callqw-context-memory.md",
+            "context_budget": context_budget,
+        }
+        settings.update(config)
+        with open(self.dir / "callqw-config.json", "w", encoding="utf-8") as f:
+            json.dump(settings, f, ensure_ascii=False, indent=4)
+
+    def fill_context(self, size):
+        """写入约 size 字节的上下文记忆（沿用 callqw 的 Markdown 记录格式）"""
+        entry = ("\n## 2024-01-01 00:00:00\n**用户/Leader Agent**: benchmark question\n"
+                 "**Qwen回应**: " + "benchmark answer " * 30 + "\n\n")
+        count = max(1, size // len(entry.encode("utf-8")))
+        with open(self.dir / "callqw-context-memory.md", "w", encoding="utf-8") as f:
+            for _ in range(count):
+                f.write(entry)
+
+    def run(self, message="benchmark", stub_env=None):
+        """运行一次 callqw，返回 (耗时秒, 峰值 RSS KB 或 None, 是否失败)
+
+        callqw 在 Qwen 调用失败时仍以 0 退出，失败与否取自它写入的最后一条调用指标。
+        """
+        env = dict(os.environ, CALLQW_NO_DAEMON="1", **(stub_env or {}))
+        cmd = [sys.executable, str(SCRIPT), "--no-cache", message]
+        elapsed, rss, code = run_measured(cmd, self.dir, env)
+        return elapsed, rss, code != 0 or not self.last_call_ok()
+
+    def last_call_ok(self):
+        metrics_file = self.dir / "callqw-logs" / "callqw-metrics.jsonl"
+        if not metrics_file.exists():
+            return False
+        with open(metrics_file, "rb") as f:
+            f.seek(max(0, f.seek(0, os.SEEK_END) - 65536))
+            lines = f.read().splitlines()
+        return bool(lines) and json.loads(lines[-1]).get("ok", False)
+
+
+def run_measured(cmd, cwd, env):
+    """运行命令并测量耗时；支持 os.wait4 的平台同时返回子进程峰值 RSS（KB）"""
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+        rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        return elapsed, rss, process.returncode
+    process.wait()
+    return time.perf_counter() - started, None, process.returncode
+
+
+def bench_overhead(root, runs, **_):
+    """桥接自身开销：callqw 端到端耗时 - 直接运行替身耗时"""
+    workspace = Workspace(root)
+    workspace.run()  # 预热：生成配置、日志目录和字节码缓存
+    bridge = [workspace.run()[0] for _ in range(runs)]
+    env = dict(os.environ)
+    stub = [run_measured([sys.executable, str(STUB), "-p", "benchmark"], workspace.dir, env)[0]
+            for _ in range(runs)]
+    result = {"bridge": summarize(bridge), "stub_only": summarize(stub)}
+    result["overhead_ms"] = round(result["bridge"]["median_ms"] - result["stub_only"]["median_ms"], 2)
+    return result
+
+
+def bench_throughput(root, runs, concurrency=(1, 4, 16), latency=0.5, **_):
+    """并发调用吞吐量：每个并发度下运行 max(runs, 并发度) 次调用"""
+    results = []
+    stub_env = {"STUB_QWEN_LATENCY": str(latency)}
+    for level in concurrency:
+        workspace = Workspace(root)
+        workspace.run(stub_env=stub_env)
+        calls = max(runs, level)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            samples = list(pool.map(lambda i: workspace.run(f"throughput {i}", stub_env), range(calls)))
+        elapsed = time.perf_counter() - started
+        entry = {"concurrency": level, "calls": calls, "stub_latency_s": latency,
+                 "calls_per_second": round(calls / elapsed, 2),
+                 "errors": sum(1 for _, _, failed in samples if failed)}
+        entry.update(summarize([s[0] for s in samples]))
+        results.append(entry)
+    return results
+
+
+def bench_context(root, runs, sizes=SIZES, **_):
+    """上下文记忆大小对延迟和内存的影响（默认预算与不限预算两种配置）"""
+    results = []
+    for budget in (32000, 0):
+        for size in sizes:
+            workspace = Workspace(root, context_budget=budget)
+            workspace.fill_context(size)
+            workspace.run()  # 首次运行会建立上下文索引
+            samples = [workspace.run() for _ in range(runs)]
+            entry = {"context_bytes": size, "context_budget": budget,
+                     "max_rss_kb": max((s[1] or 0) for s in samples),
+                     "errors": sum(1 for _, _, failed in samples if failed)}
+            entry.update(summarize([s[0] for s in samples]))
+            results.append(entry)
+    return results
+
+
+def bench_response(root, runs, sizes=SIZES, **_):
+    """回应大小对延迟和内存的影响"""
+    results = []
+    workspace = Workspace(root)
+    workspace.run()
+    for size in sizes:
+        stub_env = {"STUB_QWEN_OUTPUT_BYTES": str(size), "STUB_QWEN_CHUNKS": "16"}
+        samples = [workspace.run(stub_env=stub_env) for _ in range(runs)]
+        entry = {"response_bytes": size, "max_rss_kb": max((s[1] or 0) for s in samples),
+                 "errors": sum(1 for _, _, failed in samples if failed)}
+        entry.update(summarize([s[0] for s in samples]))
+        results.append(entry)
+    return results
+
+
+def run_batch(workspace, runs, env, concurrency=1):
+    """用 callqw batch 执行 runs 条请求，返回 (总耗时, 峰值 RSS, 结果记录列表)"""
+    requests = workspace.dir / "requests.jsonl"
+    with open(requests, "w", encoding="utf-8") as f:
+        for i in range(runs):
+            f.write(json.dumps({"id": i, "message": f"batch {i}"}) + "\n")
+    cmd = [sys.executable, str(SCRIPT), "batch", str(requests), "--concurrency", str(concurrency),
+           "--output", str(workspace.dir / "results.jsonl")]
+    elapsed, rss, _ = run_measured(cmd, workspace.dir, env)
+    with open(workspace.dir / "results.jsonl", "r", encoding="utf-8") as f:
+        return elapsed, rss, [json.loads(line) for line in f]
+
+
+def bench_pool(root, runs, startup=0.3, latency=0.1, **_):
+    """预热进程池：替身每次启动耗时 startup 秒，对比不启用和启用进程池时的调用耗时"""
+    env = dict(os.environ, STUB_QWEN_STARTUP=str(startup), STUB_QWEN_LATENCY=str(latency))
+    results = {}
+    for size in (0, 2):
+        workspace = Workspace(root, worker_pool_size=size)
+        elapsed, rss, records = run_batch(workspace, runs, env)
+        entry = {"worker_pool_size": size, "calls": runs, "stub_startup_s": startup, "stub_latency_s": latency,
+                 "total_s": round(elapsed, 3), "errors": sum(1 for r in records if r["status"] != "ok")}
+        entry.update(summarize([r["duration"] for r in records]))
+        results[f"pool_{size}"] = entry
+    return results
+
+
+def bench_backend(root, runs, latency=0.2, **_):
+    """CLI 后端与 HTTP 长连接后端的对比：用 callqw batch 顺序执行 runs 条请求"""
+    server = subprocess.Popen([sys.executable, str(STUB_SERVER), "--port", "0"], stdout=subprocess.PIPE,
+                              env=dict(os.environ, STUB_QWEN_LATENCY=str(latency)), text=True)
+    try:
+        base_url = server.stdout.readline().split()[-1]
+        results = {}
+        for backend in ("cli", "openai"):
+            workspace = Workspace(root, backend=backend, openai_base_url=base_url)
+            env = dict(os.environ, STUB_QWEN_LATENCY=str(latency))
+            elapsed, rss, records = run_batch(workspace, runs, env)
+            entry = {"calls": runs, "stub_latency_s": latency, "total_s": round(elapsed, 3),
+                     "max_rss_kb": rss, "errors": sum(1 for r in records if r["status"] != "ok")}
+            entry.update(summarize([r["duration"] for r in records]))
+            results[backend] = entry
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+SCENARIOS = {
+    "overhead": bench_overhead,
+    "throughput": bench_throughput,
+    "context": bench_context,
+    "response": bench_response,
+    "pool": bench_pool,
+    "backend": bench_backend,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="callqw 桥接开销基准测试")
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help="要运行的场景（默认全部）")
+    parser.add_argument("--runs", type=int, default=10, help="每个测量点的重复次数（默认 10）")
+    parser.add_argument("--quick", action="store_true", help="只测到 1 MB，并减少重复次数")
+    parser.add_argument("--output", "-o", type=str, default=None, help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    runs = min(args.runs, 3) if args.quick else args.runs
+    sizes = QUICK_SIZES if args.quick else SIZES
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "runs": runs,
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="callqw-bench-") as root:
+        for name in args.scenario:
+            print(f"[{name}] ...", flush=True)
+            report["results"][name] = SCENARIOS[name](root, runs, sizes=sizes)
+            print(json.dumps(report["results"][name], ensure_ascii=False, indent=2), flush=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"结果已写入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+callqw 冷启动预算检查
+
+分别测量空解释器、导入 callqw、callqw --version（控制台入口与直接运行脚本两种方式）
+的启动耗时，并用 python -X importtime 列出导入耗时最高的模块。
+相对空解释器的额外开销超过预算时以退出码 1 结束，可直接用于 CI。
+
+用法:
+  python benchmarks/startup.py
+  python benchmarks/startup.py --budget-ms 40 --runs 20 --json startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SCRIPT = REPO_DIR / "callqw.py"
+PREAMBLE = f"import sys; sys.path.insert(0, {str(REPO_DIR)!r}); "
+
+# 名称 -> 解释器参数
+CASES = {
+    "baseline": ["-c", "pass"],
+    "import": ["-c", PREAMBLE + "import callqw"],
+    "entry_version": ["-c", PREAMBLE + "import callqw; callqw.main(['--version'])"],
+    "script_version": [str(SCRIPT), "--version"],
+}
+
+
+def measure(args, runs):
+    """重复启动解释器，返回每次耗时（毫秒）"""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def import_profile(top):
+    """用 -X importtime 获取导入 callqw 时累计耗时最高的模块"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PREAMBLE + "import callqw"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append((int(parts[1]), parts[2].rstrip()))
+    rows.sort(reverse=True)
+    return [{"module": name.strip(), "cumulative_us": us} for us, name in rows[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="callqw 冷启动预算检查")
+    parser.add_argument("--runs", type=int, default=15, help="每种情况的重复次数（默认 15）")
+    parser.add_argument("--budget-ms", type=float, default=50.0,
+                        help="控制台入口 --version 相对空解释器的中位数开销上限（毫秒，默认 50）")
+    parser.add_argument("--top", type=int, default=10, help="列出导入耗时最高的模块数（默认 10）")
+    parser.add_argument("--json", type=str, default=None, help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    # 预热一次，确保 callqw 的字节码缓存已生成
+    measure(CASES["import"], 1)
+
+    results = {}
+    for name, case_args in CASES.items():
+        samples = measure(case_args, args.runs)
+        results[name] = {"median_ms": round(statistics.median(samples), 2),
+                         "min_ms": round(min(samples), 2)}
+    baseline = results["baseline"]["median_ms"]
+    for name, data in results.items():
+        data["overhead_ms"] = round(data["median_ms"] - baseline, 2)
+
+    overhead = results["entry_version"]["overhead_ms"]
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "budget_ms": args.budget_ms,
+        "within_budget": overhead <= args.budget_ms,
+        "results": results,
+        "import_profile": import_profile(args.top),
+    }
+
+    for name, data in results.items():
+        print(f"{name:<16} 中位数 {data['median_ms']:8.2f} ms  最小 {data['min_ms']:8.2f} ms  "
+              f"额外开销 {data['overhead_ms']:8.2f} ms")
+    print("\n导入耗时最高的模块（累计，微秒）:")
+    for row in report["import_profile"]:
+        print(f"  {row['cumulative_us']:>8}  {row['module']}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if not report["within_budget"]:
+        print(f"\n超出预算: 控制台入口额外开销 {overhead:.2f} ms > {args.budget_ms:.2f} ms")
+        return 1
+    print(f"\n预算内: 控制台入口额外开销 {overhead:.2f} ms <= {args.budget_ms:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
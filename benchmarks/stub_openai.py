@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenAI 兼容 Chat Completions 接口的替身服务，用于测试 callqw 的 HTTP 后端
+
+支持 POST /v1/chat/completions（stream 为 true 时以 SSE 分块返回）和 HTTP/1.1 长连接。
+延迟、输出大小和失败率与 stub_qwen.py 使用相同的环境变量:
+
+  STUB_QWEN_LATENCY       总耗时（秒，默认 0）
+  STUB_QWEN_FIRST_BYTE    首个数据块前的等待（秒，默认为总耗时的 1/10）
+  STUB_QWEN_OUTPUT_BYTES  回应大小（字节，默认 256）
+  STUB_QWEN_CHUNKS        流式响应的分块数（默认 4）
+  STUB_QWEN_FAILURE_RATE  返回 HTTP 500 的概率（0-1，默认 0）
+  STUB_QWEN_SEED          随机种子（可选）
+
+用法:
+  python benchmarks/stub_openai.py --port 8000
+然后在 callqw-config.json 中设置 "backend": "openai" 和
+"openai_base_url": "http://127.0.0.1:8000/v1"。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        StubHandler.connections.add(self.client_address)
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        latency = env_float("STUB_QWEN_LATENCY", 0.0)
+        first_byte = env_float("STUB_QWEN_FIRST_BYTE", latency / 10)
+        size = int(env_float("STUB_QWEN_OUTPUT_BYTES", 256))
+        chunks = max(1, int(env_float("STUB_QWEN_CHUNKS", 4)))
+        if random.random() < env_float("STUB_QWEN_FAILURE_RATE", 0.0):
+            time.sleep(first_byte)
+            self.send_json(500, {"error": {"message": "stub failure (STUB_QWEN_FAILURE_RATE)"}})
+            return
+
+        prompt = "".join(m.get("content", "") for m in request.get("messages", []))
+        header = (f"stub response: prompt {len(prompt)} chars, model {request.get('model')}, "
+                  f"connections {len(StubHandler.connections)}\n")
+        body = header + "x" * max(0, size - len(header) - 1) + "\n"
+        time.sleep(first_byte)
+        if not request.get("stream"):
+            self.send_json(200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": body},
+                                              "finish_reason": "stop"}]})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        gap = max(0.0, latency - first_byte) / max(1, chunks - 1)
+        step = -(-len(body) // chunks)
+        events = [{"choices": [{"index": 0, "delta": {"content": body[i * step:(i + 1) * step]}}]}
+                  for i in range(chunks)]
+        for i, event in enumerate(events):
+            self.write_chunk(f"data: {json.dumps(event)}\n\n")
+            if i + 1 < chunks:
+                time.sleep(gap)
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="OpenAI 兼容接口替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+    if "STUB_QWEN_SEED" in os.environ:
+        random.seed(os.environ["STUB_QWEN_SEED"])
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"stub OpenAI server listening on http://{args.host}:{server.server_port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
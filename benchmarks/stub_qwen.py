@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Qwen Code CLI 替身，用于基准测试和本地调试
+
+接受与 qwen 相同的参数（--yolo、-d、-p <prompt>、--version），没有 -p 时从 stdin
+读取提示词。输出内容、延迟和失败率由环境变量控制:
+
+  STUB_QWEN_STARTUP       读取提示词之前的启动耗时（秒，默认 0），模拟 CLI 运行时的启动开销
+  STUB_QWEN_LATENCY       总耗时（秒，默认 0）
+  STUB_QWEN_FIRST_BYTE    首次输出前的等待（秒，默认为总耗时的 1/10）
+  STUB_QWEN_OUTPUT_BYTES  输出大小（字节，默认 256）
+  STUB_QWEN_CHUNKS        输出分块数（默认 4，剩余耗时均匀分配到块间）
+  STUB_QWEN_FAILURE_RATE  以非 0 退出码失败的概率（0-1，默认 0）
+  STUB_QWEN_CPU           输出前空转消耗的 CPU 时间（秒，默认 0），用于测试 CPU 时间限制
+  STUB_QWEN_ALLOC_MB      输出前分配并保持的内存（MB，默认 0），用于测试地址空间限制
+  STUB_QWEN_SEED          随机种子（可选，便于复现）
+
+在 callqw-config.json 中把 qwen_cli_path 指向本文件即可使用。
+"""
+
+import os
+import random
+import sys
+import time
+
+VERSION = "0.0.0-stub"
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def main(argv):
+    if "--version" in argv:
+        print(VERSION)
+        return 0
+    time.sleep(env_float("STUB_QWEN_STARTUP", 0.0))
+    prompt = argv[argv.index("-p") + 1] if "-p" in argv and argv.index("-p") + 1 < len(argv) \
+        else sys.stdin.read()
+
+    latency = env_float("STUB_QWEN_LATENCY", 0.0)
+    first_byte = env_float("STUB_QWEN_FIRST_BYTE", latency / 10)
+    size = int(env_float("STUB_QWEN_OUTPUT_BYTES", 256))
+    chunks = max(1, int(env_float("STUB_QWEN_CHUNKS", 4)))
+    failure_rate = env_float("STUB_QWEN_FAILURE_RATE", 0.0)
+    if "STUB_QWEN_SEED" in os.environ:
+        random.seed(os.environ["STUB_QWEN_SEED"])
+
+    header = f"stub response: prompt {len(prompt)} chars, mode {'agent' if '--yolo' in argv else 'ask'}\n"
+    body = (header + "x" * max(0, size - len(header) - 1) + "\n").encode("utf-8")[:max(size, 1)]
+
+    burn = env_float("STUB_QWEN_CPU", 0.0)
+    started = time.process_time()
+    while time.process_time() - started < burn:
+        pass
+    ballast = bytearray(int(env_float("STUB_QWEN_ALLOC_MB", 0) * 1024 * 1024))
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    time.sleep(first_byte)
+    gap = max(0.0, latency - first_byte) / max(1, chunks - 1)
+    step = -(-len(body) // chunks)
+    out = sys.stdout.buffer
+    for i in range(chunks):
+        out.write(body[i * step:(i + 1) * step])
+        out.flush()
+        if i + 1 < chunks:
+            time.sleep(gap)
+
+    if random.random() < failure_rate:
+        sys.stderr.write("stub failure (STUB_QWEN_FAILURE_RATE)\n")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -8,16 +8,21 @@ Qwen Bridge - Python 版本
 版本: 1.0.0
 """
 
-import argparse
+# 启动路径只导入轻量模块；argparse、asyncio、subprocess、logging、socket 等
+# 由实际用到它们的代码路径按需导入，避免 --version、守护进程客户端等路径承担额外开销
+import codecs
 import sys
 import os
-import subprocess
 import json
-import logging
+import re
+import struct
+import threading
 import time
 from pathlib import Path
 from datetime import datetime
 
+VERSION_TEXT = "Qwen Bridge Python Version 1.0.0"
+
 # 多语言UI文本
 UI_TEXTS = {
     "zh": {
@@ -41,7 +46,76 @@ UI_TEXTS = {
         "command_success": "Qwen 调用成功",
         "command_failed": "Qwen 调用失败: {}",
         "command_not_found": "错误: 未找到 qwen 命令。请确保 Qwen Code CLI 已安装并在 PATH 中，或在配置文件中指定正确路径。",
-        "command_error": "调用 Qwen 时发生错误: {}"
+        "command_error": "调用 Qwen 时发生错误: {}",
+        "context_budget_report": "上下文预算 {} {}：保留 {} 条记录，丢弃 {} 条较早记录（已用 {}）",
+        "stream_timing": "首次输出耗时 {:.2f} 秒，总耗时 {:.2f} 秒",
+        "daemon_listening": "桥接守护进程已启动，监听: {}",
+        "daemon_stopped": "桥接守护进程已停止",
+        "daemon_unsupported": "错误: 当前平台不支持 Unix socket 守护进程模式",
+        "daemon_in_use": "错误: 已有守护进程在监听 {}",
+        "daemon_disconnected": "错误: 与守护进程的连接意外中断",
+        "daemon_client_gone": "客户端已断开，终止正在执行的 Qwen 调用",
+        "batch_item_done": "[{}/{}] #{} {} ({:.2f} 秒)",
+        "batch_summary": "批处理完成：成功 {}，失败 {}，用时 {:.2f} 秒，结果已写入 {}",
+        "batch_invalid_item": "无效的请求: {}",
+        "batch_item_error": "执行请求时出错: {}",
+        "watch_started": "正在监视 {}（{}），并发数 {}，按 Ctrl+C 停止",
+        "watch_item_done": "{}: {}，{:.2f} 秒",
+        "watch_too_many_attempts": "处理已中断 {} 次，不再重试",
+        "watch_error": "处理 {} 时出错: {}",
+        "watch_summary": "监视结束：成功 {}，失败 {}",
+        "watch_status": "{}: 待处理 {}，处理中 {}，回应 {}，已完成 {}，失败 {}",
+        "map_no_files": "没有匹配 {} 的文件",
+        "map_plan": "{} 个文件分为 {} 个分块（每块预算 {}）",
+        "map_chunk_done": "[{}/{}] {}，{:.2f} 秒: {}",
+        "map_report_summary": "共 {} 个分块：成功 {}，失败 {}",
+        "map_report_failed": "（失败）",
+        "map_summary": "分块映射完成：成功 {}，失败 {}（其中 {} 个复用上次的结果），用时 {:.2f} 秒，报告已写入 {}",
+        "map_resume_hint": "重新运行相同的命令只会重新调用失败的分块",
+        "replay_no_requests": "对话日志中没有可回放的请求",
+        "log_no_records": "没有匹配的对话记录",
+        "log_invalid_time": "无效的时间: {}",
+        "replay_unknown_backend": "未知的后端: {}（可用: cli、openai 或 fanout_backends 中的名称）",
+        "replay_item_done": "[{}] {} {:.2f} 秒（开始延后 {:.2f} 秒）",
+        "replay_report": "回放 {} 条请求：成功 {}，失败 {}（错误率 {:.1%}），用时 {:.2f} 秒，吞吐量 {:.2f} 请求/秒",
+        "replay_latency": "{} (秒): p50 {}  p95 {}  p99 {}  最大 {}",
+        "replay_label_latency": "延迟",
+        "replay_label_ttfb": "首字节",
+        "replay_label_lag": "开始延后",
+        "cache_hit": "命中响应缓存（命中 {}，未命中 {}）",
+        "cache_stats": "响应缓存: {} 条记录，{} 字节 / 上限 {} 字节，命中 {}，未命中 {}，淘汰 {}",
+        "cache_cleared": "响应缓存已清空",
+        "cache_disabled": "响应缓存未启用（配置项 response_cache）",
+        "command_timeout": "Qwen 调用超时（{:.1f} 秒），已终止子进程",
+        "command_output_limit": "Qwen 输出超过上限（{} 字节），已终止子进程",
+        "command_limit_exceeded": "Qwen 子进程超过资源限制（{}），已被终止",
+        "limit_cpu": "CPU 时间 {} 秒",
+        "limit_memory": "地址空间 {} MB",
+        "limit_wall": "墙钟时间 {} 秒",
+        "child_usage": "子进程资源: 用户 CPU {} 秒，系统 CPU {} 秒，最大 RSS {} KB，上下文切换 {} 次自愿 / {} 次非自愿",
+        "hedge_started": "{:.2f} 秒内没有输出，发起对冲请求",
+        "hedge_report": "对冲请求: 第 {} 个调用胜出（截止时间 {:.2f} 秒），预计节省 {} 秒",
+        "fanout_not_configured": "未配置 fanout_backends，无法扇出调用",
+        "fanout_header": "=== {} ({:.2f} 秒) ===",
+        "fanout_report": "扇出调用: {} 最先成功（{:.2f} 秒），比最慢的成功调用快 {:.2f} 秒",
+        "scheduler_waited": "请求调度器: {} 请求排队 {:.2f} 秒",
+        "scheduler_backoff": "{} 后端返回配额或限流错误，所有请求暂停 {:.1f} 秒",
+        "scheduler_timeout": "请求调度器排队 {:.1f} 秒后达到总超时，未执行 Qwen 调用",
+        "command_retry": "第 {} 次调用失败，{:.1f} 秒后重试...",
+        "phase_timings": "阶段耗时 (毫秒): {}",
+        "search_no_match": "没有找到匹配的日志内容",
+        "context_sqlite_required": "此命令需要在配置中设置 \"context_backend\": \"sqlite\"",
+        "context_stats": "上下文记录: {} 轮, 消息 {} 字节, 回应 {} 字节, 全文索引分词器: {}",
+        "context_no_match": "没有找到相关的上下文记录",
+        "sessions_header": "{:<24} {:>8} {:>12}  {}",
+        "sessions_columns": ["会话", "轮数", "大小(字节)", "最后活动"],
+        "session_default": "(默认)",
+        "profile_written": "性能分析结果: {}",
+        "profile_memory_peak": "内存峰值 {:.2f} MiB，占用最高的检查点处分配最多的位置:",
+        "worker_pool_stats": "预热进程池: 每种命令行 {} 个, 本次交接 {:.1f} 毫秒, 无就绪进程等待 {}/{} 次, 已回收 {} 个",
+        "compact_report": "{}: {} 轮 -> {} 轮（去重 {}，合并失败记录 {}，截断回应 {}），{} -> {} 字节，节省 {} 字节",
+        "compact_nothing": "{}: 检查了 {} 轮记录，无需压缩",
+        "compact_failed": "压缩上下文记忆失败: {}"
     },
     "en": {
         "title": "=== Leader Agent -> Qwen Bridge (With Context) ===",
@@ -64,7 +138,76 @@ UI_TEXTS = {
         "command_success": "Qwen call succeeded",
         "command_failed": "Qwen call failed: {}",
         "command_not_found": "Error: qwen command not found. Please ensure Qwen Code CLI is installed and in PATH, or specify the correct path in the config file.",
-        "command_error": "Error calling Qwen: {}"
+        "command_error": "Error calling Qwen: {}",
+        "context_budget_report": "Context budget {} {}: kept {} entries, dropped {} older entries (used {})",
+        "stream_timing": "Time to first output {:.2f}s, total {:.2f}s",
+        "daemon_listening": "Bridge daemon started, listening on: {}",
+        "daemon_stopped": "Bridge daemon stopped",
+        "daemon_unsupported": "Error: Unix socket daemon mode is not supported on this platform",
+        "daemon_in_use": "Error: a daemon is already listening on {}",
+        "daemon_disconnected": "Error: connection to the daemon was lost unexpectedly",
+        "daemon_client_gone": "Client disconnected, terminating the running Qwen call",
+        "batch_item_done": "[{}/{}] #{} {} ({:.2f}s)",
+        "batch_summary": "Batch finished: {} succeeded, {} failed in {:.2f}s, results written to {}",
+        "batch_invalid_item": "Invalid request: {}",
+        "batch_item_error": "Error while executing the request: {}",
+        "watch_started": "Watching {} ({}) with concurrency {}, press Ctrl+C to stop",
+        "watch_item_done": "{}: {}, {:.2f}s",
+        "watch_too_many_attempts": "Processing was interrupted {} times, giving up",
+        "watch_error": "Error while processing {}: {}",
+        "watch_summary": "Watch finished: {} succeeded, {} failed",
+        "watch_status": "{}: {} pending, {} processing, {} responses, {} done, {} failed",
+        "map_no_files": "No files match {}",
+        "map_plan": "{} files split into {} chunks (budget {} per chunk)",
+        "map_chunk_done": "[{}/{}] {}, {:.2f}s: {}",
+        "map_report_summary": "{} chunks: {} succeeded, {} failed",
+        "map_report_failed": "(failed)",
+        "map_summary": "Map finished: {} succeeded, {} failed ({} reused from the previous run) in {:.2f}s, report written to {}",
+        "map_resume_hint": "Re-run the same command to retry only the failed chunks",
+        "replay_no_requests": "No replayable requests found in the conversation log",
+        "log_no_records": "No matching conversation records",
+        "log_invalid_time": "Invalid time: {}",
+        "replay_unknown_backend": "Unknown backend: {} (available: cli, openai or a name from fanout_backends)",
+        "replay_item_done": "[{}] {} {:.2f}s (started {:.2f}s late)",
+        "replay_report": "Replayed {} requests: {} succeeded, {} failed (error rate {:.1%}) in {:.2f}s, throughput {:.2f} req/s",
+        "replay_latency": "{} (s): p50 {}  p95 {}  p99 {}  max {}",
+        "replay_label_latency": "Latency",
+        "replay_label_ttfb": "First byte",
+        "replay_label_lag": "Start lag",
+        "cache_hit": "Response cache hit (hits {}, misses {})",
+        "cache_stats": "Response cache: {} entries, {} bytes / limit {} bytes, hits {}, misses {}, evictions {}",
+        "cache_cleared": "Response cache cleared",
+        "cache_disabled": "Response cache is disabled (config key response_cache)",
+        "command_timeout": "Qwen call timed out ({:.1f}s), child process terminated",
+        "command_output_limit": "Qwen output exceeded the limit ({} bytes), child process terminated",
+        "command_limit_exceeded": "Qwen child process exceeded its resource limit ({}) and was terminated",
+        "limit_cpu": "CPU time {}s",
+        "limit_memory": "address space {} MB",
+        "limit_wall": "wall time {}s",
+        "child_usage": "Child resources: user CPU {}s, system CPU {}s, max RSS {} KB, context switches {} voluntary / {} involuntary",
+        "hedge_started": "No output within {:.2f}s, sending a hedged request",
+        "hedge_report": "Hedged request: attempt {} won (deadline {:.2f}s), estimated saving {}s",
+        "fanout_not_configured": "fanout_backends is not configured, cannot fan out",
+        "fanout_header": "=== {} ({:.2f}s) ===",
+        "fanout_report": "Fan-out: {} succeeded first ({:.2f}s), {:.2f}s faster than the slowest success",
+        "scheduler_waited": "Request scheduler: {} request queued for {:.2f}s",
+        "scheduler_backoff": "The {} backend reported a quota or rate limit error, pausing all requests for {:.1f}s",
+        "scheduler_timeout": "Reached the total timeout after {:.1f}s in the request scheduler queue, Qwen was not called",
+        "command_retry": "Attempt {} failed, retrying in {:.1f}s...",
+        "phase_timings": "Phase timings (ms): {}",
+        "search_no_match": "No matching log lines found",
+        "context_sqlite_required": "This command requires \"context_backend\": \"sqlite\" in the config",
+        "context_stats": "Context turns: {}, messages {} bytes, responses {} bytes, full-text tokenizer: {}",
+        "context_no_match": "No relevant context entries found",
+        "sessions_header": "{:<24} {:>8} {:>12}  {}",
+        "sessions_columns": ["Session", "Turns", "Bytes", "Last activity"],
+        "session_default": "(default)",
+        "profile_written": "Profile written: {}",
+        "profile_memory_peak": "Peak memory {:.2f} MiB, top allocation sites at the highest checkpoint:",
+        "worker_pool_stats": "Worker pool: {} per command line, hand-off {:.1f} ms, waited for a worker {}/{} times, {} recycled",
+        "compact_report": "{}: {} -> {} turns ({} duplicates, {} failures collapsed, {} responses trimmed), {} -> {} bytes, saved {} bytes",
+        "compact_nothing": "{}: checked {} turns, nothing to compact",
+        "compact_failed": "Context compaction failed: {}"
     }
 }
 
@@ -163,7 +306,71 @@ class ConfigManager:
 === Agent模式协作规则结束 ===""",
         "default_english_ui": False,
         "default_dev_mode": False,
-        "default_agent_mode": False
+        "default_agent_mode": False,
+        "default_stream": False,
+        "context_recent_entries": 0,
+        "context_budget": 32000,
+        "context_budget_unit": "chars",
+        "context_backend": "markdown",
+        "context_db_file": "./callqw-context.sqlite3",
+        "context_relevant_entries": 0,
+        "context_compaction": True,
+        "context_trim_bytes": 16384,
+        "context_archive_dir": "./callqw-context-archive",
+        "sessions_dir": "./callqw-sessions",
+        "backend": "cli",
+        "openai_base_url": "http://127.0.0.1:8000/v1",
+        "openai_model": "qwen",
+        "openai_api_key": "",
+        "openai_pool_size": 4,
+        "openai_stream": True,
+        "worker_pool_size": 0,
+        "worker_pool_max_age": 300,
+        "child_cpu_seconds": 0,
+        "child_memory_mb": 0,
+        "child_wall_seconds": 0,
+        "profile": False,
+        "profile_memory": False,
+        "profile_dir": "./callqw-logs/profiles",
+        "profile_top": 20,
+        "output_memory_bytes": 1048576,
+        "output_max_bytes": 0,
+        "hedge": False,
+        "hedge_percentile": 95,
+        "hedge_min_samples": 20,
+        "hedge_delay": 10.0,
+        "hedge_cli_path": "",
+        "fanout_backends": [],
+        "map_budget": 24000,
+        "scheduler": False,
+        "scheduler_dir": "./callqw-logs/scheduler",
+        "scheduler_rate": 1.0,
+        "scheduler_burst": 5,
+        "scheduler_interactive_reserve": 1,
+        "scheduler_backoff_base": 5.0,
+        "scheduler_backoff_max": 300.0,
+        "scheduler_quota_retries": 3,
+        "scheduler_quota_pattern": r"(?i)quota|rate.?limit|too many requests|\b429\b|配额|限流",
+        "scheduler_limits": {},
+        "daemon_socket": "./callqw-logs/callqw.sock",
+        "response_cache": False,
+        "response_cache_file": "./callqw-logs/callqw-response-cache.sqlite3",
+        "response_cache_max_bytes": 52428800,
+        "response_cache_ttl": 86400,
+        "call_timeout": 0,
+        "total_timeout": 0,
+        "retry_attempts": 0,
+        "retry_backoff_base": 1.0,
+        "retry_backoff_max": 30.0,
+        "metrics": True,
+        "metrics_file": "./callqw-logs/callqw-metrics.jsonl",
+        "metrics_prometheus_file": "",
+        "conversation_text_log": True,
+        "log_max_bytes": 10485760,
+        "log_max_age_days": 7,
+        "log_compression": "auto",
+        "log_retention_count": 20,
+        "log_retention_days": 90
     }
     
     def __init__(self, config_path="config.json"):
@@ -251,241 +458,4040 @@ class Colors:
         """打印彩色文本"""
         print(self.colorize(text, color))
 
+    def write_colored(self, text, color):
+        """输出彩色文本片段（不换行，立即刷新），用于流式输出"""
+        sys.stdout.write(self.colorize(text, color))
+        sys.stdout.flush()
 
-class QwenBridge:
-    def __init__(self, config_path=None):
-        self.version = "1.0.0"
-        self.work_dir = Path.cwd()
 
-        # 只在当前工作目录查找和生成配置文件
-        if config_path is None:
-            config_path = self.work_dir / "callqw-config.json"
-            if not config_path.exists():
-                print(f"未检测到项目配置，自动创建: {config_path}")
-        else:
-            config_path = Path(config_path)
+class FileLock:
+    """跨进程的排他文件锁（POSIX 使用 fcntl.flock，Windows 使用 msvcrt.locking）
 
-        # 加载配置（如无则自动创建）
-        self.config_manager = ConfigManager(str(config_path))
-        self.config = self.config_manager.config
+    用于保护多个 callqw 进程共享的元数据（上下文索引、Prometheus 状态文件）。
+    同一实例可重入；线程之间的互斥仍由调用方的 threading.Lock 负责。
+    """
 
-        # 使用配置中的路径，如果是相对路径则基于配置文件所在目录
-        config_dir = Path(config_path).parent
-        logs_dir_config = self.config.get("logs_dir", str(config_dir / "callqw-logs"))
-        context_file_config = self.config.get("context_memory_file", str(config_dir / "callqw-context-memory.md"))
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+        self._depth = 0
 
-        # 处理路径：如果是相对路径，则基于配置文件所在目录
-        if not Path(logs_dir_config).is_absolute():
-            self.logs_dir = config_dir / logs_dir_config
-        else:
-            self.logs_dir = Path(logs_dir_config)
+    def acquire(self, blocking=True):
+        """获取锁；blocking 为 False 且锁被其他进程持有时返回 False"""
+        if self._depth:
+            self._depth += 1
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            f.close()
+                            return False
+                        time.sleep(0.05)
+            else:
+                import fcntl
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    f.close()
+                    return False
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+        self._depth = 1
+        return True
 
-        if not Path(context_file_config).is_absolute():
-            self.context_file = config_dir / context_file_config
-        else:
-            self.context_file = Path(context_file_config)
+    def release(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        f, self._file = self._file, None
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
 
-        self.conversation_log = self.logs_dir / "callqw-conversation-log.txt"
-        self.bridge_log = self.logs_dir / "callqw-bridge.log"
-        self.colors = Colors()
+    def __enter__(self):
+        self.acquire()
+        return self
 
-        # 确保目录存在
-        self.logs_dir.mkdir(parents=True, exist_ok=True)
+    def __exit__(self, *exc_info):
+        self.release()
 
-        # 设置日志
-        self.setup_logging()
-        
-    def get_ui_text(self, key, english_ui=False):
-        """获取多语言UI文本"""
-        lang = "en" if english_ui else "zh"
-        return UI_TEXTS[lang].get(key, UI_TEXTS["zh"].get(key, key))
-        
-    def setup_logging(self, dev_mode=False):
-        """设置日志系统"""
-        handlers = [logging.FileHandler(self.bridge_log, encoding='utf-8')]
-        
-        # 只在开发者模式下输出到控制台
-        if dev_mode:
-            handlers.append(logging.StreamHandler(sys.stdout))
-            
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=handlers,
-            force=True  # 强制重新配置
-        )
-        self.logger = logging.getLogger(__name__)
-        
-    def log_conversation(self, mode, message, response="", english_ui=False):
-        """记录对话日志"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 根据UI语言选择标签
-        if english_ui:
-            mode_label = f"Mode: {mode}"
-            user_label = "User/Leader Agent"
-            qwen_label = "Qwen"
-        else:
-            mode_label = f"模式: {mode}"
-            user_label = "用户/Leader Agent"
-            qwen_label = "Qwen"
-        
-        log_entry = f"[{timestamp}] {mode_label}\n{user_label}: {message}\n"
+
+class ContextStore:
+    """追加写入的上下文记忆存储
+
+    数据文件沿用原有的 Markdown 格式，每轮对话只在末尾追加一条记录；
+    旁路索引文件（<context_memory_file>.idx）为每条记录保存定长的
+    (偏移, 长度, 时间戳)，读取最近 N 条时可以直接定位，无需解析整个文件。
+    """
+
+    INDEX_MAGIC = b"CQWIDX01"
+    RECORD = struct.Struct("<QId")  # 偏移, 长度, 时间戳
+    ENTRY_PATTERN = rb"\r?\n## (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\r?\n"  # 首次使用时由 re 编译并缓存
+    ENTRY_BODY_PATTERN = r"\*\*用户/Leader Agent\*\*: (.*?)\n(?:\*\*Qwen回应\*\*: (.*?)\n)?\n?$"
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, data_path):
+        self.data_path = Path(data_path)
+        self.index_path = Path(str(self.data_path) + ".idx")
+        # 压缩时在持有锁的情况下重新读取全部记录，因此使用可重入锁
+        self._lock = threading.RLock()
+        # 多个进程共用同一个上下文文件时，由文件锁保证数据和索引的写入顺序一致
+        self.file_lock = FileLock(str(self.data_path) + ".lock")
+        self._synced = False
+
+    @staticmethod
+    def format_entry(timestamp, message, response=""):
+        """按上下文记忆的 Markdown 格式生成一条记录"""
+        entry = f"\n## {timestamp}\n"
+        entry += f"**用户/Leader Agent**: {message}\n"
         if response:
-            log_entry += f"{qwen_label}: {response}\n"
-        log_entry += "-" * 50 + "\n"
-        
-        with open(self.conversation_log, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
-            
-    def get_context_memory(self, english_ui=False):
-        """获取上下文记忆"""
-        if self.context_file.exists():
+            entry += f"**Qwen回应**: {response}\n"
+        entry += "\n"
+        return entry
+
+    def _parse_timestamp(self, raw):
+        try:
+            return datetime.strptime(raw.decode("ascii"), self.TIMESTAMP_FORMAT).timestamp()
+        except ValueError:
+            return 0.0
+
+    def _read_records(self, index_file, start, count):
+        """从索引文件读取 [start, start+count) 范围内的记录"""
+        index_file.seek(len(self.INDEX_MAGIC) + start * self.RECORD.size)
+        data = index_file.read(count * self.RECORD.size)
+        return [self.RECORD.unpack_from(data, i * self.RECORD.size)
+                for i in range(len(data) // self.RECORD.size)]
+
+    def _record_count(self, index_size):
+        return max(0, (index_size - len(self.INDEX_MAGIC)) // self.RECORD.size)
+
+    def _scan_entries(self, start):
+        """从数据文件 start 处开始扫描记录，返回 (偏移, 长度, 时间戳) 列表"""
+        with open(self.data_path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        matches = list(re.finditer(self.ENTRY_PATTERN, data))
+        records = []
+        for i, match in enumerate(matches):
+            begin = match.start()
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(data)
+            records.append((start + begin, end - begin, self._parse_timestamp(match.group(1))))
+        return records
+
+    def _index_state(self):
+        """不加锁检查索引：索引无效或不存在时返回 None，最后一条记录正好结束于数据文件末尾时返回 True"""
+        try:
+            data_size = self.data_path.stat().st_size if self.data_path.exists() else 0
+            with open(self.index_path, "rb") as f:
+                if f.read(len(self.INDEX_MAGIC)) != self.INDEX_MAGIC:
+                    return None
+                index_size = f.seek(0, os.SEEK_END)
+                count = self._record_count(index_size)
+                if index_size != len(self.INDEX_MAGIC) + count * self.RECORD.size:
+                    return False
+                indexed_end = 0
+                if count:
+                    offset, length, _ = self._read_records(f, count - 1, 1)[0]
+                    indexed_end = offset + length
+        except OSError:
+            return None
+        return indexed_end == data_size
+
+    def _sync_index(self):
+        """让索引与数据文件保持一致
+
+        首次运行时从旧的 Markdown 文件一次性构建索引（迁移）；之后只校验
+        最后一条记录，并补齐崩溃时已写入数据但未写入索引的尾部记录。
+        索引已经一致时不加文件锁；需要补齐但另一个进程正在追加记录时，
+        本次直接使用现有索引，读取方不会等待写入方。
+        """
+        if self._synced:
+            return
+        state = self._index_state()
+        if state is None:
+            # 索引不存在（迁移）时必须先构建，写入方只在追加的瞬间持有锁
+            with self.file_lock:
+                self._repair_index()
+        elif not state:
+            if not self.file_lock.acquire(blocking=False):
+                return
             try:
-                with open(self.context_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                self.logger.debug(self.get_ui_text("context_loaded", english_ui).format(len(content)))
-                return content
-            except Exception as e:
-                self.logger.warning(self.get_ui_text("context_load_failed", english_ui).format(str(e)))
-                return ""
+                self._repair_index()
+            finally:
+                self.file_lock.release()
+        self._synced = True
+
+    def _repair_index(self):
+        data_size = self.data_path.stat().st_size if self.data_path.exists() else 0
+        valid = False
+        if self.index_path.exists():
+            with open(self.index_path, "rb") as f:
+                valid = f.read(len(self.INDEX_MAGIC)) == self.INDEX_MAGIC
+        if not valid:
+            with open(self.index_path, "wb") as f:
+                f.write(self.INDEX_MAGIC)
+
+        with open(self.index_path, "r+b") as f:
+            count = self._record_count(f.seek(0, os.SEEK_END))
+            # 截掉写了一半的索引记录
+            f.truncate(len(self.INDEX_MAGIC) + count * self.RECORD.size)
+            indexed_end = 0
+            if count:
+                offset, length, _ = self._read_records(f, count - 1, 1)[0]
+                indexed_end = offset + length
+            if indexed_end > data_size:
+                # 数据文件被截断或手动改写，重建索引
+                f.truncate(len(self.INDEX_MAGIC))
+                count, indexed_end = 0, 0
+            if data_size > indexed_end:
+                f.seek(0, os.SEEK_END)
+                for record in self._scan_entries(indexed_end):
+                    f.write(self.RECORD.pack(*record))
+
+    def append(self, message, response="", timestamp=None):
+        """追加一条记录，开销与历史长度无关"""
+        now = datetime.now() if timestamp is None else timestamp
+        entry = self.format_entry(now.strftime(self.TIMESTAMP_FORMAT), message, response).encode("utf-8")
+        with self._lock, self.file_lock:
+            self._sync_index()
+            with open(self.data_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(entry)
+            # 先写数据再写索引：崩溃时最多丢失索引，下次同步时自动补齐
+            with open(self.index_path, "ab") as f:
+                f.write(self.RECORD.pack(offset, len(entry), now.timestamp()))
+
+    def open_entry(self, message, timestamp=None):
+        """开始一条增量写入的记录，返回 ContextEntryWriter
+
+        回应先写入临时文件，close() 时才加锁一次追加整条记录，流式调用期间
+        不持有存储锁，其他进程可以照常读写同一个上下文文件。
+        """
+        return ContextEntryWriter(self, datetime.now() if timestamp is None else timestamp, message)
+
+    def __len__(self):
+        with self._lock:
+            self._sync_index()
+            return self._record_count(self.index_path.stat().st_size)
+
+    def tail(self, count):
+        """返回最近 count 条记录拼接成的文本"""
+        if count <= 0 or not self.data_path.exists():
+            return ""
+        with self._lock:
+            self._sync_index()
+            with open(self.index_path, "rb") as f:
+                total = self._record_count(f.seek(0, os.SEEK_END))
+                start = max(0, total - count)
+                records = self._read_records(f, start, total - start)
+        if not records:
+            return ""
+        begin = records[0][0]
+        end = records[-1][0] + records[-1][1]
+        with open(self.data_path, "rb") as f:
+            f.seek(begin)
+            return f.read(end - begin).decode("utf-8", errors="replace")
+
+    def iter_reverse(self, batch=64):
+        """从新到旧逐条产出 (时间戳, 文本)，按批次反向读取索引"""
+        if not self.data_path.exists():
+            return
+        with self._lock:
+            self._sync_index()
+            total = self._record_count(self.index_path.stat().st_size)
+        with open(self.index_path, "rb") as index_file, open(self.data_path, "rb") as data_file:
+            end = total
+            while end > 0:
+                start = max(0, end - batch)
+                for offset, length, timestamp in reversed(self._read_records(index_file, start, end - start)):
+                    data_file.seek(offset)
+                    yield timestamp, data_file.read(length).decode("utf-8", errors="replace")
+                end = start
+
+    def read_all(self):
+        """读取完整的上下文记忆文本"""
+        if not self.data_path.exists():
+            return ""
+        with open(self.data_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def load_turns(self, after=0):
+        """读取第 after 条之后的记录，返回 (记录列表, 记录总数)
+
+        每条记录是一个字典（key、created、offset、raw、message、response），
+        无法解析的记录（例如手动编辑过的内容）message 为 None，压缩时原样保留。
+        """
+        if not self.data_path.exists():
+            return [], 0
+        with self._lock:
+            self._sync_index()
+            with open(self.index_path, "rb") as f:
+                total = self._record_count(f.seek(0, os.SEEK_END))
+                records = self._read_records(f, after, total - after) if total > after else []
+        turns = []
+        with open(self.data_path, "rb") as f:
+            for i, (offset, length, timestamp) in enumerate(records):
+                f.seek(offset)
+                raw = f.read(length)
+                match = re.search(self.ENTRY_BODY_PATTERN, raw.decode("utf-8", errors="replace"), re.DOTALL)
+                turns.append({
+                    "key": after + i, "created": timestamp, "offset": offset, "raw": raw,
+                    "message": match.group(1) if match else None,
+                    "response": (match.group(2) or "") if match else None,
+                })
+        return turns, total
+
+    def compact(self, transform):
+        """用 transform(全部记录) 返回的记录替换上下文记忆，返回 (记录总数, 压缩前字节数, 压缩后字节数)
+
+        新内容先写入临时文件并 fsync，再依次删除旧索引、重命名数据文件和索引：
+        任何一步崩溃，数据文件都是完整的旧版本或新版本，缺失的索引会在下次同步时重建。
+        """
+        with self._lock, self.file_lock:
+            turns, _ = self.load_turns()
+            kept = transform(turns)
+            size_before = self.data_path.stat().st_size if self.data_path.exists() else 0
+            prefix = b""
+            if self.data_path.exists():
+                # 保留第一条记录之前的内容（例如手动添加的标题）
+                with open(self.data_path, "rb") as f:
+                    prefix = f.read(turns[0]["offset"] if turns else size_before)
+            data_tmp = Path(str(self.data_path) + ".compact-tmp")
+            index_tmp = Path(str(self.index_path) + ".compact-tmp")
+            with open(data_tmp, "wb") as data, open(index_tmp, "wb") as index:
+                data.write(prefix)
+                index.write(self.INDEX_MAGIC)
+                for turn in kept:
+                    raw = turn["raw"]
+                    if turn.get("modified"):
+                        timestamp = datetime.fromtimestamp(turn["created"]).strftime(self.TIMESTAMP_FORMAT)
+                        raw = self.format_entry(timestamp, turn["message"], turn["response"]).encode("utf-8")
+                    index.write(self.RECORD.pack(data.tell(), len(raw), turn["created"]))
+                    data.write(raw)
+                size_after = data.tell()
+                for f in (data, index):
+                    f.flush()
+                    os.fsync(f.fileno())
+            try:
+                self.index_path.unlink()
+            except FileNotFoundError:
+                pass
+            os.replace(data_tmp, self.data_path)
+            os.replace(index_tmp, self.index_path)
+        return len(kept), size_before, size_after
+
+
+class ContextEntryWriter:
+    """流式写入单条上下文记录
+
+    回应内容先写入 SpooledTemporaryFile（不超过 SPOOL_BYTES 时留在内存中），close() 时
+    在存储锁内把整条记录追加到数据文件并写入索引，持锁时间与调用耗时无关。
+    """
+
+    SPOOL_BYTES = 1048576
+
+    def __init__(self, store, timestamp, message):
+        import tempfile
+        self.store = store
+        self.timestamp = timestamp
+        self.message = message
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_BYTES, dir=str(store.data_path.parent),
+                                                   prefix="callqw-entry-")
+        self.has_response = False
+
+    def write(self, text):
+        """追加一段回应内容"""
+        if not text:
+            return
+        self.has_response = True
+        self.spool.write(text.encode("utf-8"))
+
+    def close(self):
+        """把整条记录追加到数据文件并写入索引"""
+        import shutil
+        store = self.store
+        header = ContextStore.format_entry(self.timestamp.strftime(ContextStore.TIMESTAMP_FORMAT), self.message)
+        try:
+            self.spool.seek(0)
+            with store._lock, store.file_lock:
+                store._sync_index()
+                with open(store.data_path, "ab") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    # format_entry 以空行结尾，回应内容紧跟在用户消息之后
+                    f.write(header[:-1].encode("utf-8"))
+                    if self.has_response:
+                        f.write("**Qwen回应**: ".encode("utf-8"))
+                        shutil.copyfileobj(self.spool, f)
+                    f.write(b"\n\n" if self.has_response else b"\n")
+                    length = f.tell() - offset
+                with open(store.index_path, "ab") as f:
+                    f.write(ContextStore.RECORD.pack(offset, length, self.timestamp.timestamp()))
+        finally:
+            self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SQLiteContextStore:
+    """基于 SQLite 的上下文记忆存储（配置 context_backend 为 sqlite 时启用）
+
+    每轮对话保存为一行，记录模式、会话、时间戳和大小；FTS5 全文索引
+    （支持时使用 trigram 分词，中文无需分词）用于检索与当前消息相关的历史记录。
+    接口与 ContextStore 相同，渲染出的文本沿用 Markdown 记录格式。
+    首次使用时自动导入已有的 Markdown 上下文记忆。
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS turns ("
+        " id INTEGER PRIMARY KEY, created REAL NOT NULL, mode TEXT NOT NULL, session TEXT NOT NULL,"
+        " message TEXT NOT NULL, response TEXT NOT NULL,"
+        " message_bytes INTEGER NOT NULL, response_bytes INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS turns_session ON turns (session, id)",
+        "CREATE INDEX IF NOT EXISTS turns_created ON turns (created)",
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+    FTS_TOKENIZERS = ("trigram", "unicode61")
+    TERM_PATTERN = r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+|\w+"  # 连续的 CJK 字符或单词
+    MAX_QUERY_TERMS = 32
+    CANDIDATES_PER_TERM = 200
+
+    def __init__(self, data_path, import_from=None):
+        self.data_path = Path(data_path)
+        self.import_from = Path(import_from) if import_from else None
+        self._lock = threading.Lock()
+        self._initialized = False
+        self.fts_tokenizer = None
+
+    def _connect(self):
+        import sqlite3
+        self.data_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.data_path), timeout=10)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 多个进程同时首次打开数据库时，由写事务保证建表和导入只执行一次
+            conn.execute("BEGIN IMMEDIATE")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.fts_tokenizer = self._ensure_fts(conn)
+            if self.import_from is not None:
+                self._import_markdown(conn)
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def _ensure_fts(self, conn):
+        """创建全文索引表；SQLite 不支持 FTS5 时返回 None，此时只能按时间读取"""
+        import sqlite3
+        row = conn.execute("SELECT value FROM meta WHERE name = 'fts_tokenizer'").fetchone()
+        if row:
+            return row[0] or None
+        for tokenizer in self.FTS_TOKENIZERS:
+            try:
+                conn.execute(
+                    "CREATE VIRTUAL TABLE turns_fts USING fts5("
+                    f" message, response, content='turns', content_rowid='id', tokenize='{tokenizer}')")
+            except sqlite3.OperationalError:
+                continue
+            conn.execute("INSERT INTO turns_fts (turns_fts) VALUES ('rebuild')")
+            break
         else:
-            self.logger.debug(self.get_ui_text("context_not_found", english_ui))
+            tokenizer = ""
+        conn.execute("INSERT INTO meta (name, value) VALUES ('fts_tokenizer', ?)", (tokenizer,))
+        return tokenizer or None
+
+    def _import_markdown(self, conn):
+        """把已有的 Markdown 上下文记忆一次性导入数据库"""
+        if conn.execute("SELECT 1 FROM meta WHERE name = 'imported'").fetchone():
+            return
+        if self.import_from.exists() and not conn.execute("SELECT 1 FROM turns LIMIT 1").fetchone():
+            source = ContextStore(self.import_from)
+            rows = []
+            for timestamp, text in source.iter_reverse():
+                match = re.search(ContextStore.ENTRY_BODY_PATTERN, text, re.DOTALL)
+                if match:
+                    rows.append((timestamp, match.group(1), match.group(2) or ""))
+            for timestamp, message, response in reversed(rows):
+                self._insert(conn, timestamp, "ask", "", message, response)
+        conn.execute("INSERT INTO meta (name, value) VALUES ('imported', '1')")
+
+    def _insert(self, conn, timestamp, mode, session, message, response):
+        cursor = conn.execute(
+            "INSERT INTO turns (created, mode, session, message, response, message_bytes, response_bytes)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (timestamp, mode, session, message, response,
+             len(message.encode("utf-8")), len(response.encode("utf-8"))))
+        if self.fts_tokenizer:
+            conn.execute("INSERT INTO turns_fts (rowid, message, response) VALUES (?, ?, ?)",
+                         (cursor.lastrowid, message, response))
+
+    @staticmethod
+    def render(created, message, response):
+        """把一行记录渲染为 Markdown 格式的上下文文本"""
+        timestamp = datetime.fromtimestamp(created).strftime(ContextStore.TIMESTAMP_FORMAT)
+        return ContextStore.format_entry(timestamp, message, response)
+
+    def append(self, message, response="", timestamp=None, *, mode="ask", session=""):
+        """写入一轮对话，同时记录模式和会话"""
+        now = datetime.now() if timestamp is None else timestamp
+        with self._lock:
+            conn = self._connect()
+            try:
+                self._insert(conn, now.timestamp(), mode, session, message, response)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def open_entry(self, message, timestamp=None, *, mode="ask", session=""):
+        """开始一条流式写入的记录；回应内容在内存中累积，close() 时一次写入"""
+        return BufferedEntryWriter(self, message, timestamp or datetime.now(), mode=mode, session=session)
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT count(*) FROM turns").fetchone()[0]
+        finally:
+            conn.close()
+
+    def recent(self, count):
+        """返回最近 count 条记录 [(id, 时间戳, 文本)]，从新到旧排列"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, created, message, response FROM turns ORDER BY id DESC LIMIT ?",
+                                (count,)).fetchall()
+        finally:
+            conn.close()
+        return [(row[0], row[1], self.render(*row[1:])) for row in rows]
+
+    def tail(self, count):
+        """返回最近 count 条记录拼接成的文本"""
+        if count <= 0:
             return ""
-            
-    def update_context_memory(self, message, response="", english_ui=False):
-        """更新上下文记忆"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 读取现有内容
-        context_content = ""
-        if self.context_file.exists():
-            with open(self.context_file, 'r', encoding='utf-8') as f:
-                context_content = f.read()
-        
-        # 添加新的交互记录
-        new_entry = f"\n## {timestamp}\n"
-        new_entry += f"**用户/Leader Agent**: {message}\n"
-        if response:
-            new_entry += f"**Qwen回应**: {response}\n"
-        new_entry += "\n"
-        
-        # 写入更新的内容
-        with open(self.context_file, 'w', encoding='utf-8') as f:
-            f.write(context_content + new_entry)
-            
-    def call_qwen(self, message, mode="ask", dev_mode=False, english_ui=False):
-        """调用 Qwen Code CLI"""
-        # 使用配置中的CLI路径，如果未设置则使用默认值
-        qwen_cli_path = self.config.get("qwen_cli_path", "qwen")
-        if not qwen_cli_path:  # 如果配置中是空字符串，使用默认值
-            qwen_cli_path = "qwen"
-            
-        cmd = [qwen_cli_path]
-        
-        # 根据模式设置参数
-        if mode == "agent":
-            cmd.append("--yolo")  # agent 模式使用 --yolo 参数自动接受所有操作
-        
-        if dev_mode:
-            cmd.append("-d")  # debug 模式
-            
-        # 使用 -p 参数传递提示消息
-        cmd.extend(["-p", message])
-        
-        # Qwen Code 0.0.8 版本似乎不支持 --lang 参数
-        # 保留接口以备将来使用
-        
-        if dev_mode:
-            self.colors.print_colored(self.get_ui_text("calling_qwen", english_ui), "magenta")
-        
-        self.logger.info(self.get_ui_text("command_executing", english_ui).format(' '.join(cmd)))
-        
+        return "".join(text for _, _, text in reversed(self.recent(count)))
+
+    def iter_reverse(self, batch=64):
+        """从新到旧逐条产出 (时间戳, 文本)"""
+        conn = self._connect()
         try:
-            # 获取当前环境变量
-            env = os.environ.copy()
-            
-            # 首先尝试不使用shell执行命令（更安全）
-            try:
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    encoding='utf-8',
-                    cwd=self.work_dir,
-                    env=env,
-                    shell=False
-                )
-            except FileNotFoundError:
-                # 如果找不到命令，在Windows上尝试使用shell
-                if os.name == 'nt':
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        encoding='utf-8',
-                        cwd=self.work_dir,
-                        env=env,
-                        shell=True
-                    )
+            last_id = None
+            while True:
+                if last_id is None:
+                    rows = conn.execute("SELECT id, created, message, response FROM turns"
+                                        " ORDER BY id DESC LIMIT ?", (batch,)).fetchall()
                 else:
-                    raise
-            
-            stdout, stderr = process.communicate()
-            
-            if process.returncode == 0:
-                self.logger.info(self.get_ui_text("command_success", english_ui))
-                return stdout
-            else:
-                error_msg = self.get_ui_text("command_failed", english_ui).format(stderr)
-                self.logger.error(self.get_ui_text("command_failed", english_ui).format(stderr))
-                if dev_mode:
-                    self.colors.print_colored(error_msg, "red")
-                return error_msg
-                
+                    rows = conn.execute("SELECT id, created, message, response FROM turns WHERE id < ?"
+                                        " ORDER BY id DESC LIMIT ?", (last_id, batch)).fetchall()
+                if not rows:
+                    return
+                for row in rows:
+                    yield row[1], self.render(*row[1:])
+                last_id = rows[-1][0]
+        finally:
+            conn.close()
+
+    def read_all(self):
+        """读取完整的上下文记忆文本"""
+        return "".join(reversed([text for _, text in self.iter_reverse(batch=1024)]))
+
+    def query_terms(self, text):
+        """从自然语言文本中提取检索词（trigram 分词时中文按三字切分），较长、更有区分度的词优先"""
+        terms = []
+        for word in re.findall(self.TERM_PATTERN, text.lower()):
+            if self.fts_tokenizer == "trigram":
+                if len(word) < 3:
+                    continue
+                if not word.isascii():
+                    terms.extend(word[i:i + 3] for i in range(len(word) - 2))
+                    continue
+            terms.append(word)
+        unique = list(dict.fromkeys(terms))
+        return sorted(unique, key=len, reverse=True)[:self.MAX_QUERY_TERMS]
+
+    def search(self, text, limit=10, exclude=(), since=None):
+        """检索与 text 相关的记录，返回 [(id, 时间戳, 文本)]，按相关度从高到低排列
+
+        直接用 bm25() 排序需要统计每个词在全部记录中的出现次数，常见词在数十万条
+        记录上要花费数百毫秒；这里对每个词只取最新的 CANDIDATES_PER_TERM 条匹配，
+        按匹配密度估算文档频率，在候选集上计算 IDF 加权得分，耗时与历史长度基本无关。
+        """
+        import math
+        import sqlite3
+        excluded = set(exclude)
+        conn = self._connect()
+        try:
+            terms = self.query_terms(text) if self.fts_tokenizer else []
+            if not terms or limit <= 0:
+                return []
+            newest = conn.execute("SELECT max(id) FROM turns").fetchone()[0] or 0
+            scores = {}
+            for term in terms:
+                try:
+                    ids = [row[0] for row in conn.execute(
+                        "SELECT rowid FROM turns_fts WHERE turns_fts MATCH ? ORDER BY rowid DESC LIMIT ?",
+                        ('"' + term.replace('"', '""') + '"', self.CANDIDATES_PER_TERM))]
+                except sqlite3.OperationalError:
+                    continue
+                if not ids:
+                    continue
+                frequency = len(ids)
+                if frequency == self.CANDIDATES_PER_TERM:
+                    frequency = frequency * newest / max(1, newest - ids[-1] + 1)
+                weight = math.log(1 + newest / frequency)
+                for turn_id in ids:
+                    if turn_id not in excluded:
+                        scores[turn_id] = scores.get(turn_id, 0.0) + weight
+            # 得分相同时较新的记录优先
+            ranked = sorted(scores, key=lambda turn_id: (scores[turn_id], turn_id), reverse=True)
+            results = []
+            for turn_id in ranked:
+                row = conn.execute("SELECT id, created, message, response FROM turns WHERE id = ?",
+                                   (turn_id,)).fetchone()
+                if row and (since is None or row[1] >= since):
+                    results.append((row[0], row[1], self.render(*row[1:])))
+                    if len(results) >= limit:
+                        break
+            return results
+        finally:
+            conn.close()
+
+    def _load_turns(self, conn, after):
+        rows = conn.execute("SELECT id, created, message, response FROM turns WHERE id > ? ORDER BY id",
+                            (after,)).fetchall()
+        return [{"key": row[0], "created": row[1], "message": row[2], "response": row[3]} for row in rows]
+
+    def load_turns(self, after=0):
+        """读取 id 大于 after 的记录，返回 (记录列表, 最大 id)；记录格式与 ContextStore.load_turns 相同"""
+        conn = self._connect()
+        try:
+            turns = self._load_turns(conn, after)
+        finally:
+            conn.close()
+        return turns, turns[-1]["key"] if turns else after
+
+    def compact(self, transform):
+        """用 transform(全部记录) 返回的记录替换上下文记忆，返回 (最大 id, 压缩前字节数, 压缩后字节数)
+
+        删除和改写在同一个写事务中完成，崩溃时由 SQLite 回滚；字节数为消息和回应的总大小，
+        释放的页面由 SQLite 复用，文件本身不会缩小。
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            turns = self._load_turns(conn, 0)
+            kept = transform(turns)
+            original = {turn["key"]: turn for turn in turns}
+            kept_keys = {turn["key"] for turn in kept}
+            for turn in turns:
+                if turn["key"] not in kept_keys:
+                    self._unindex(conn, turn)
+                    conn.execute("DELETE FROM turns WHERE id = ?", (turn["key"],))
+            for turn in kept:
+                if not turn.get("modified"):
+                    continue
+                self._unindex(conn, original[turn["key"]])
+                conn.execute(
+                    "UPDATE turns SET message = ?, response = ?, message_bytes = ?, response_bytes = ? WHERE id = ?",
+                    (turn["message"], turn["response"], len(turn["message"].encode("utf-8")),
+                     len(turn["response"].encode("utf-8")), turn["key"]))
+                if self.fts_tokenizer:
+                    conn.execute("INSERT INTO turns_fts (rowid, message, response) VALUES (?, ?, ?)",
+                                 (turn["key"], turn["message"], turn["response"]))
+            conn.commit()
+        finally:
+            conn.close()
+
+        def size(items):
+            return sum(len(t["message"].encode("utf-8")) + len(t["response"].encode("utf-8")) for t in items)
+
+        return (turns[-1]["key"] if turns else 0), size(turns), size(kept)
+
+    def _unindex(self, conn, turn):
+        """从外部内容 FTS 表中删除一行（需要提供原来的内容）"""
+        if self.fts_tokenizer:
+            conn.execute("INSERT INTO turns_fts (turns_fts, rowid, message, response) VALUES ('delete', ?, ?, ?)",
+                         (turn["key"], turn["message"], turn["response"]))
+
+    def stats(self):
+        """返回记录数、消息/回应总字节数和全文索引分词器"""
+        conn = self._connect()
+        try:
+            count, message_bytes, response_bytes = conn.execute(
+                "SELECT count(*), coalesce(sum(message_bytes), 0), coalesce(sum(response_bytes), 0)"
+                " FROM turns").fetchone()
+        finally:
+            conn.close()
+        return {"turns": count, "message_bytes": message_bytes, "response_bytes": response_bytes,
+                "fts": self.fts_tokenizer or "-"}
+
+
+class BufferedEntryWriter:
+    """为不支持追加写入的存储累积流式回应，close() 时写入一条完整记录
+
+    metadata 为原样传给 store.append 的关键字参数（例如 SQLite 存储的 mode 和 session）。
+    """
+
+    def __init__(self, store, message, timestamp, **metadata):
+        self.store = store
+        self.message = message
+        self.timestamp = timestamp
+        self.metadata = metadata
+        self.parts = []
+
+    def write(self, text):
+        """追加一段回应内容"""
+        if text:
+            self.parts.append(text)
+
+    def close(self):
+        """写入完整记录"""
+        self.store.append(self.message, "".join(self.parts), self.timestamp, **self.metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ContextCompactor:
+    """上下文记忆压缩：按内容哈希去重、合并连续的失败记录、截断过长的回应
+
+    每次写入上下文后由 schedule() 在后台线程中增量检查：只读取上次检查之后新增的
+    记录，与状态文件（<数据文件>.compact）中保存的内容哈希比较，只有发现重复、
+    连续失败或过长回应时才重写整个存储。被截断的回应完整保存在 archive_dir 中，
+    上下文中只保留开头和结尾，并注明归档文件的位置。
+    """
+
+    STATE_MAGIC = b"CQWCMP01"
+    STATE_HEADER = struct.Struct("<QB")  # 已检查的位置, 最后一条记录的失败类型
+    DIGEST_SIZE = 8
+    ERROR_KEYS = ("command_failed", "command_not_found", "command_timeout", "command_output_limit", "command_error",
+                  "command_limit_exceeded", "scheduler_timeout")
+    COLLAPSED_PATTERN = r"\n\[已合并 (\d+) 条连续的失败记录\]$"
+
+    def __init__(self, store, archive_dir, trim_bytes=0, on_error=None):
+        self.store = store
+        # 未配置归档目录时不截断回应
+        self.archive_dir = Path(archive_dir) if archive_dir else None
+        self.trim_bytes = trim_bytes if archive_dir else 0
+        self.on_error = on_error
+        self.state_path = Path(str(store.data_path) + ".compact")
+        self.file_lock = FileLock(str(store.data_path) + ".compact.lock")
+        self._lock = threading.Lock()
+        self._schedule_lock = threading.Lock()
+        self._thread = None
+        self._pending = False
+
+    @classmethod
+    def error_kind(cls, response):
+        """返回回应对应的失败类型（ERROR_KEYS 中的序号加 1），不是失败提示时返回 0"""
+        if not response:
+            return 0
+        for kind, key in enumerate(cls.ERROR_KEYS, 1):
+            for texts in UI_TEXTS.values():
+                if response.startswith(texts[key].split("{")[0]):
+                    return kind
+        return 0
+
+    def digest(self, turn):
+        import hashlib
+        text = turn["message"] + "\0" + turn["response"]
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=self.DIGEST_SIZE).digest()
+
+    def oversized(self, turn):
+        return bool(self.trim_bytes) and len(turn["response"].encode("utf-8")) > self.trim_bytes
+
+    def _read_state(self):
+        """读取 (已检查的位置, 最后的失败类型, 哈希集合)；状态文件不存在或已损坏时返回 None"""
+        try:
+            with open(self.state_path, "rb") as f:
+                data = f.read()
         except FileNotFoundError:
-            error_msg = self.get_ui_text("command_not_found", english_ui)
-            self.logger.error(error_msg)
-            if dev_mode:
-                self.colors.print_colored(error_msg, "red")
-            return error_msg
-        except Exception as e:
-            error_msg = self.get_ui_text("command_error", english_ui).format(str(e))
-            self.logger.error(error_msg)
-            if dev_mode:
-                self.colors.print_colored(error_msg, "red")
-            return error_msg
-            
-    def display_header(self, english_ui=False):
-        """显示程序头部信息"""
-        title = self.get_ui_text("title", english_ui)
-        version = self.get_ui_text("version", english_ui)
-        working_dir = self.get_ui_text("working_dir", english_ui).format(self.work_dir)
-        
-        header = f"\n{title}\n{version}\n{working_dir}\n"
-        print(header)
-        
-    def run(self, args):
-        """主运行方法"""
-        # 使用配置中的默认值（如果命令行参数未明确指定）
-        english_ui = args.english_ui or self.config.get("default_english_ui", False)
-        dev_mode = args.dev_mode or self.config.get("default_dev_mode", False)
-        agent_mode = args.mode == "agent" or (args.mode is None and self.config.get("default_agent_mode", False))
-        
-        # 重新配置日志系统（根据 dev_mode）
-        self.setup_logging(dev_mode)
-        
-        # 只在开发者模式显示头部信息
-        if dev_mode:
-            self.display_header(english_ui)
-            
-            # 显示模式信息
-            if agent_mode:
-                mode_text = self.get_ui_text("mode_agent", english_ui)
+            return None
+        start = len(self.STATE_MAGIC) + self.STATE_HEADER.size
+        if len(data) < start or not data.startswith(self.STATE_MAGIC):
+            return None
+        marker, last_kind = self.STATE_HEADER.unpack_from(data, len(self.STATE_MAGIC))
+        end = start + (len(data) - start) // self.DIGEST_SIZE * self.DIGEST_SIZE
+        digests = {data[i:i + self.DIGEST_SIZE] for i in range(start, end, self.DIGEST_SIZE)}
+        return marker, last_kind, digests
+
+    def _write_state(self, marker, last_kind, digests):
+        tmp = Path(str(self.state_path) + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(self.STATE_MAGIC + self.STATE_HEADER.pack(marker, last_kind) + b"".join(digests))
+        os.replace(tmp, self.state_path)
+
+    def _append_state(self, marker, last_kind, digests):
+        """追加新记录的哈希后再更新头部：中途崩溃时只会多检查一遍新记录"""
+        with open(self.state_path, "r+b") as f:
+            start = len(self.STATE_MAGIC) + self.STATE_HEADER.size
+            size = f.seek(0, os.SEEK_END)
+            f.truncate(start + (size - start) // self.DIGEST_SIZE * self.DIGEST_SIZE)
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(digests))
+            f.seek(len(self.STATE_MAGIC))
+            f.write(self.STATE_HEADER.pack(marker, last_kind))
+
+    def _scan(self, turns, last_kind, digests):
+        """检查新记录是否需要压缩；不需要时返回 (新哈希列表, 最后的失败类型)，否则返回 None"""
+        added = []
+        for turn in turns:
+            if turn["message"] is None:
+                last_kind = 0
+                continue
+            kind = self.error_kind(turn["response"])
+            digest = self.digest(turn)
+            if (kind and kind == last_kind) or digest in digests or self.oversized(turn):
+                return None
+            digests.add(digest)
+            added.append(digest)
+            last_kind = kind
+        return added, last_kind
+
+    def compact(self, full=False):
+        """执行一次压缩，返回报告字典
+
+        full 为 False 时从状态文件记录的位置增量检查；为 True 时忽略状态文件，检查全部记录。
+        两种方式都只在确实有内容可压缩时才重写存储。
+        """
+        with self._lock, self.file_lock:
+            state = None if full else self._read_state()
+            if state is not None:
+                marker, last_kind, digests = state
+                turns, new_marker = self.store.load_turns(marker)
+                if new_marker < marker:
+                    # 存储被截断或替换过，重新检查全部记录
+                    state = None
+            if state is None:
+                marker, last_kind, digests = 0, 0, set()
+                turns, new_marker = self.store.load_turns()
+            scanned = self._scan(turns, last_kind, digests)
+            if scanned is None:
+                return self._compact_all()
+            added, last_kind = scanned
+            if state is None:
+                self._write_state(new_marker, last_kind, digests)
+            elif added or new_marker != marker:
+                self._append_state(new_marker, last_kind, added)
+            return {"compacted": False, "checked": len(turns)}
+
+    def _compact_all(self):
+        report = {"compacted": True, "duplicates": 0, "errors_collapsed": 0, "trimmed": 0}
+        kept = []
+
+        def transform(turns):
+            kept.extend(self._transform(turns, report))
+            report.update(turns_before=len(turns), turns_after=len(kept))
+            return kept
+
+        marker, size_before, size_after = self.store.compact(transform)
+        parsed = [turn for turn in kept if turn["message"] is not None]
+        last_kind = self.error_kind(kept[-1]["response"]) if kept and kept[-1]["message"] is not None else 0
+        self._write_state(marker, last_kind, {self.digest(turn) for turn in parsed})
+        report.update(bytes_before=size_before, bytes_after=size_after, saved=size_before - size_after)
+        return report
+
+    def _transform(self, turns, report):
+        """合并连续的同类失败记录，截断过长的回应，再按内容哈希去重（保留最新的一条）"""
+        collapsed = []
+        previous_kind = 0
+        for turn in turns:
+            turn = dict(turn)
+            kind = self.error_kind(turn["response"]) if turn["message"] is not None else 0
+            if kind and kind == previous_kind:
+                count = self._collapsed_count(collapsed[-1]) + self._collapsed_count(turn)
+                turn["response"] = (re.sub(self.COLLAPSED_PATTERN, "", turn["response"])
+                                    + f"\n[已合并 {count} 条连续的失败记录]")
+                collapsed[-1] = turn
+                report["errors_collapsed"] += 1
             else:
-                mode_text = self.get_ui_text("mode_ask", english_ui)
+                collapsed.append(turn)
+            previous_kind = kind
+
+        for turn in collapsed:
+            if turn["message"] is not None and self.oversized(turn):
+                turn["response"] = self._trim(turn["response"])
+                report["trimmed"] += 1
+
+        seen = set()
+        kept = []
+        for turn in reversed(collapsed):
+            if turn["message"] is not None:
+                digest = self.digest(turn)
+                if digest in seen:
+                    report["duplicates"] += 1
+                    continue
+                seen.add(digest)
+            kept.append(turn)
+        kept.reverse()
+
+        original = {turn["key"]: turn for turn in turns}
+        for turn in kept:
+            source = original[turn["key"]]
+            turn["modified"] = (turn["message"], turn["response"]) != (source["message"], source["response"])
+        return kept
+
+    def _collapsed_count(self, turn):
+        match = re.search(self.COLLAPSED_PATTERN, turn["response"])
+        return int(match.group(1)) if match else 1
+
+    def _trim(self, response):
+        """把完整回应写入归档目录，返回保留开头和结尾的摘录"""
+        import hashlib
+        data = response.encode("utf-8")
+        path = self.archive_dir / (hashlib.sha1(data).hexdigest()[:16] + ".md")
+        if not path.exists():
+            # 先写入归档再改写上下文，崩溃时不会留下指向不存在文件的引用
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            tmp = Path(str(path) + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        keep = self.trim_bytes // 4
+        head = data[:keep].decode("utf-8", errors="ignore")
+        tail = data[-keep:].decode("utf-8", errors="ignore")
+        omitted = len(data) - len(head.encode("utf-8")) - len(tail.encode("utf-8"))
+        return f"{head}\n\n[回应过长，已省略 {omitted} 字节，完整内容见 {path}]\n\n{tail}"
+
+    def schedule(self):
+        """在后台线程中执行增量压缩；已有压缩在进行时，结束后再执行一次"""
+        with self._schedule_lock:
+            if self._thread is not None:
+                self._pending = True
+                return
+            self._thread = threading.Thread(target=self._run, name="callqw-context-compact")
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+            with self._schedule_lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+
+    def wait(self):
+        """等待后台压缩结束"""
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+class ContextAssembler:
+    """按预算组装发送给 Qwen 的提示词
+
+    协作规则头部和当前消息始终保留，剩余预算从最新的对话记录开始向前填充，
+    超出预算的较早记录被丢弃，保证提示词大小不随会话变长而无限增长。
+    """
+
+    UNITS = ("chars", "tokens")
+    CJK_PATTERN = r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"  # 首次使用时由 re 编译并缓存
+
+    def __init__(self, store, budget=0, unit="chars", relevant=0, recent=0):
+        if unit not in self.UNITS:
+            raise ValueError(f"context_budget_unit 必须是 {self.UNITS} 之一: {unit}")
+        self.store = store
+        self.budget = budget
+        self.unit = unit
+        # relevant > 0 且存储支持全文检索时，上下文由“最近 recent 条 + 最相关的 relevant 条”组成
+        self.relevant = relevant if hasattr(store, "search") else 0
+        self.recent = recent or relevant
+
+    @classmethod
+    def estimate_tokens(cls, text):
+        """粗略估算 token 数：CJK 字符按 1 个 token，其余按 4 个字符 1 个 token"""
+        cjk = len(re.findall(cls.CJK_PATTERN, text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def measure(self, text):
+        """按配置的单位计算文本大小"""
+        return self.estimate_tokens(text) if self.unit == "tokens" else len(text)
+
+    def select_relevant(self, message, reserved=0):
+        """选取最近的记录和与 message 最相关的记录，返回值与 select_history 相同"""
+        remaining = self.budget - reserved if self.budget else None
+        recent = self.store.recent(self.recent)
+        matches = self.store.search(message, self.relevant, exclude=[row[0] for row in recent])
+        kept = []
+        # 最近的记录优先占用预算，其次按相关度
+        for row in recent + matches:
+            size = self.measure(row[2])
+            if remaining is not None:
+                if size > remaining:
+                    continue
+                remaining -= size
+            kept.append(row)
+        kept.sort(key=lambda row: row[0])
+        return "".join(row[2] for row in kept), len(kept), len(self.store) - len(kept)
+
+    def select_history(self, reserved=0):
+        """从新到旧选取能放入预算的记录，返回 (按时间顺序拼接的文本, 保留条数, 丢弃条数)"""
+        remaining = self.budget - reserved if self.budget else None
+        kept = []
+        for _, entry in self.store.iter_reverse():
+            size = self.measure(entry)
+            if remaining is not None:
+                if size > remaining:
+                    break
+                remaining -= size
+            kept.append(entry)
+        dropped = len(self.store) - len(kept) if self.store.data_path.exists() else 0
+        return "".join(reversed(kept)), len(kept), dropped
+
+    def assemble(self, header, message):
+        """组装完整提示词，返回 (提示词, 上下文文本, 统计信息)"""
+        started = time.perf_counter()
+        reserved = self.measure(header) + self.measure(message)
+        if self.relevant:
+            history, kept, dropped = self.select_relevant(message, reserved)
+        else:
+            history, kept, dropped = self.select_history(reserved)
+        selected = time.perf_counter()
+        parts = [header] if header else []
+        if history:
+            parts.append("=== 对话上下文 ===" + history + "=== 对话上下文结束 ===")
+        parts.append(message)
+        prompt = "\n\n".join(parts)
+        stats = {
+            "budget": self.budget,
+            "unit": self.unit,
+            "kept": kept,
+            "dropped": dropped,
+            "history_chars": len(history),
+            "used": self.measure(prompt),
+            "read_seconds": selected - started,
+            "assembly_seconds": time.perf_counter() - selected,
+        }
+        return prompt, history, stats
+
+
+class ResponseCache:
+    """ask 模式的磁盘响应缓存
+
+    使用 SQLite 单文件存储，键由提示词（包含消息和上下文）、模式、Qwen CLI
+    路径及其版本共同决定；超过容量上限时按最近访问时间淘汰，超过 TTL 的记录失效。
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS responses ("
+        " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+        " created REAL NOT NULL, accessed REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)",
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS cli_versions ("
+        " path TEXT PRIMARY KEY, mtime REAL NOT NULL, version TEXT NOT NULL)",
+    )
+
+    def __init__(self, path, max_bytes=0, ttl=0):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._initialized = False
+
+    def _connect(self):
+        import sqlite3
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        if not self._initialized:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def _bump(conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, amount))
+
+    def cli_version(self, cli_path):
+        """获取 Qwen CLI 版本；按可执行文件的修改时间缓存，避免每次调用都启动 CLI"""
+        import shutil
+        import subprocess
+        resolved = shutil.which(cli_path) or cli_path
+        try:
+            mtime = os.stat(resolved).st_mtime
+        except OSError:
+            return ""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT mtime, version FROM cli_versions WHERE path = ?", (resolved,)).fetchone()
+            if row and row[0] == mtime:
+                return row[1]
+            try:
+                version = subprocess.run(
+                    [resolved, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    timeout=30, cwd=str(self.path.parent)
+                ).stdout.decode("utf-8", errors="replace").strip()
+            except (OSError, subprocess.SubprocessError):
+                version = ""
+            conn.execute("INSERT OR REPLACE INTO cli_versions (path, mtime, version) VALUES (?, ?, ?)",
+                         (resolved, mtime, version))
+            conn.commit()
+            return version
+        finally:
+            conn.close()
+
+    def make_key(self, prompt, mode, cli_path):
+        """计算缓存键：提示词摘要 + 模式 + CLI 路径与版本"""
+        import hashlib
+        prompt_digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        material = json.dumps([prompt_digest, mode, cli_path, self.cli_version(cli_path)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """查找缓存，未命中或已过期时返回 None"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self._bump(conn, "hits")
+            else:
+                self._bump(conn, "misses")
+            conn.commit()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def put(self, key, response):
+        """写入缓存，并清理过期记录、按 LRU 淘汰超出容量的记录"""
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        if self.max_bytes and size > self.max_bytes:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO responses (key, response, size, created, accessed) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+            if self.ttl:
+                conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            if self.max_bytes:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                evicted = 0
+                while total > self.max_bytes:
+                    row = conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+                    conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                    total -= row[1]
+                    evicted += 1
+                if evicted:
+                    self._bump(conn, "evictions", evicted)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        """返回缓存统计信息"""
+        conn = self._connect()
+        try:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        finally:
+            conn.close()
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+        }
+
+    def clear(self):
+        """清空缓存记录和计数器"""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM responses")
+            conn.execute("DELETE FROM counters")
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class LogRotator:
+    """日志文件的按大小/按时间轮转、压缩归档和保留策略
+
+    轮转时把当前文件重命名为 <name>.<YYYYmmdd-HHMMSS>，压缩（gzip，或已安装
+    zstandard 时使用 zstd）和清理过期归档在后台线程中完成，不占用请求路径。
+    iter_lines() 按时间顺序透明地读取压缩归档和当前文件。
+    """
+
+    STAMP_FORMAT = "%Y%m%d-%H%M%S"
+    SUFFIXES = (".gz", ".zst")
+    START_PATTERN = r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})"  # 日志首行的时间戳
+
+    def __init__(self, max_bytes=0, max_age_days=0, compression="auto", retention_count=0, retention_days=0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.compression = compression
+        self.retention_count = retention_count
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _resolve_compression(self):
+        """auto/zstd 在未安装 zstandard 时回退为 gzip（在后台线程中解析，不影响启动）"""
+        if self.compression in ("auto", "zstd"):
+            import importlib.util
+            return "zstd" if importlib.util.find_spec("zstandard") else "gzip"
+        return self.compression if self.compression in ("gzip", "none") else "gzip"
+
+    def _started_at(self, path):
+        """从日志开头读取第一条记录的时间"""
+        try:
+            with open(path, "rb") as f:
+                head = f.read(128).decode("utf-8", errors="ignore")
+        except OSError:
+            return None
+        match = re.search(self.START_PATTERN, head)
+        if not match:
+            return None
+        try:
+            return datetime.strptime(" ".join(match.groups()), "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return None
+
+    def should_rotate(self, path):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return False
+        if size == 0:
+            return False
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        if self.max_age:
+            started = self._started_at(path)
+            return started is not None and time.time() - started >= self.max_age
+        return False
+
+    def maybe_rotate(self, path):
+        """需要时轮转日志，返回是否发生了轮转"""
+        path = Path(path)
+        if not (self.max_bytes or self.max_age) or not self.should_rotate(path):
+            return False
+        with self._lock:
+            if not self.should_rotate(path):
+                return False
+            stamp = datetime.now().strftime(self.STAMP_FORMAT)
+            target = path.with_name(f"{path.name}.{stamp}")
+            counter = 0
+            while target.exists() or any(Path(f"{target}{suffix}").exists() for suffix in self.SUFFIXES):
+                counter += 1
+                target = path.with_name(f"{path.name}.{stamp}-{counter}")
+            try:
+                os.rename(path, target)
+            except OSError:
+                # 其他进程已完成轮转
+                return False
+        thread = threading.Thread(target=self._archive, args=(path,), name="callqw-log-archive")
+        thread.start()
+        self._threads.append(thread)
+        return True
+
+    def segments(self, path):
+        """返回已轮转的归档文件，按时间从旧到新排序"""
+        path = Path(path)
+        if not path.parent.exists():
+            return []
+        prefix = path.name + "."
+        found = [p for p in path.parent.iterdir()
+                 if p.name.startswith(prefix) and p.name[len(prefix):len(prefix) + 1].isdigit()
+                 and not p.name.endswith(".tmp")]
+        return sorted(found, key=lambda p: p.name)
+
+    def _compress(self, segment, compression):
+        if compression == "none" or segment.suffix in self.SUFFIXES:
+            return
+        suffix = ".zst" if compression == "zstd" else ".gz"
+        target = Path(f"{segment}{suffix}")
+        tmp = Path(f"{target}.tmp")
+        with open(segment, "rb") as source, open(tmp, "wb") as sink:
+            if suffix == ".zst":
+                import zstandard
+                with zstandard.ZstdCompressor().stream_writer(sink, closefd=False) as writer:
+                    for block in iter(lambda: source.read(1 << 20), b""):
+                        writer.write(block)
+            else:
+                import gzip
+                with gzip.GzipFile(fileobj=sink, mode="wb") as writer:
+                    for block in iter(lambda: source.read(1 << 20), b""):
+                        writer.write(block)
+        os.replace(tmp, target)
+        segment.unlink()
+
+    def _archive(self, path):
+        """压缩所有未压缩的归档（包括之前中断留下的），并执行保留策略"""
+        compression = self._resolve_compression()
+        for segment in self.segments(path):
+            try:
+                self._compress(segment, compression)
+            except OSError:
+                pass
+        self.apply_retention(path)
+
+    def apply_retention(self, path):
+        """删除超出数量上限或超过保留天数的归档"""
+        segments = self.segments(path)
+        expired = []
+        if self.retention_count and len(segments) > self.retention_count:
+            expired = segments[:len(segments) - self.retention_count]
+        if self.retention_days:
+            cutoff = time.time() - self.retention_days * 86400
+            expired += [p for p in segments if p not in expired and p.stat().st_mtime < cutoff]
+        for segment in expired:
+            try:
+                segment.unlink()
+            except OSError:
+                pass
+
+    def wait(self):
+        """等待后台归档线程结束"""
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @staticmethod
+    def open_segment(path):
+        """以文本方式打开日志文件，自动识别 gzip/zstd 压缩"""
+        path = Path(path)
+        if path.suffix == ".gz":
+            import gzip
+            return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+        if path.suffix == ".zst":
+            import io
+            import zstandard
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+            return io.TextIOWrapper(raw, encoding="utf-8", errors="replace")
+        return open(path, "r", encoding="utf-8", errors="replace")
+
+    def iter_lines(self, path):
+        """按时间顺序逐行读取所有归档和当前日志，产出 (文件名, 行)"""
+        path = Path(path)
+        files = self.segments(path) + ([path] if path.exists() else [])
+        for segment in files:
+            try:
+                with self.open_segment(segment) as f:
+                    for line in f:
+                        yield segment.name, line.rstrip("\n")
+            except (OSError, EOFError):
+                continue
+
+
+class ConversationJournal:
+    """结构化对话日志（JSONL）
+
+    每次调用追加一行 JSON 记录：时间戳、会话、模式、消息、回应、退出状态、耗时和字节数。
+    回应从 chunks 逐块转义写入，不需要把完整文本放进内存。旁路的稀疏索引（<日志>.idx）
+    每隔 INDEX_INTERVAL 字节记录一个 (时间戳, 偏移)，按时间查询时二分查找后直接定位；
+    查看最近的记录时从文件末尾向前读取。
+
+    文本对话日志（text_path）是同一条记录的渲染结果，和 JSONL 记录在同一次写入中生成。
+    """
+
+    INDEX_MAGIC = b"CQWJIX01"
+    INDEX_RECORD = struct.Struct("<dQ")  # 时间戳, 偏移
+    INDEX_INTERVAL = 65536
+    TS_PATTERN = rb'^\{"ts": "([^"]+)"'  # 首次使用时由 re 编译并缓存
+    SEPARATOR = "-" * 50
+
+    def __init__(self, path, text_path=None, rotator=None):
+        self.path = Path(path)
+        self.index_path = Path(str(self.path) + ".idx")
+        self.text_path = Path(text_path) if text_path else None
+        self.rotator = rotator
+        self._lock = threading.Lock()
+        self.file_lock = FileLock(str(self.path) + ".lock")
+
+    @staticmethod
+    def epoch(ts):
+        """记录中的 ISO 时间戳转换为 Unix 时间"""
+        return datetime.fromisoformat(ts).timestamp()
+
+    @classmethod
+    def render_header(cls, record, english_ui=False):
+        mode_label = "Mode" if english_ui else "模式"
+        user_label = "User/Leader Agent" if english_ui else "用户/Leader Agent"
+        timestamp = record["ts"][:19].replace("T", " ")
+        return f"[{timestamp}] {mode_label}: {record['mode']}\n{user_label}: {record['message']}\n"
+
+    @classmethod
+    def render(cls, record, english_ui=False):
+        """把一条记录渲染为文本对话日志的格式"""
+        text = cls.render_header(record, english_ui)
+        response = record.get("response") or ""
+        if response:
+            text += "Qwen: " + response + ("" if response.endswith("\n") else "\n")
+        return text + cls.SEPARATOR + "\n"
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if not data.startswith(self.INDEX_MAGIC):
+            return None
+        body = data[len(self.INDEX_MAGIC):]
+        body = body[:len(body) - len(body) % self.INDEX_RECORD.size]
+        return [entry for entry in self.INDEX_RECORD.iter_unpack(body)]
+
+    def _entry_at(self, f, offset):
+        """读取 offset 处记录的时间戳，不是记录开头时返回 None"""
+        f.seek(offset)
+        match = re.match(self.TS_PATTERN, f.read(64))
+        if not match:
+            return None
+        try:
+            return self.epoch(match.group(1).decode("ascii"))
+        except ValueError:
+            return None
+
+    def _valid_index(self, entries):
+        """索引的最后一项是否仍指向当前文件中的记录（日志被轮转或截断后失效）"""
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return not entries
+        if not entries:
+            return size == 0
+        ts, offset = entries[-1]
+        if offset >= size:
+            return False
+        with open(self.path, "rb") as f:
+            found = self._entry_at(f, offset)
+        return found is not None and abs(found - ts) < 0.001
+
+    def _rebuild_index(self):
+        """扫描整个日志重建索引"""
+        entries = []
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not entries or offset - entries[-1][1] >= self.INDEX_INTERVAL:
+                        match = re.match(self.TS_PATTERN, line)
+                        if match:
+                            try:
+                                entries.append((self.epoch(match.group(1).decode("ascii")), offset))
+                            except ValueError:
+                                pass
+                    offset += len(line)
+        tmp = Path(f"{self.index_path}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(self.INDEX_MAGIC + b"".join(self.INDEX_RECORD.pack(*entry) for entry in entries))
+        os.replace(tmp, self.index_path)
+        return entries
+
+    def index(self):
+        """读取索引，失效时重建，返回 [(时间戳, 偏移)]"""
+        with self._lock, self.file_lock:
+            entries = self._read_index()
+            if entries is None or not self._valid_index(entries):
+                entries = self._rebuild_index()
+            return entries
+
+    def append(self, fields, chunks, english_ui=False):
+        """追加一条记录，回应从 chunks 逐块写入；返回不含回应的记录字段"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, self.file_lock:
+            if self.rotator is not None:
+                if self.rotator.maybe_rotate(self.path):
+                    try:
+                        self.index_path.unlink()
+                    except FileNotFoundError:
+                        pass
+                if self.text_path is not None:
+                    self.rotator.maybe_rotate(self.text_path)
+            entries = self._read_index()
+            if entries is None or not self._valid_index(entries):
+                entries = self._rebuild_index()
+
+            # 时间戳在锁内生成，文件中的记录按时间排列
+            now = time.time()
+            record = {"ts": datetime.fromtimestamp(now).isoformat(timespec="milliseconds")}
+            record.update(fields)
+            text_log = open(self.text_path, "a", encoding="utf-8") if self.text_path is not None else None
+            try:
+                with open(self.path, "a+b") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    if offset:
+                        f.seek(offset - 1)
+                        if f.read(1) != b"\n":
+                            # 上次写入在记录中途被终止，先结束那一行，避免与本条记录拼在一起
+                            f.write(b"\n")
+                            offset += 1
+                    f.write((json.dumps(record, ensure_ascii=False)[:-1] + ', "response": "').encode("utf-8"))
+                    if text_log is not None:
+                        text_log.write(self.render_header(record, english_ui))
+                    size = 0
+                    last = ""
+                    try:
+                        for text in chunks:
+                            if not text:
+                                continue
+                            f.write(json.dumps(text, ensure_ascii=False)[1:-1].encode("utf-8"))
+                            if text_log is not None:
+                                text_log.write(("Qwen: " if not size else "") + text)
+                            size += len(text.encode("utf-8"))
+                            last = text
+                    except BaseException:
+                        # 读取回应时出错（或被中断）仍然写入完整的一行；重复的 ok 键以后出现的为准
+                        f.write(f'", "response_bytes": {size}, "ok": false}}\n'.encode("utf-8"))
+                        if text_log is not None:
+                            text_log.write(("" if not size or last.endswith("\n") else "\n") + self.SEPARATOR + "\n")
+                        raise
+                    f.write(f'", "response_bytes": {size}}}\n'.encode("utf-8"))
+                if text_log is not None:
+                    text_log.write(("" if not size or last.endswith("\n") else "\n") + self.SEPARATOR + "\n")
+            finally:
+                if text_log is not None:
+                    text_log.close()
+
+            if not entries or offset - entries[-1][1] >= self.INDEX_INTERVAL:
+                with open(self.index_path, "ab") as f:
+                    if f.seek(0, os.SEEK_END) == 0:
+                        f.write(self.INDEX_MAGIC)
+                    f.write(self.INDEX_RECORD.pack(now, offset))
+        record["response_bytes"] = size
+        return record
+
+    @staticmethod
+    def parse(line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # 进程在写入过程中被终止留下的不完整记录
+            return None
+        return record if isinstance(record, dict) and "ts" in record else None
+
+    def records(self, since=None, until=None):
+        """按时间顺序产出 [since, until] 内的记录（Unix 时间，None 表示不限）
+
+        通过稀疏索引定位到不晚于 since 的最后一个索引点，只读取其后的部分。
+        """
+        import bisect
+        if not self.path.exists():
+            return
+        start = 0
+        if since is not None:
+            entries = self.index()
+            position = bisect.bisect_right([ts for ts, _ in entries], since) - 1
+            if position >= 0:
+                start = entries[position][1]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                record = self.parse(line)
+                if record is None:
+                    continue
+                ts = self.epoch(record["ts"])
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    return
+                yield record
+
+    def reverse_records(self, block_size=65536):
+        """从文件末尾向前逐条产出记录（最新的在前）"""
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            pending = b""
+            while end > 0:
+                start = max(0, end - block_size)
+                f.seek(start)
+                lines = (f.read(end - start) + pending).split(b"\n")
+                end = start
+                # 块的第一行可能不完整，留到读取前一块时拼接
+                pending = lines.pop(0) if start > 0 else b""
+                for line in reversed(lines):
+                    record = self.parse(line) if line else None
+                    if record is not None:
+                        yield record
+
+    def tail(self, count, predicate=None, since=None):
+        """最近 count 条满足 predicate 的记录，按时间顺序返回"""
+        found = []
+        for record in self.reverse_records():
+            if since is not None and self.epoch(record["ts"]) < since:
+                break
+            if predicate is None or predicate(record):
+                found.append(record)
+                if len(found) >= count:
+                    break
+        return list(reversed(found))
+
+
+class CallMetrics:
+    """单次调用的分阶段耗时和大小统计"""
+
+    def __init__(self, mode="ask"):
+        self.started = time.perf_counter()
+        self.timestamp = datetime.now()
+        self.spans = {}
+        self.fields = {"mode": mode}
+
+    def add_span(self, name, seconds):
+        """累加一个阶段的耗时（秒），None 表示该阶段未发生"""
+        if seconds is not None:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def span(self, name):
+        """计时上下文管理器"""
+        metrics = self
+
+        class _Span:
+            def __enter__(self):
+                self.started = time.perf_counter()
+
+            def __exit__(self, *exc_info):
+                metrics.add_span(name, time.perf_counter() - self.started)
+
+        return _Span()
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def add_result(self, result):
+        """记录 Qwen 调用结果中的子进程耗时和输出大小"""
+        self.add_span("queue", result.queued)
+        self.add_span("spawn", result.spawn)
+        self.add_span("ttfb", result.first_output)
+        self.add_span("subprocess_total", None if result.cached else result.duration)
+        self.update(ok=result.ok, returncode=result.returncode, cached=result.cached,
+                    attempts=result.attempts, timed_out=result.timed_out, pooled=result.pooled,
+                    response_bytes=result.output_bytes)
+        usage = result.usage
+        if usage:
+            cpu = {kind: usage.get(f"{kind}_cpu") for kind in ("user", "sys")}
+            self.update(child_user_cpu_ms=None if cpu["user"] is None else round(cpu["user"] * 1000, 3),
+                        child_sys_cpu_ms=None if cpu["sys"] is None else round(cpu["sys"] * 1000, 3),
+                        child_max_rss_kb=usage.get("max_rss_kb"),
+                        child_voluntary_switches=usage.get("voluntary_switches"),
+                        child_involuntary_switches=usage.get("involuntary_switches"),
+                        child_limit=usage.get("limit"))
+        if result.hedge:
+            saved = result.hedge["saved"]
+            self.update(hedge_winner=result.hedge["winner"], hedge_delay_ms=round(result.hedge["delay"] * 1000, 3),
+                        hedge_saved_ms=None if saved is None else round(saved * 1000, 3))
+
+    def to_record(self):
+        """生成一条 JSON 指标记录"""
+        record = {"ts": self.timestamp.isoformat(timespec="milliseconds")}
+        record.update(self.fields)
+        record["spans_ms"] = {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()}
+        record["total_ms"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return record
+
+
+class MetricsSink:
+    """把每次调用的指标写入 JSONL 文件，并可选导出 Prometheus textfile
+
+    Prometheus 导出的累计值保存在 <textfile>.state.json 中，每次写入后通过
+    临时文件 + 原子重命名更新 textfile，node_exporter 不会读到写了一半的文件。
+    """
+
+    DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, path, prometheus_path=None, rotator=None):
+        self.path = Path(path)
+        self.prometheus_path = Path(prometheus_path) if prometheus_path else None
+        self.rotator = rotator
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        """写入一条指标记录"""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.rotator:
+                self.rotator.maybe_rotate(self.path)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            if self.prometheus_path:
+                # 状态文件是读-改-写，多个进程同时写指标时需要加文件锁
+                with FileLock(str(self.prometheus_path) + ".lock"):
+                    self._export_prometheus(record)
+
+    def _export_prometheus(self, record):
+        state_path = Path(str(self.prometheus_path) + ".state.json")
+        state = {"calls": {}, "duration": {}, "phases": {}, "prompt_bytes": 0, "response_bytes": 0}
+        if state_path.exists():
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except ValueError:
+                pass
+
+        mode = record.get("mode", "ask")
+        status = "ok" if record.get("ok") else "error"
+        call_key = f"{mode},{status}"
+        state["calls"][call_key] = state["calls"].get(call_key, 0) + 1
+        seconds = record.get("total_ms", 0) / 1000
+        duration = state["duration"].setdefault(mode, {"buckets": [0] * len(self.DURATION_BUCKETS),
+                                                       "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.DURATION_BUCKETS):
+            if seconds <= bound:
+                duration["buckets"][i] += 1
+        duration["sum"] += seconds
+        duration["count"] += 1
+        for phase, ms in record.get("spans_ms", {}).items():
+            phase_state = state["phases"].setdefault(phase, {"sum": 0.0, "count": 0})
+            phase_state["sum"] += ms / 1000
+            phase_state["count"] += 1
+        state["prompt_bytes"] += record.get("prompt_bytes", 0)
+        state["response_bytes"] += record.get("response_bytes", 0)
+        # 旧的状态文件中没有子进程资源的累计值
+        child_cpu = state.setdefault("child_cpu", {"user": 0.0, "sys": 0.0})
+        for kind in child_cpu:
+            child_cpu[kind] += (record.get(f"child_{kind}_cpu_ms") or 0) / 1000
+        limit_kills = state.setdefault("limit_kills", {})
+        if record.get("child_limit"):
+            limit_kills[record["child_limit"]] = limit_kills.get(record["child_limit"], 0) + 1
+
+        lines = [
+            "# HELP callqw_calls_total Qwen bridge calls by mode and status.",
+            "# TYPE callqw_calls_total counter",
+        ]
+        for key, value in sorted(state["calls"].items()):
+            call_mode, call_status = key.split(",")
+            lines.append(f'callqw_calls_total{{mode="{call_mode}",status="{call_status}"}} {value}')
+        lines += ["# HELP callqw_call_duration_seconds End-to-end bridge call duration.",
+                  "# TYPE callqw_call_duration_seconds histogram"]
+        for call_mode, data in sorted(state["duration"].items()):
+            for bound, count in zip(self.DURATION_BUCKETS, data["buckets"]):
+                lines.append(f'callqw_call_duration_seconds_bucket{{mode="{call_mode}",le="{bound}"}} {count}')
+            lines.append(f'callqw_call_duration_seconds_bucket{{mode="{call_mode}",le="+Inf"}} {data["count"]}')
+            lines.append(f'callqw_call_duration_seconds_sum{{mode="{call_mode}"}} {data["sum"]:.6f}')
+            lines.append(f'callqw_call_duration_seconds_count{{mode="{call_mode}"}} {data["count"]}')
+        lines += ["# HELP callqw_phase_seconds Time spent per bridge phase.",
+                  "# TYPE callqw_phase_seconds summary"]
+        for phase, data in sorted(state["phases"].items()):
+            lines.append(f'callqw_phase_seconds_sum{{phase="{phase}"}} {data["sum"]:.6f}')
+            lines.append(f'callqw_phase_seconds_count{{phase="{phase}"}} {data["count"]}')
+        lines += ["# HELP callqw_prompt_bytes_total Prompt bytes sent to Qwen.",
+                  "# TYPE callqw_prompt_bytes_total counter",
+                  f"callqw_prompt_bytes_total {state['prompt_bytes']}",
+                  "# HELP callqw_response_bytes_total Response bytes received from Qwen.",
+                  "# TYPE callqw_response_bytes_total counter",
+                  f"callqw_response_bytes_total {state['response_bytes']}",
+                  "# HELP callqw_child_cpu_seconds_total CPU time used by Qwen child processes.",
+                  "# TYPE callqw_child_cpu_seconds_total counter"]
+        for kind, seconds in sorted(child_cpu.items()):
+            lines.append(f'callqw_child_cpu_seconds_total{{kind="{kind}"}} {seconds:.6f}')
+        lines += ["# HELP callqw_child_limit_kills_total Qwen child processes terminated by a resource limit.",
+                  "# TYPE callqw_child_limit_kills_total counter"]
+        for limit, value in sorted(limit_kills.items()):
+            lines.append(f'callqw_child_limit_kills_total{{limit="{limit}"}} {value}')
+
+        self.prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+        for path, content in ((state_path, json.dumps(state)), (self.prometheus_path, "\n".join(lines) + "\n")):
+            tmp_path = Path(f"{path}.{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+
+class BridgeProfiler:
+    """桥接器自身的性能分析：cProfile 以及可选的 tracemalloc 内存分析
+
+    停止时在 directory 中写入 <时间>-<pid>-<label>.pstats（可用 pstats、snakeviz 读取）和
+    .collapsed.txt（flamegraph.pl、speedscope 可读取的折叠栈，权重单位为微秒）；启用内存
+    分析时另写 .memory.txt，记录峰值内存，以及各检查点（checkpoint()，例如回应读完时）和结束时
+    占用最高的那一刻分配最多的位置。cProfile 只统计开启它的线程，工作线程需要调用
+    profile_thread() 单独开启，停止时合并。
+    """
+
+    MAX_DEPTH = 64
+    MIN_WEIGHT = 1e-6  # 折叠栈中不足 1 微秒的调用路径不再展开
+
+    def __init__(self, directory, label, cpu=True, memory=False, top=20):
+        self.directory = Path(directory)
+        self.label = label
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.profile = None
+        self.paths = []
+        self.peak = 0
+        self.sites = []  # [(文件:行号, 字节数, 分配次数)]
+        self._threads = []
+        self._tracing = False
+        self._snapshot = None
+        self._snapshot_size = -1
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+        if self.cpu:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def profile_thread(self):
+        """在工作线程中调用（例如作为线程池的 initializer），为该线程开启单独的 cProfile"""
+        if self.profile is None:
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 起 cProfile 基于 sys.monitoring，主线程的分析已覆盖所有线程
+            return
+        with self._lock:
+            self._threads.append(profile)
+
+    def checkpoint(self):
+        """在内存占用可能最高的时刻调用：当前占用超过之前的检查点时保存 tracemalloc 快照"""
+        if not self.memory:
+            return
+        import tracemalloc
+        with self._lock:
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self._snapshot_size:
+                self._snapshot, self._snapshot_size = tracemalloc.take_snapshot(), current
+
+    @staticmethod
+    def frame(func):
+        """折叠栈中的帧名称：函数名 (文件名:行号)，内置函数只有名称"""
+        filename, line, name = func
+        text = name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})"
+        return text.replace(";", ":")
+
+    @classmethod
+    def collapse(cls, stats):
+        """把 pstats 的调用图展开为折叠栈 {"帧;帧;帧": 秒数}
+
+        cProfile 只记录调用者和被调用者之间的边，每条路径的耗时按各条边的累计耗时比例分摊，
+        递归调用的环在第二次进入时截断。
+        """
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((func, edge[3]))
+        stacks = {}
+        pending = [((func,), (cls.frame(func),), entry[3]) for func, entry in stats.items() if not entry[4]]
+        while pending:
+            path, frames, share = pending.pop()
+            func = path[-1]
+            total = stats[func][3]
+            scale = share / total if total else 0.0
+            own = stats[func][2] * scale
+            if own > 0:
+                key = ";".join(frames)
+                stacks[key] = stacks.get(key, 0.0) + own
+            if len(path) >= cls.MAX_DEPTH:
+                continue
+            for callee, cumulative in callees.get(func, ()):
+                weight = cumulative * scale
+                if callee not in path and weight >= cls.MIN_WEIGHT:
+                    pending.append((path + (callee,), frames + (cls.frame(callee),), weight))
+        return stacks
+
+    def stop(self):
+        """停止分析并写入结果文件，返回写入的文件路径列表"""
+        if self.profile is not None:
+            self.profile.disable()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        base = self.directory / f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{self.label}"
+        paths = []
+        if self.memory:
+            # 先于 cProfile 结果的整理取快照，不把分析器自身的分配计入
+            import tracemalloc
+            self.checkpoint()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            snapshot = self._snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            ))
+            if self._tracing:
+                tracemalloc.stop()
+            self.sites = [(f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", stat.size, stat.count)
+                          for stat in snapshot.statistics("lineno")[:self.top]]
+            paths.append(Path(f"{base}.memory.txt"))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.write(f"peak {self.peak} bytes ({self.peak / 1048576:.2f} MiB)\n")
+                f.write(f"top {len(self.sites)} allocation sites at the highest checkpoint "
+                        f"({self._snapshot_size} bytes; size, count):\n")
+                for where, size, count in self.sites:
+                    f.write(f"{size:>12} {count:>8}  {where}\n")
+        if self.profile is not None:
+            import pstats
+            stats = pstats.Stats(self.profile)
+            with self._lock:
+                threads, self._threads = self._threads, []
+            for profile in threads:
+                stats.add(profile)
+            paths.append(Path(f"{base}.pstats"))
+            stats.dump_stats(str(paths[-1]))
+            stacks = self.collapse(stats.stats)
+            paths.append(Path(f"{base}.collapsed.txt"))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                for stack, seconds in sorted(stacks.items()):
+                    weight = int(round(seconds * 1e6))
+                    if weight:
+                        f.write(f"{stack} {weight}\n")
+        self.paths = paths
+        return paths
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class LatencyTracker:
+    """最近 ask 模式调用的首字节延迟分布，用于计算对冲请求的截止时间
+
+    首次使用时从指标文件末尾读取历史记录，之后由本进程的调用结果持续更新，
+    守护进程和批处理中无需重复读取文件。
+    """
+
+    HISTORY_BYTES = 262144
+
+    def __init__(self, metrics_path=None, size=500):
+        self.metrics_path = metrics_path
+        self.size = size
+        self.samples = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        import collections
+        samples = []
+        if self.metrics_path is not None and Path(self.metrics_path).exists():
+            with open(self.metrics_path, "rb") as f:
+                start = max(0, f.seek(0, os.SEEK_END) - self.HISTORY_BYTES)
+                f.seek(start)
+                lines = f.read().splitlines()
+            for line in lines[1 if start else 0:]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                ttfb = record.get("spans_ms", {}).get("ttfb")
+                if record.get("mode") == "ask" and record.get("ok") and not record.get("cached") and ttfb is not None:
+                    samples.append(ttfb / 1000)
+        self.samples = collections.deque(samples[-self.size:], maxlen=self.size)
+
+    def add(self, seconds):
+        with self._lock:
+            if self.samples is None:
+                self._load()
+            self.samples.append(seconds)
+
+    @staticmethod
+    def nearest_rank(values, p):
+        """已排序数值的第 p 百分位（最近秩法）；values 为空时返回 None"""
+        import math
+        if not values:
+            return None
+        return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+    def percentile(self, p, min_samples=1):
+        """第 p 百分位的首字节延迟（秒）；样本不足 min_samples 时返回 None"""
+        with self._lock:
+            if self.samples is None:
+                self._load()
+            values = sorted(self.samples)
+        if len(values) < max(1, min_samples):
+            return None
+        return self.nearest_rank(values, p)
+
+    def mean_above(self, seconds):
+        """首字节延迟超过 seconds 的调用的平均首字节延迟，用于估计对冲节省的时间"""
+        with self._lock:
+            values = [value for value in self.samples or () if value > seconds]
+        return sum(values) / len(values) if values else None
+
+
+class RequestScheduler:
+    """跨进程的请求调度器：按后端的令牌桶限速，交互式请求优先，同一优先级内先到先得
+
+    排队状态保存在 spool 目录中并由文件锁保护：每个等待中的请求在 <后端>/ 下有一个
+    票据文件，文件名按优先级和到达时间排序，等待期间定期更新修改时间作为心跳，
+    进程异常退出留下的票据会在 STALE_SECONDS 后被清理；<后端>.json 保存令牌桶和
+    配额退避状态。batch 请求需要在桶中保留 interactive_reserve 个令牌给交互式请求。
+    检测到配额错误时清空令牌并指数退避，所有进程的后续请求都会等待退避结束。
+    """
+
+    PRIORITIES = ("interactive", "batch")
+    STALE_SECONDS = 10.0
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, spool_dir, rate=1.0, burst=5, interactive_reserve=1, backoff_base=5.0,
+                 backoff_max=300.0, limits=None):
+        self.spool_dir = Path(spool_dir)
+        self.rate = rate
+        self.burst = burst
+        self.interactive_reserve = interactive_reserve
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limits = limits or {}
+
+    def _key(self, backend):
+        import hashlib
+        return f"{backend.name}-{hashlib.sha1(backend.identity().encode('utf-8')).hexdigest()[:12]}"
+
+    def _limits(self, backend):
+        """后端的 (每秒令牌数, 桶容量)；scheduler_limits 可按后端名称（cli、openai）单独设置"""
+        limits = self.limits.get(backend.name, {})
+        return max(1e-6, limits.get("rate", self.rate)), max(1, limits.get("burst", self.burst))
+
+    def _load_state(self, path, burst, now):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"tokens": burst, "updated": now, "backoff_until": 0.0, "backoff_level": 0}
+
+    @staticmethod
+    def _save_state(path, state):
+        tmp = Path(str(path) + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    def _try_take(self, key, ticket, rank, rate, burst):
+        """在文件锁内尝试为 ticket 取得一个令牌；成功返回 None，否则更新票据心跳并返回建议的等待秒数
+
+        会阻塞在文件锁和文件读写上，由 acquire 放到线程池中执行，不占用事件循环。
+        """
+        queue_dir = self.spool_dir / key
+        state_path = self.spool_dir / f"{key}.json"
+        with FileLock(self.spool_dir / f"{key}.lock"):
+            now = time.time()
+            ahead = 0
+            for other in os.scandir(str(queue_dir)):
+                if other.name >= ticket.name:
+                    continue
+                try:
+                    if other.stat().st_mtime < now - self.STALE_SECONDS:
+                        os.unlink(other.path)
+                        continue
+                except OSError:
+                    continue
+                ahead += 1
+            state = self._load_state(state_path, burst, now)
+            state["tokens"] = min(burst, state["tokens"] + max(0.0, now - state["updated"]) * rate)
+            state["updated"] = now
+            self._save_state(state_path, state)
+            delay = None
+            if now < state["backoff_until"]:
+                delay = state["backoff_until"] - now
+            elif ahead:
+                # 前面的请求取得令牌后很快离开队列，有令牌时缩短轮询间隔
+                delay = 0.02 if state["tokens"] >= 1 else self.POLL_INTERVAL
+            else:
+                need = min(burst, 1 + (self.interactive_reserve if rank else 0))
+                if state["tokens"] < need:
+                    delay = (need - state["tokens"]) / rate
+            if delay is not None:
+                ticket.touch()
+                return delay
+            state["tokens"] -= 1
+            self._save_state(state_path, state)
+            ticket.unlink()
+            return None
+
+    async def acquire(self, backend, priority="interactive", timeout=None):
+        """等待轮到本请求并取得一个令牌，返回排队等待的秒数
+
+        timeout 秒内没有取得令牌时抛出 asyncio.TimeoutError（None 表示不限时）。
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        rank = self.PRIORITIES.index(priority) if priority in self.PRIORITIES else 0
+        key = self._key(backend)
+        rate, burst = self._limits(backend)
+        queue_dir = self.spool_dir / key
+        queue_dir.mkdir(parents=True, exist_ok=True)
+        ticket = queue_dir / f"{rank}-{time.time():017.6f}-{os.getpid()}-{threading.get_ident()}"
+        ticket.touch()
+        started = time.monotonic()
+        try:
+            while True:
+                delay = await loop.run_in_executor(None, self._try_take, key, ticket, rank, rate, burst)
+                waited = time.monotonic() - started
+                if delay is None:
+                    return waited
+                if timeout is not None and waited >= timeout:
+                    raise asyncio.TimeoutError()
+                delay = min(delay, self.POLL_INTERVAL)
+                await asyncio.sleep(delay if timeout is None else min(delay, timeout - waited))
+        finally:
+            try:
+                ticket.unlink()
+            except FileNotFoundError:
+                pass
+
+    def report(self, backend, quota_error):
+        """记录一次调用的结果：配额错误时清空令牌并延长退避，返回退避秒数；成功时重置退避级别"""
+        key = self._key(backend)
+        _, burst = self._limits(backend)
+        state_path = self.spool_dir / f"{key}.json"
+        with FileLock(self.spool_dir / f"{key}.lock"):
+            now = time.time()
+            state = self._load_state(state_path, burst, now)
+            if not quota_error:
+                if state["backoff_level"]:
+                    state["backoff_level"] = 0
+                    self._save_state(state_path, state)
+                return 0.0
+            state["backoff_level"] += 1
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** (state["backoff_level"] - 1))
+            state["backoff_until"] = max(state["backoff_until"], now + backoff)
+            state["tokens"] = 0.0
+            state["updated"] = now
+            self._save_state(state_path, state)
+            return backoff
+
+
+class ContextShard:
+    """一个会话独占的上下文记忆和对话日志
+
+    默认会话使用配置中的 context_memory_file 和 logs_dir；通过 --session 指定的
+    会话各自保存在 <sessions_dir>/<会话 ID>/ 下，不同会话的并发调用互不争用。
+    """
+
+    SESSION_PATTERN = r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}"
+
+    def __init__(self, session, context_store, context_assembler, conversation_log, compactor=None, journal=None):
+        self.session = session
+        self.context_store = context_store
+        self.context_assembler = context_assembler
+        self.conversation_log = conversation_log  # 文本对话日志（由结构化日志渲染）
+        self.compactor = compactor
+        self.journal = journal                    # 结构化对话日志（JSONL）
+
+    @classmethod
+    def validate(cls, session):
+        """检查会话 ID（字母、数字、_ . -，最长 64 个字符），不合法时抛出 ValueError"""
+        if not re.fullmatch(cls.SESSION_PATTERN, session):
+            raise ValueError(f"会话 ID 只能包含字母、数字、_ . -（最长 64 个字符）: {session}")
+        return session
+
+    def entry_metadata(self, mode):
+        """写入上下文记录时额外传给存储的关键字参数：只有 SQLite 存储保存模式和会话，Markdown 格式不记录"""
+        if isinstance(self.context_store, SQLiteContextStore):
+            return {"mode": mode, "session": self.session}
+        return {}
+
+
+class OutputLimitExceeded(Exception):
+    """输出超过 output_max_bytes 上限"""
+
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.limit = limit
+
+
+class OutputBuffer:
+    """有界内存的输出缓冲
+
+    不超过 memory_bytes 的输出保存在内存中，超出后转存到 spool_dir 下的匿名临时文件
+    （SpooledTemporaryFile，关闭或进程退出后自动删除）。日志和上下文通过 chunks()
+    逐块读取，不需要把完整输出拼接成一个字符串。max_bytes 为输出大小的硬上限，
+    超出时 write() 抛出 OutputLimitExceeded，由调用方终止子进程。
+    """
+
+    def __init__(self, memory_bytes=1048576, max_bytes=0, spool_dir=None):
+        import tempfile
+        self.memory_bytes = memory_bytes
+        self.max_bytes = max_bytes
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_bytes, dir=spool_dir, prefix="callqw-output-")
+        self.size = 0
+        self.last = ""
+
+    @property
+    def spilled(self):
+        """输出是否已转存到磁盘"""
+        return self.size > self.memory_bytes
+
+    def write(self, text):
+        """追加一段输出文本"""
+        data = text.encode("utf-8")
+        if self.max_bytes and self.size + len(data) > self.max_bytes:
+            raise OutputLimitExceeded(self.max_bytes)
+        self.file.write(data)
+        self.size += len(data)
+        if text:
+            self.last = text
+
+    def chunks(self, size=65536):
+        """从头逐块产出已写入的文本"""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.file.seek(0)
+        try:
+            while True:
+                data = self.file.read(size)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield text
+                if not data:
+                    return
+        finally:
+            self.file.seek(0, os.SEEK_END)
+
+    def getvalue(self):
+        return "".join(self.chunks())
+
+    def close(self):
+        self.file.close()
+
+
+class QwenResult:
+    """一次 Qwen 调用的结果
+
+    output 为 OutputBuffer 时，完整文本只在首次访问 output 属性时读入内存；
+    显示和写日志应使用 chunks() 逐块读取。
+    """
+
+    def __init__(self, output, ok=True, returncode=0, stderr="", duration=0.0, first_output=None,
+                 cached=False, timed_out=False, attempts=1, spawn=None, pooled=False, usage=None):
+        # 成功时为 Qwen 的输出，失败时为错误提示
+        self.buffer = output if isinstance(output, OutputBuffer) else None
+        self._output = None if self.buffer is not None else output
+        self.cached = cached              # 是否来自响应缓存
+        self.timed_out = timed_out        # 是否因超时被终止
+        self.attempts = attempts          # 实际调用次数（含重试）
+        self.spawn = spawn                # 启动子进程耗时（秒），使用预热进程池时为交接耗时
+        self.pooled = pooled              # 是否使用了预热进程池
+        self.hedge = None                 # 对冲请求的统计信息（发起了对冲时为字典）
+        self.queued = None                # 在请求调度器中排队的时间（秒），未启用调度器时为 None
+        self.usage = usage                # 子进程资源使用（ChildLimits.usage 的字典），无法取得时为 None
+        self.ok = ok
+        self.returncode = returncode
+        self.stderr = stderr
+        self.duration = duration          # 子进程总耗时（秒）
+        self.first_output = first_output  # 首次输出耗时（秒），无输出时为 None
+
+    @property
+    def output(self):
+        if self._output is None:
+            self._output = self.buffer.getvalue()
+        return self._output
+
+    @property
+    def limit(self):
+        """导致子进程被终止的资源限制（"cpu"、"memory"、"wall"），没有时为 None"""
+        return (self.usage or {}).get("limit")
+
+    @property
+    def output_bytes(self):
+        if self._output is None:
+            return self.buffer.size
+        return len(self._output.encode("utf-8"))
+
+    @property
+    def spilled(self):
+        """输出是否已转存到磁盘"""
+        return self.buffer is not None and self.buffer.spilled
+
+    def chunks(self):
+        """逐块产出输出文本"""
+        if self._output is None:
+            for text in self.buffer.chunks():
+                yield text
+        elif self._output:
+            yield self._output
+
+    def endswith(self, suffix):
+        if self._output is None:
+            return self.buffer.last.endswith(suffix)
+        return self._output.endswith(suffix)
+
+    def close(self):
+        """释放输出缓冲（包括磁盘上的临时文件）"""
+        if self.buffer is not None:
+            self.buffer.close()
+
+
+class ChildLimits:
+    """Qwen 子进程的资源限制和资源使用统计（仅 POSIX）
+
+    CPU 时间（RLIMIT_CPU）和地址空间（RLIMIT_AS）由一层 sh 的 ulimit 在 exec 之前设置，
+    Qwen CLI 启动的子孙进程同样继承（限制按进程各自计算）；墙钟时间由父进程计时，
+    到时终止整个进程组。资源使用在回收子进程时通过 os.wait4 取得，包含它已回收的子孙进程。
+    """
+
+    CPU_GRACE = 5  # 软限制处收到 SIGXCPU，忽略该信号的进程在此秒数后被 SIGKILL
+    MEMORY_PATTERN = r"(?i)out of memory|cannot allocate|bad_alloc|ENOMEM|MemoryError|allocation failed"
+
+    def __init__(self, cpu_seconds=0, memory_mb=0, wall_seconds=0):
+        self.cpu_seconds = cpu_seconds or 0
+        self.memory_mb = memory_mb or 0
+        self.wall_seconds = wall_seconds or 0
+
+    def ulimit_commands(self):
+        """设置 rlimit 的 sh ulimit 命令列表（数值已按当前硬限制截断）；不需要设置或不是 POSIX 时为空"""
+        if os.name == 'nt' or not (self.cpu_seconds or self.memory_mb):
+            return []
+        import resource
+        limits = []
+        if self.cpu_seconds:
+            soft = int(-(-self.cpu_seconds // 1))
+            limits.append((resource.RLIMIT_CPU, "t", 1, soft, soft + self.CPU_GRACE))
+        if self.memory_mb:
+            size = int(self.memory_mb * 1024)
+            limits.append((resource.RLIMIT_AS, "v", 1024, size, size))
+        commands = []
+        for which, option, unit, soft, hard in limits:
+            current = resource.getrlimit(which)[1]
+            if current != resource.RLIM_INFINITY:
+                # 非特权进程不能提高硬限制
+                soft, hard = min(soft, current // unit), min(hard, current // unit)
+            # 先降低软限制，否则新的硬限制可能低于当前软限制而设置失败
+            commands += [f"ulimit -S -{option} {soft}", f"ulimit -H -{option} {hard}"]
+        return commands
+
+    def wrap(self, cmd):
+        """用一层 sh 在 exec 之前设置 rlimit（ulimit 失败时不执行命令），不需要时原样返回命令行
+
+        sh 以 exec 执行命令，子进程的 pid 不变。不使用 subprocess 的 preexec_fn：
+        桥接器运行时通常有多个线程，preexec_fn 在 fork 出的子进程中可能死锁。
+        """
+        commands = self.ulimit_commands()
+        if not commands:
+            return list(cmd)
+        return ["/bin/sh", "-c", " && ".join(commands + ['exec "$@"']), "callqw-limits"] + list(cmd)
+
+    @staticmethod
+    def usage(rusage):
+        """把 rusage 转换为记录用的字典（max_rss_kb 在 macOS 上由字节换算）"""
+        max_rss = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+        return {"user_cpu": round(rusage.ru_utime, 6), "sys_cpu": round(rusage.ru_stime, 6),
+                "max_rss_kb": max_rss, "voluntary_switches": rusage.ru_nvcsw,
+                "involuntary_switches": rusage.ru_nivcsw}
+
+    @classmethod
+    def reap(cls, process):
+        """阻塞等待 subprocess.Popen 子进程退出并回收，返回 (退出码, 资源使用)
+
+        POSIX 上用 os.wait4 回收并把退出码写回 process.returncode（被信号终止时为负的信号值），
+        其他平台没有资源使用。
+        """
+        if not hasattr(os, "wait4"):
+            return process.wait(), None
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # 已在别处回收
+            return process.wait(), None
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return process.returncode, cls.usage(rusage)
+
+    @staticmethod
+    def parse_times(text):
+        """解析 sh 内建命令 times 的输出（第二行是已回收子进程的用户/系统 CPU 时间），无法解析时返回 None"""
+        lines = text.strip().splitlines()
+        values = re.findall(r"(\d+)m(\d+(?:[.,]\d+)?)s", lines[-1]) if len(lines) >= 2 else []
+        if len(values) != 2:
+            return None
+        user, system = (int(minutes) * 60 + float(seconds.replace(",", ".")) for minutes, seconds in values)
+        return {"user_cpu": round(user, 6), "sys_cpu": round(system, 6)}
+
+    def classify(self, returncode, usage, stderr, wall_killed=False):
+        """判断子进程是否因资源限制被终止，返回 "cpu"、"memory"、"wall" 或 None
+
+        退出码为负的信号值，或经过 sh 包装时为 128 加信号值。
+        """
+        if wall_killed:
+            return "wall"
+        if returncode in (None, 0):
+            return None
+        import signal
+        signum = -returncode if returncode < 0 else returncode - 128 if returncode > 128 else None
+        if self.cpu_seconds:
+            cpu = (usage.get("user_cpu", 0) + usage.get("sys_cpu", 0)) if usage else 0
+            if signum == getattr(signal, "SIGXCPU", None) or (signum == signal.SIGKILL and cpu >= self.cpu_seconds):
+                return "cpu"
+        if self.memory_mb and re.search(self.MEMORY_PATTERN, stderr or ""):
+            return "memory"
+        return None
+
+    def value(self, limit):
+        """资源限制的配置值，用于错误提示"""
+        return {"cpu": self.cpu_seconds, "memory": self.memory_mb, "wall": self.wall_seconds}[limit]
+
+
+class SubprocessBackend:
+    """通过 Qwen Code CLI 子进程调用 Qwen（默认后端，agent 模式始终使用）"""
+
+    name = "cli"
+
+    def __init__(self, bridge, cli_path=None):
+        self.bridge = bridge
+        self.cli_path = cli_path  # None 表示使用配置 qwen_cli_path
+
+    def identity(self):
+        """参与响应缓存键计算的后端标识"""
+        return self.cli_path or self.bridge.get_cli_path()
+
+    def describe(self, message, mode="ask", dev_mode=False):
+        """用于日志的调用描述，提示词只记录其大小"""
+        if self.bridge.worker_pool is not None:
+            cmd = self.bridge.build_command(None, mode, dev_mode, self.cli_path)
+            return ' '.join(cmd + [f"<stdin {len(message)} chars>"])
+        cmd = self.bridge.build_command(message, mode, dev_mode, self.cli_path)
+        return ' '.join(cmd[:-1] + [f"<{len(message)} chars>"])
+
+    def _popen(self, cmd):
+        """启动 Qwen 子进程（独立进程组，便于超时时整组终止），资源限制在 exec 之前设置"""
+        import subprocess
+        # 获取当前环境变量
+        env = os.environ.copy()
+        options = dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=str(self.bridge.work_dir), env=env)
+        if os.name != 'nt':
+            options["start_new_session"] = True
+            limited = self.bridge.child_limits.wrap(cmd)
+            if limited != list(cmd):
+                import shutil
+                # 经过 sh 包装后找不到命令只会表现为退出码 127，先检查以给出同样的提示
+                if shutil.which(cmd[0]) is None:
+                    raise FileNotFoundError(cmd[0])
+                cmd = limited
+        
+        # 首先尝试不使用shell执行命令（更安全）
+        try:
+            return subprocess.Popen(cmd, **options)
+        except FileNotFoundError:
+            # 如果找不到命令，在Windows上尝试使用shell
+            if os.name == 'nt':
+                return subprocess.Popen(subprocess.list2cmdline(cmd), shell=True, **options)
+            raise
+
+    @staticmethod
+    def _signal_tree(pid, force=False):
+        """向子进程所在的进程组发送 SIGTERM（force 时为 SIGKILL），Windows 上用 taskkill 终止进程树"""
+        try:
+            if os.name == 'nt':
+                import subprocess
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                import signal
+                os.killpg(pid, signal.SIGKILL if force else signal.SIGTERM)
+        except OSError:
+            pass
+
+    async def _kill_tree(self, process, exited, grace=2.0):
+        """终止子进程及其所有子孙进程，并等待回收线程确认退出"""
+        import asyncio
+        self._signal_tree(process.pid)
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), grace)
+        except asyncio.TimeoutError:
+            self._signal_tree(process.pid, force=True)
+            await exited
+
+    @staticmethod
+    def _watch(process):
+        """在专用线程中等待子进程退出并用 ChildLimits.reap 回收，返回得到 (退出码, 资源使用) 的 Future"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+
+        def deliver(result):
+            if not exited.done():
+                exited.set_result(result)
+
+        def wait():
+            try:
+                result = ChildLimits.reap(process)
+            except OSError:
+                result = (process.poll(), None)
+            try:
+                loop.call_soon_threadsafe(deliver, result)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+        threading.Thread(target=wait, name="callqw-reaper", daemon=True).start()
+        return exited
+
+    def _wall_guard(self, pid, killed):
+        """墙钟时间限制：到时以 SIGKILL 终止进程组并在 killed 中记下，未配置时返回 None"""
+        import asyncio
+        wall = self.bridge.child_limits.wall_seconds
+        if not wall:
+            return None
+
+        async def guard():
+            await asyncio.sleep(wall)
+            killed.append(True)
+            self._signal_tree(pid, force=True)
+        return asyncio.ensure_future(guard())
+
+    @staticmethod
+    async def _communicate(process, started, on_output, output):
+        """读取子进程的 stdout 和 stderr，返回 (首次输出耗时, stderr)
+
+        stdout 按数据到达的顺序逐块读取，每块解码后写入 output 并立即交给 on_output 回调。
+        两个管道各由一个专用线程读取（读完后关闭），不占用默认线程池，也不会因为一个管道
+        写满而互相阻塞。
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        errors = []
+
+        def put(data):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, data)
+            except RuntimeError:
+                # 事件循环已关闭（调用被取消）
+                pass
+
+        def read_stdout():
+            try:
+                while True:
+                    data = process.stdout.read1(65536)
+                    put(data)
+                    if not data:
+                        break
+            except (OSError, ValueError):
+                put(b"")
+            finally:
+                process.stdout.close()
+
+        def read_stderr():
+            try:
+                errors.append(process.stderr.read())
+            except (OSError, ValueError):
+                pass
+            finally:
+                process.stderr.close()
+
+        stderr_thread = threading.Thread(target=read_stderr, name="callqw-stderr", daemon=True)
+        stderr_thread.start()
+        threading.Thread(target=read_stdout, name="callqw-stdout", daemon=True).start()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        first_output = None
+        while True:
+            data = await queue.get()
+            text = decoder.decode(data, final=not data).replace('\r\n', '\n')
+            if text:
+                if first_output is None:
+                    first_output = time.monotonic() - started
+                output.write(text)
+                if on_output:
+                    on_output(text)
+            if not data:
+                break
+        await loop.run_in_executor(None, stderr_thread.join)
+        return first_output, b"".join(errors).decode('utf-8', errors='replace')
+
+    def _classify(self, returncode, usage, stderr, killed):
+        """在资源使用中记下导致子进程被终止的资源限制（limit 字段）"""
+        limit = self.bridge.child_limits.classify(returncode, usage, stderr, bool(killed))
+        return dict(usage or {}, limit=limit) if limit else usage
+
+    async def run(self, message, mode="ask", dev_mode=False, on_output=None, output=None):
+        """执行一次子进程调用，返回 (退出码, stdout 缓冲, stderr, 首次输出耗时, 启动耗时, 资源使用)
+
+        子进程退出后由专用线程通过 os.wait4 回收，资源使用为 ChildLimits.usage 的字典
+        （超过资源限制被终止时带有 limit 字段），无法取得时为 None。被取消（超时、Ctrl-C）
+        或输出超过上限时终止整个进程树。
+        """
+        output = OutputBuffer() if output is None else output
+        if self.bridge.worker_pool is not None:
+            return await self._run_pooled(message, mode, dev_mode, on_output, output)
+        cmd = self.bridge.build_command(message, mode, dev_mode, self.cli_path)
+        started = time.monotonic()
+        process = self._popen(cmd)
+        spawn = time.monotonic() - started
+        exited = self._watch(process)
+        killed = []
+        guard = self._wall_guard(process.pid, killed)
+        self.bridge.child_groups.add(process.pid)
+        try:
+            first_output, stderr = await self._communicate(process, started, on_output, output)
+            returncode, usage = await exited
+            return returncode, output, stderr, first_output, spawn, self._classify(returncode, usage, stderr, killed)
+        finally:
+            if guard is not None:
+                guard.cancel()
+            if not exited.done():
+                await self._kill_tree(process, exited)
+            self.bridge.child_groups.discard(process.pid)
+
+    async def _run_pooled(self, message, mode, dev_mode, on_output, output):
+        """使用预热进程池中的进程执行调用，返回值与 run 相同；启动耗时即交接耗时"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        worker = self.bridge.worker_pool.checkout(self.bridge.build_command(None, mode, dev_mode, self.cli_path))
+        spawn = time.monotonic() - started
+        finished = False
+        killed = []
+        guard = self._wall_guard(worker.process.pid, killed)
+        self.bridge.child_groups.add(worker.process.pid)
+        try:
+            send_future = loop.run_in_executor(None, worker.send, message)
+            first_output, stderr = await self._communicate(worker.process, started, on_output, output)
+            try:
+                await send_future
+            except BrokenPipeError:
+                # 进程在读完提示词之前退出，错误信息在 stderr 和退出码中
+                pass
+            returncode, stderr, usage = await loop.run_in_executor(None, worker.finish, stderr)
+            finished = True
+            return returncode, output, stderr, first_output, spawn, self._classify(returncode, usage, stderr, killed)
+        finally:
+            if guard is not None:
+                guard.cancel()
+            if not finished:
+                worker.kill()
+            else:
+                worker.close()
+            self.bridge.child_groups.discard(worker.process.pid)
+
+
+class WarmWorker:
+    """预先启动、等待从 stdin 读取提示词的 Qwen CLI 进程
+
+    Qwen CLI 的非交互模式每个进程只处理一条提示词，因此预热进程是一次性的：
+    交接时写入提示词并关闭 stdin，读完输出后进程退出。POSIX 上通过一层 sh 在 stderr
+    末尾追加退出码和 times 输出，即使进程已交给 fork 出的守护进程子进程（不是它的父进程）
+    也能取得退出码和 CPU 时间。
+    """
+
+    STATUS_MARKER = "__callqw_exit_status__"
+
+    def __init__(self, cmd, cwd, limits=()):
+        import subprocess
+        self.key = tuple(cmd)
+        self.started = time.monotonic()
+        self.owner = os.getpid()
+        options = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       cwd=str(cwd), env=os.environ.copy())
+        self.wrapped = os.name != 'nt'
+        if self.wrapped:
+            # limits 为 ChildLimits.ulimit_commands()，在 sh 中先于 Qwen CLI 执行
+            run = " && ".join(list(limits) + ['"$@"'])
+            wrapper = ["/bin/sh", "-c", f'{run}; printf "\\n%s %d\\n" {self.STATUS_MARKER} "$?" >&2; times >&2',
+                       "callqw-worker"]
+            self.process = subprocess.Popen(wrapper + list(cmd), start_new_session=True, **options)
+        else:
+            self.process = subprocess.Popen(cmd, **options)
+
+    @property
+    def age(self):
+        return time.monotonic() - self.started
+
+    def alive(self):
+        """健康检查：进程仍在等待输入；交给子进程的 worker 已由守护进程检查过"""
+        if os.getpid() != self.owner:
+            return True
+        return self.process.poll() is None
+
+    def send(self, prompt):
+        """写入提示词并关闭 stdin"""
+        try:
+            self.process.stdin.write(prompt.encode("utf-8"))
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def finish(self, stderr):
+        """stdout 和 stderr 读完后调用，返回 (退出码, 去掉退出码标记的 stderr, 资源使用)
+
+        本进程是 worker 的父进程时通过 os.wait4 回收 sh 取得资源使用（包含 sh 回收的 Qwen CLI），
+        交给守护进程子进程的 worker 只能从 sh 的 times 输出取得 CPU 时间。
+        """
+        usage = None
+        if os.getpid() == self.owner:
+            try:
+                # 回收进程，避免僵尸进程
+                usage = ChildLimits.reap(self.process)[1]
+            except Exception:
+                pass
+        if not self.wrapped:
+            return self.process.returncode, stderr, usage
+        head, marker, tail = stderr.rpartition(self.STATUS_MARKER)
+        if not marker:
+            # 进程被信号终止，sh 没有机会写入退出码
+            return self.process.returncode or -1, stderr, usage
+        status, _, times = tail.strip().partition("\n")
+        if usage is None:
+            usage = ChildLimits.parse_times(times)
+        status = status.strip()
+        return (int(status) if status.isdigit() else -1), head[:-1] if head.endswith("\n") else head, usage
+
+    def kill(self):
+        """终止进程组（sh 和 Qwen CLI）"""
+        try:
+            if os.name == 'nt':
+                import subprocess
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(self.process.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                import signal
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.close()
+        if os.getpid() == self.owner:
+            try:
+                self.process.wait(timeout=5)
+            except Exception:
+                pass
+
+    def close(self):
+        """关闭本进程持有的管道，不终止进程（交给其他进程后调用）"""
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+
+
+class WorkerPool:
+    """Qwen CLI 预热进程池
+
+    每种命令行（模式、调试参数）各保持 size 个已启动的进程。取用时交出一个健康的进程，
+    并立即补充新进程（Popen 本身很快，CLI 的启动开销在后台与当前请求并行完成）；
+    超过 max_age 的空闲进程被回收重启。
+    """
+
+    def __init__(self, cwd, size=2, max_age=300, limits=()):
+        self.cwd = cwd
+        self.limits = limits  # 在预热进程的 sh 中设置资源限制的 ulimit 命令
+        self.size = size
+        self.max_age = max_age
+        self.refill = True
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.stats = {"handoffs": 0, "waits": 0, "spawned": 0, "recycled": 0, "last_handoff_ms": 0.0}
+
+    def _spawn(self, cmd):
+        self.stats["spawned"] += 1
+        return WarmWorker(cmd, self.cwd, self.limits)
+
+    def _prune(self, idle):
+        """回收已退出或超龄的空闲进程"""
+        healthy = []
+        for worker in idle:
+            if worker.alive() and (not self.max_age or worker.age < self.max_age):
+                healthy.append(worker)
+            else:
+                worker.kill()
+                self.stats["recycled"] += 1
+        idle[:] = healthy
+
+    def prime(self, cmd):
+        """把 cmd 对应的空闲进程补足到 size 个"""
+        with self._lock:
+            if not self.refill:
+                return
+            idle = self._idle.setdefault(tuple(cmd), [])
+            self._prune(idle)
+            while len(idle) < self.size:
+                idle.append(self._spawn(cmd))
+
+    def checkout(self, cmd):
+        """取出一个就绪的进程；没有空闲进程时当场启动一个（计为一次等待）"""
+        started = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(tuple(cmd), [])
+            self._prune(idle)
+            # 守护进程的子进程中，交接次数和等待次数已由 take() 在守护进程中统计
+            if self.refill:
+                self.stats["handoffs"] += 1
+            if idle:
+                worker = idle.pop(0)
+            else:
+                if self.refill:
+                    self.stats["waits"] += 1
+                worker = self._spawn(cmd)
+            self.stats["last_handoff_ms"] = (time.monotonic() - started) * 1000
+        self.prime(cmd)
+        return worker
+
+    def take(self, cmd):
+        """不补充地取出一个空闲进程（守护进程 fork 前调用），没有时返回 None"""
+        with self._lock:
+            idle = self._idle.get(tuple(cmd), [])
+            self._prune(idle)
+            self.stats["handoffs"] += 1
+            if not idle:
+                self.stats["waits"] += 1
+                return None
+            return idle.pop(0)
+
+    def adopt(self, worker):
+        """在 fork 出的子进程中调用：只保留交给本进程的 worker，关闭其余进程的管道副本且不再补充"""
+        with self._lock:
+            for idle in self._idle.values():
+                for other in idle:
+                    other.close()
+            self._idle = {worker.key: [worker]} if worker else {}
+            self.refill = False
+
+    def shutdown(self):
+        """终止所有空闲进程"""
+        with self._lock:
+            for idle in self._idle.values():
+                for worker in idle:
+                    worker.kill()
+            self._idle = {}
+            self.refill = False
+
+
+class HTTPConnectionPool:
+    """http.client 长连接池：空闲连接复用，超出 size 的连接用完即关闭"""
+
+    def __init__(self, base_url, size=4, timeout=None):
+        from urllib.parse import urlsplit
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"openai_base_url 必须以 http:// 或 https:// 开头: {base_url}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        import http.client
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """发送请求，返回 (连接, 响应)；复用的空闲连接已被服务端关闭时自动换新连接重试一次"""
+        import http.client
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            conn = conn or self._new_connection()
+            try:
+                conn.request(method, self.base_path + path, body=body, headers=headers or {})
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+    def release(self, conn, reusable=True):
+        """归还连接；响应未读完或出错的连接直接关闭"""
+        with self._lock:
+            if reusable and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def abort(conn):
+        """中断正在读取的连接（从其他线程调用），使阻塞的读操作立即返回"""
+        import socket
+        sock = getattr(conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class OpenAIBackend:
+    """调用 OpenAI 兼容的 Chat Completions 接口（如本地 vLLM、llama.cpp server）
+
+    请求通过长连接池发送，流式响应按 SSE 逐块解析并回调 on_output；
+    阻塞的 HTTP 读写在线程池中执行，不阻塞事件循环。只用于 ask 模式。
+    """
+
+    name = "openai"
+
+    def __init__(self, base_url, model, api_key="", pool_size=4, stream=True, extra_body=None):
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.stream = stream
+        self.extra_body = extra_body or {}
+        self.pool = HTTPConnectionPool(base_url, size=pool_size)
+
+    def identity(self):
+        return f"{self.base_url}#{self.model}"
+
+    def describe(self, message, mode="ask", dev_mode=False):
+        return f"POST {self.base_url}/chat/completions model={self.model} <{len(message)} chars>"
+
+    def _request_body(self, message):
+        body = dict(self.extra_body)
+        body.update(model=self.model, messages=[{"role": "user", "content": message}], stream=self.stream)
+        return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+    def _exchange(self, message, emit, state):
+        """在工作线程中完成一次请求，通过 emit(类型, 值) 把状态码和文本块交给事件循环"""
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream" if self.stream else "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        conn, response = self.pool.request("POST", "/chat/completions", self._request_body(message), headers)
+        state["conn"] = conn
+        reusable = False
+        try:
+            emit("status", response.status)
+            if response.status != 200:
+                emit("error", response.read().decode("utf-8", errors="replace"))
+                reusable = not response.will_close
+                return
+            if not self.stream:
+                data = json.loads(response.read().decode("utf-8"))
+                emit("text", data["choices"][0]["message"].get("content") or "")
+                reusable = not response.will_close
+                return
+            for raw in response:
+                line = raw.decode("utf-8", errors="replace").strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get("choices") or [{}]
+                text = (choices[0].get("delta") or {}).get("content")
+                if text:
+                    emit("text", text)
+            # 读完剩余的数据后连接才能复用
+            response.read()
+            reusable = not response.will_close
+        finally:
+            state.pop("conn", None)
+            self.pool.release(conn, reusable)
+
+    async def run(self, message, mode="ask", dev_mode=False, on_output=None, output=None):
+        """执行一次 HTTP 调用，返回值与 SubprocessBackend.run 相同（没有资源使用）；HTTP 错误状态码作为退出码"""
+        import asyncio
+        output = OutputBuffer() if output is None else output
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        state = {}
+
+        def emit(kind, value):
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+
+        def worker():
+            try:
+                self._exchange(message, emit, state)
+            except BaseException as e:
+                emit("exception", e)
+            finally:
+                emit("end", None)
+
+        started = time.monotonic()
+        future = loop.run_in_executor(None, worker)
+        status, spawn, first_output = None, None, None
+        errors = []
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "end":
+                    break
+                if kind == "exception":
+                    raise value
+                if kind == "status":
+                    status = value
+                    spawn = time.monotonic() - started
+                elif kind == "error":
+                    errors.append(value)
+                elif kind == "text":
+                    if first_output is None:
+                        first_output = time.monotonic() - started
+                    output.write(value)
+                    if on_output:
+                        on_output(value)
+            await future
+        finally:
+            if not future.done():
+                # 超时或被取消：中断连接，让工作线程尽快结束
+                conn = state.get("conn")
+                if conn is not None:
+                    self.pool.abort(conn)
+        returncode = 0 if status == 200 else status
+        return returncode, output, "".join(errors), first_output, spawn, None
+
+
+class QwenBridge:
+    def __init__(self, config_path=None):
+        self.version = "1.0.0"
+        self.work_dir = Path.cwd()
+
+        # 只在当前工作目录查找和生成配置文件
+        if config_path is None:
+            config_path = self.work_dir / "callqw-config.json"
+            if not config_path.exists():
+                print(f"未检测到项目配置，自动创建: {config_path}")
+        else:
+            config_path = Path(config_path)
+
+        # 加载配置（如无则自动创建）
+        config_started = time.perf_counter()
+        self.config_manager = ConfigManager(str(config_path))
+        self.config = self.config_manager.config
+        # 配置加载耗时只计入该实例的第一次调用（守护进程中后续调用不再加载）
+        self._pending_config_load = time.perf_counter() - config_started
+
+        # 使用配置中的路径，如果是相对路径则基于配置文件所在目录
+        config_dir = Path(config_path).parent
+        self.config_dir = config_dir
+        logs_dir_config = self.config.get("logs_dir", str(config_dir / "callqw-logs"))
+        context_file_config = self.config.get("context_memory_file", str(config_dir / "callqw-context-memory.md"))
+
+        # 处理路径：如果是相对路径，则基于配置文件所在目录
+        if not Path(logs_dir_config).is_absolute():
+            self.logs_dir = config_dir / logs_dir_config
+        else:
+            self.logs_dir = Path(logs_dir_config)
+
+        if not Path(context_file_config).is_absolute():
+            self.context_file = config_dir / context_file_config
+        else:
+            self.context_file = Path(context_file_config)
+        # 对话日志由会话分片写入，轮转器需要在创建分片之前准备好
+        # 旧配置文件中没有这些键，回退到默认值而不是 0（不限制）
+        defaults = ConfigManager.DEFAULT_CONFIG
+        self.log_rotator = LogRotator(
+            max_bytes=self.config.get("log_max_bytes", defaults["log_max_bytes"]),
+            max_age_days=self.config.get("log_max_age_days", defaults["log_max_age_days"]),
+            compression=self.config.get("log_compression", defaults["log_compression"]),
+            retention_count=self.config.get("log_retention_count", defaults["log_retention_count"]),
+            retention_days=self.config.get("log_retention_days", defaults["log_retention_days"])
+        )
+        # 当前会话（由 --session 设置），空字符串表示默认会话
+        self.session = ""
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self._default_shard = self._build_shard(
+            "", self.context_file, self.config_path_option("context_db_file"),
+            self.logs_dir / "callqw-conversation-log.txt", self.config_path_option("context_archive_dir")
+        )
+        self.context_store = self._default_shard.context_store
+        self.context_assembler = self._default_shard.context_assembler
+        self.conversation_log = self._default_shard.conversation_log
+        self.conversation_journal = self._default_shard.journal
+
+        self.response_cache = None
+        if self.config.get("response_cache", False):
+            self.response_cache = ResponseCache(
+                self.config_path_option("response_cache_file"),
+                max_bytes=self.config.get("response_cache_max_bytes", defaults["response_cache_max_bytes"]),
+                ttl=self.config.get("response_cache_ttl", defaults["response_cache_ttl"])
+            )
+
+        self.bridge_log = self.logs_dir / "callqw-bridge.log"
+
+        self.cli_backend = SubprocessBackend(self)
+        self._http_backend = None
+        self._hedge_backend = None
+        self._fanout_backends = None
+        self.latency_tracker = LatencyTracker(self.config_path_option("metrics_file"))
+        # 请求调度器：按后端限速并让交互式请求优先，priority 由 --priority 或 batch 命令设置
+        self.priority = "interactive"
+        self.scheduler = None
+        if self.config.get("scheduler", False):
+            defaults = ConfigManager.DEFAULT_CONFIG
+            self.scheduler = RequestScheduler(
+                self.config_path_option("scheduler_dir"),
+                rate=self.config.get("scheduler_rate", defaults["scheduler_rate"]),
+                burst=self.config.get("scheduler_burst", defaults["scheduler_burst"]),
+                interactive_reserve=self.config.get("scheduler_interactive_reserve",
+                                                    defaults["scheduler_interactive_reserve"]),
+                backoff_base=self.config.get("scheduler_backoff_base", defaults["scheduler_backoff_base"]),
+                backoff_max=self.config.get("scheduler_backoff_max", defaults["scheduler_backoff_max"]),
+                limits=self.config.get("scheduler_limits", {})
+            )
+        # Qwen 子进程的资源限制（0 表示不限制）
+        self.child_limits = ChildLimits(self.config.get("child_cpu_seconds", 0),
+                                        self.config.get("child_memory_mb", 0),
+                                        self.config.get("child_wall_seconds", 0))
+        # 预热进程池只在守护进程、批处理等长时间运行的场景中由 enable_worker_pool() 启用
+        self.worker_pool = None
+        # 运行中的 Qwen 子进程组（进程组号），守护进程的客户端断开时由 kill_children() 终止
+        self.child_groups = set()
+        # 进行中的性能分析（BridgeProfiler），由 start_profiler() 开启
+        self.profiler = None
+
+        self.metrics_sink = None
+        if self.config.get("metrics", True):
+            self.metrics_sink = MetricsSink(
+                self.config_path_option("metrics_file"),
+                self.config_path_option("metrics_prometheus_file"),
+                rotator=self.log_rotator
+            )
+
+        # 颜色输出、日志目录和日志系统均在首次使用时初始化
+        self._colors = None
+        self._logger = None
+        self._logs_dir_ready = False
+
+    def config_path_option(self, key):
+        """读取路径类配置项，相对路径基于配置文件所在目录；值为空字符串时返回 None"""
+        value = self.config.get(key, ConfigManager.DEFAULT_CONFIG.get(key))
+        if not value:
+            return None
+        path = Path(value)
+        return path if path.is_absolute() else self.config_dir / path
+
+    @property
+    def colors(self):
+        """颜色输出（首次使用时初始化，Windows 上会尝试加载 colorama）"""
+        if self._colors is None:
+            self._colors = Colors()
+        return self._colors
+
+    @property
+    def logger(self):
+        """日志记录器；run() 之外首次使用时按非开发者模式配置"""
+        if self._logger is None:
+            self.setup_logging()
+        return self._logger
+
+    def ensure_logs_dir(self):
+        """确保日志目录存在"""
+        if not self._logs_dir_ready:
+            self.logs_dir.mkdir(parents=True, exist_ok=True)
+            self._logs_dir_ready = True
+        
+    def get_ui_text(self, key, english_ui=False):
+        """获取多语言UI文本"""
+        lang = "en" if english_ui else "zh"
+        return UI_TEXTS[lang].get(key, UI_TEXTS["zh"].get(key, key))
+        
+    def setup_logging(self, dev_mode=False):
+        """设置日志系统"""
+        import logging
+        self.ensure_logs_dir()
+        # 每次调用都会重新配置日志，在打开文件前检查是否需要轮转
+        self.log_rotator.maybe_rotate(self.bridge_log)
+        handlers = [logging.FileHandler(self.bridge_log, encoding='utf-8')]
+        
+        # 只在开发者模式下输出到控制台
+        if dev_mode:
+            handlers.append(logging.StreamHandler(sys.stdout))
+            
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=handlers,
+            force=True  # 强制重新配置
+        )
+        self._logger = logging.getLogger(__name__)
+        
+    def _build_shard(self, session, context_file, db_file, conversation_log, archive_dir):
+        if self.config.get("context_backend", "markdown") == "sqlite":
+            store = SQLiteContextStore(db_file, import_from=context_file)
+        else:
+            store = ContextStore(context_file)
+        # 旧配置文件中没有 context_budget，回退到默认预算；预算为 0 时整个记忆文件会进入 -p 参数
+        assembler = ContextAssembler(
+            store,
+            budget=self.config.get("context_budget", ConfigManager.DEFAULT_CONFIG["context_budget"]),
+            unit=self.config.get("context_budget_unit", "chars"),
+            relevant=self.config.get("context_relevant_entries", 0),
+            recent=self.config.get("context_recent_entries", 0)
+        )
+        compactor = ContextCompactor(
+            store, archive_dir,
+            trim_bytes=self.config.get("context_trim_bytes", ConfigManager.DEFAULT_CONFIG["context_trim_bytes"]),
+            on_error=self._compaction_failed
+        )
+        journal = ConversationJournal(
+            conversation_log.with_suffix(".jsonl"),
+            text_path=conversation_log if self.config.get("conversation_text_log", True) else None,
+            rotator=self.log_rotator
+        )
+        return ContextShard(session, store, assembler, conversation_log, compactor, journal)
+
+    def _compaction_failed(self, error):
+        self.logger.warning(self.get_ui_text("compact_failed", False).format(error))
+
+    def session_dir(self, session):
+        """会话的存储目录"""
+        return self.config_path_option("sessions_dir") / ContextShard.validate(session)
+
+    def shard(self, session=None):
+        """获取会话的上下文分片；session 为 None 时使用当前会话"""
+        session = self.session if session is None else session
+        if not session:
+            return self._default_shard
+        with self._shards_lock:
+            if session not in self._shards:
+                directory = self.session_dir(session)
+                directory.mkdir(parents=True, exist_ok=True)
+                self._shards[session] = self._build_shard(
+                    session, directory / self.context_file.name,
+                    directory / self.config_path_option("context_db_file").name,
+                    directory / "callqw-conversation-log.txt", directory / "context-archive"
+                )
+            return self._shards[session]
+
+    def list_sessions(self):
+        """列出默认会话和 sessions_dir 下的所有会话：[{session, turns, bytes, last_activity}]"""
+        def describe(shard, files):
+            sizes = [(f.stat().st_size, f.stat().st_mtime) for f in files if f.is_file()]
+            store = shard.context_store
+            return {
+                "session": shard.session,
+                "turns": len(store) if store.data_path.exists() else 0,
+                "bytes": sum(size for size, _ in sizes),
+                "last_activity": max((mtime for _, mtime in sizes), default=None),
+            }
+
+        default = self._default_shard
+        default_files = [default.context_store.data_path, default.conversation_log, default.journal.path,
+                         default.journal.index_path]
+        if isinstance(default.context_store, ContextStore):
+            default_files.append(default.context_store.index_path)
+        sessions = [describe(default, default_files)]
+        sessions_dir = self.config_path_option("sessions_dir")
+        if sessions_dir.is_dir():
+            for directory in sorted(sessions_dir.iterdir()):
+                if directory.is_dir() and re.fullmatch(ContextShard.SESSION_PATTERN, directory.name):
+                    sessions.append(describe(self.shard(directory.name), directory.rglob("*")))
+        return sessions
+
+    def log_conversation(self, mode, message, response="", english_ui=False, session=None):
+        """记录一条对话日志（不写入上下文记忆）"""
+        self.record_conversation(mode, message, [response], english_ui, session=session)
+
+    @staticmethod
+    def result_fields(result):
+        """对话日志记录中来自调用结果的字段"""
+        return {
+            "ok": result.ok,
+            "returncode": result.returncode,
+            "cached": result.cached,
+            "attempts": result.attempts,
+            "duration_ms": None if result.duration is None else round(result.duration * 1000, 3),
+            "first_output_ms": None if result.first_output is None else round(result.first_output * 1000, 3),
+            "usage": result.usage,
+        }
+
+    def record_conversation(self, mode, message, chunks, english_ui=False, session=None, result=None, **fields):
+        """把一条对话写入结构化对话日志（同时渲染到文本对话日志），回应从 chunks 逐块写入"""
+        shard = self.shard(session)
+        record = {"session": shard.session, "mode": mode, "message": message,
+                  "message_bytes": len(message.encode("utf-8"))}
+        if result is not None:
+            record.update(self.result_fields(result))
+        record.update(fields)
+        self.ensure_logs_dir()
+        return shard.journal.append(record, chunks, english_ui)
+            
+    def get_context_memory(self, english_ui=False, last_n=None, session=None):
+        """获取上下文记忆
+
+        last_n 为 None 时使用配置 context_recent_entries（0 表示全部）；
+        指定条数时通过索引直接读取最近 N 条记录。配置了 context_budget 时
+        只返回预算内最新的记录。
+        """
+        if last_n is None:
+            last_n = self.config.get("context_recent_entries", 0)
+        shard = self.shard(session)
+        if shard.context_store.data_path.exists():
+            try:
+                if last_n:
+                    content = shard.context_store.tail(last_n)
+                elif shard.context_assembler.budget:
+                    content = shard.context_assembler.select_history()[0]
+                else:
+                    content = shard.context_store.read_all()
+                self.logger.debug(self.get_ui_text("context_loaded", english_ui).format(len(content)))
+                return content
+            except Exception as e:
+                self.logger.warning(self.get_ui_text("context_load_failed", english_ui).format(str(e)))
+                return ""
+        else:
+            self.logger.debug(self.get_ui_text("context_not_found", english_ui))
+            return ""
+            
+    def record_result(self, mode, message, result, english_ui=False, session=None, context=True, **fields):
+        """把一次调用的结果写入对话日志和上下文记忆
+
+        输出从 QwenResult 逐块读取并同时写入两处，不会为写日志拼接完整的输出文本。
+        """
+        self.record_output(mode, message, result.chunks(), english_ui, session, context, result=result, **fields)
+
+    def record_output(self, mode, message, chunks, english_ui=False, session=None, context=True, result=None,
+                      **fields):
+        """把逐块产出的回应文本写入对话日志和上下文记忆"""
+        shard = self.shard(session)
+        context_entry = shard.context_store.open_entry(message, **shard.entry_metadata(mode)) if context else None
+
+        def tee():
+            for text in chunks:
+                if context_entry is not None:
+                    context_entry.write(text)
+                yield text
+
+        try:
+            self.record_conversation(mode, message, tee(), english_ui, session, result, **fields)
+        finally:
+            if context_entry is not None:
+                context_entry.close()
+        if context:
+            self.schedule_compaction(session)
+
+    def update_context_memory(self, message, response="", english_ui=False, mode="ask", session=None):
+        """更新上下文记忆（仅追加，不重写历史内容），随后在后台增量压缩"""
+        shard = self.shard(session)
+        shard.context_store.append(message, response, **shard.entry_metadata(mode))
+        self.schedule_compaction(session)
+
+    def schedule_compaction(self, session=None):
+        """配置 context_compaction 开启时，在后台线程中增量压缩会话的上下文记忆"""
+        if self.config.get("context_compaction", ConfigManager.DEFAULT_CONFIG["context_compaction"]):
+            self.shard(session).compactor.schedule()
+
+    def wait_for_compaction(self):
+        """等待所有会话的后台压缩结束"""
+        with self._shards_lock:
+            shards = [self._default_shard] + list(self._shards.values())
+        for shard in shards:
+            shard.compactor.wait()
+            
+    def get_mode_rules(self, mode="ask"):
+        """获取当前模式的协作规则头部"""
+        key = "agent_mode_rules" if mode == "agent" else "ask_mode_rules"
+        return self.config.get(key, self.config_manager.DEFAULT_CONFIG[key])
+
+    def build_prompt(self, message, mode="ask", english_ui=False, dev_mode=False, session=None):
+        """组装带协作规则和上下文记忆的提示词，返回 (提示词, 上下文文本, 统计信息)"""
+        assembler = self.shard(session).context_assembler
+        prompt, history, stats = assembler.assemble(self.get_mode_rules(mode), message)
+        report = self.get_ui_text("context_budget_report", english_ui).format(
+            stats["budget"] or "∞", stats["unit"], stats["kept"], stats["dropped"], stats["used"]
+        )
+        self.logger.info(report)
+        if dev_mode and stats["dropped"]:
+            self.colors.print_colored(report, "gray")
+        return prompt, history, stats
+
+    def new_metrics(self, mode="ask"):
+        """创建单次调用的指标对象，首次调用时计入配置加载耗时"""
+        metrics = CallMetrics(mode)
+        metrics.add_span("config_load", self._pending_config_load)
+        self._pending_config_load = None
+        return metrics
+
+    def record_metrics(self, metrics, dev_mode=False, english_ui=False):
+        """输出单次调用的指标：写入指标文件，开发者模式下同时显示各阶段耗时"""
+        record = metrics.to_record()
+        if dev_mode:
+            timings = ", ".join(f"{name} {ms:.1f}" for name, ms in record["spans_ms"].items())
+            timings += f", total {record['total_ms']:.1f}"
+            self.colors.print_colored(self.get_ui_text("phase_timings", english_ui).format(timings), "gray")
+        if self.metrics_sink is None:
+            return
+        try:
+            self.metrics_sink.emit(record)
+        except OSError as e:
+            self.logger.warning(f"写入指标文件失败: {e}")
+
+    def get_cli_path(self):
+        """获取 Qwen Code CLI 路径"""
+        # 使用配置中的CLI路径，如果未设置则使用默认值
+        qwen_cli_path = self.config.get("qwen_cli_path", "qwen")
+        if not qwen_cli_path:  # 如果配置中是空字符串，使用默认值
+            qwen_cli_path = "qwen"
+        return qwen_cli_path
+
+    def build_command(self, message, mode="ask", dev_mode=False, cli_path=None):
+        """构造 Qwen Code CLI 命令行；message 为 None 时不带 -p，CLI 从 stdin 读取提示词
+
+        cli_path 用于对冲请求和扇出调用中配置的其他 CLI 路径，None 时使用 qwen_cli_path。
+        """
+        cmd = [cli_path or self.get_cli_path()]
+        
+        # 根据模式设置参数
+        if mode == "agent":
+            cmd.append("--yolo")  # agent 模式使用 --yolo 参数自动接受所有操作
+        
+        if dev_mode:
+            cmd.append("-d")  # debug 模式
+            
+        # 使用 -p 参数传递提示消息
+        if message is not None:
+            cmd.extend(["-p", message])
+        
+        # Qwen Code 0.0.8 版本似乎不支持 --lang 参数
+        # 保留接口以备将来使用
+        return cmd
+
+    def new_output_buffer(self, limit=True):
+        """创建一次调用的输出缓冲：超过 output_memory_bytes 的部分转存到日志目录，超过 output_max_bytes 时终止调用
+
+        limit 为 False 时不检查 output_max_bytes（用于转录已经受限的输出）。
+        """
+        defaults = ConfigManager.DEFAULT_CONFIG
+        self.ensure_logs_dir()
+        return OutputBuffer(
+            memory_bytes=self.config.get("output_memory_bytes", defaults["output_memory_bytes"]),
+            max_bytes=self.config.get("output_max_bytes", defaults["output_max_bytes"]) if limit else 0,
+            spool_dir=str(self.logs_dir)
+        )
+
+    def enable_worker_pool(self):
+        """按配置 worker_pool_size 启用 Qwen CLI 预热进程池（0 表示不启用），返回进程池或 None"""
+        size = self.config.get("worker_pool_size", 0)
+        if not size or self.worker_pool is not None:
+            return self.worker_pool
+        import atexit
+        self.worker_pool = WorkerPool(self.work_dir, size=size,
+                                      max_age=self.config.get("worker_pool_max_age", 300),
+                                      limits=self.child_limits.ulimit_commands())
+        self.worker_pool.prime(self.build_command(None))
+        atexit.register(self.worker_pool.shutdown)
+        return self.worker_pool
+
+    def kill_children(self):
+        """向所有运行中的 Qwen 子进程组发送 SIGTERM（守护进程的客户端断开时调用）"""
+        for pid in list(self.child_groups):
+            SubprocessBackend._signal_tree(pid)
+
+    def start_profiler(self, label, cpu=False, memory=False):
+        """按参数或配置 profile / profile_memory 开始性能分析，都未开启时返回 None"""
+        cpu = cpu or self.config.get("profile", False)
+        memory = memory or self.config.get("profile_memory", False)
+        if not (cpu or memory):
+            return None
+        self.profiler = BridgeProfiler(self.config_path_option("profile_dir"), label, cpu, memory,
+                                       self.config.get("profile_top", ConfigManager.DEFAULT_CONFIG["profile_top"]))
+        return self.profiler.start()
+
+    def profile_thread(self):
+        """工作线程的 initializer：性能分析进行中时为该线程开启 cProfile"""
+        if self.profiler is not None:
+            self.profiler.profile_thread()
+
+    def stop_profiler(self, english_ui=False):
+        """结束性能分析，显示并记录结果文件；内存分析时还显示峰值和占用最多的分配位置"""
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return
+        profiler.stop()
+        lines = [self.get_ui_text("profile_written", english_ui).format(", ".join(str(p) for p in profiler.paths))]
+        if profiler.memory:
+            lines.append(self.get_ui_text("profile_memory_peak", english_ui).format(profiler.peak / 1048576))
+            lines += [f"  {size / 1024:10.1f} KiB {count:>8}  {where}" for where, size, count in profiler.sites[:5]]
+        for line in lines:
+            self.logger.info(line)
+        self.colors.print_colored("\n".join(lines), "yellow")
+
+    def show_worker_pool_stats(self, english_ui=False):
+        """开发者模式下显示预热进程池的大小、交接耗时和等待次数"""
+        pool = self.worker_pool
+        if pool is None:
+            return
+        stats = pool.stats
+        text = self.get_ui_text("worker_pool_stats", english_ui).format(
+            pool.size, stats["last_handoff_ms"], stats["waits"], stats["handoffs"], stats["recycled"])
+        self.logger.info(text)
+        self.colors.print_colored(text, "gray")
+
+    def make_backend(self, spec):
+        """按描述创建后端：{"type": "cli", "cli_path": ...} 或 {"type": "openai", "base_url": ..., "model": ...}
+
+        未指定的字段使用配置中对应的 qwen_cli_path / openai_* 设置。
+        """
+        if spec.get("type", "cli") == "cli":
+            return SubprocessBackend(self, cli_path=spec.get("cli_path") or None)
+        defaults = ConfigManager.DEFAULT_CONFIG
+
+        def option(name):
+            return spec.get(name, self.config.get("openai_" + name, defaults.get("openai_" + name)))
+
+        return OpenAIBackend(
+            option("base_url"),
+            option("model"),
+            api_key=option("api_key") or os.environ.get("OPENAI_API_KEY", ""),
+            pool_size=option("pool_size"),
+            stream=option("stream"),
+            extra_body=option("extra_body") or {}
+        )
+
+    def backend_for(self, mode="ask"):
+        """选择调用后端：配置 backend 为 openai 时 ask 模式走 HTTP，agent 模式需要操作文件，始终使用 CLI"""
+        if mode == "agent" or self.config.get("backend", "cli") != "openai":
+            return self.cli_backend
+        if self._http_backend is None:
+            self._http_backend = self.make_backend({"type": "openai"})
+        return self._http_backend
+
+    def hedge_backend(self, mode="ask"):
+        """对冲请求使用的后端：配置了 hedge_cli_path 时使用该 CLI，否则与原请求相同"""
+        cli_path = self.config.get("hedge_cli_path", "")
+        if not cli_path:
+            return self.backend_for(mode)
+        if self._hedge_backend is None:
+            self._hedge_backend = SubprocessBackend(self, cli_path=cli_path)
+        return self._hedge_backend
+
+    def fanout_backends(self):
+        """扇出调用的后端列表 [(名称, 后端)]，来自配置 fanout_backends"""
+        if self._fanout_backends is None:
+            backends = []
+            for i, spec in enumerate(self.config.get("fanout_backends", [])):
+                name = spec.get("name") or f"{spec.get('type', 'cli')}-{i + 1}"
+                backends.append((name, self.make_backend(spec)))
+            self._fanout_backends = backends
+        return self._fanout_backends
+
+    def is_quota_error(self, result):
+        """调用是否因配额或限流失败（HTTP 429，或错误输出匹配 scheduler_quota_pattern）"""
+        if result.ok:
+            return False
+        if result.returncode == 429:
+            return True
+        pattern = self.config.get("scheduler_quota_pattern", ConfigManager.DEFAULT_CONFIG["scheduler_quota_pattern"])
+        return bool(pattern) and re.search(pattern, f"{result.stderr}\n{result.output}") is not None
+
+    async def _execute_process(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                               timeout=0, backend=None, deadline=None):
+        """通过后端（默认为当前模式的后端）执行一次调用，返回 QwenResult；timeout 为 0 表示不限时
+
+        启用请求调度器时先按 self.priority 排队取得令牌，排队时间不计入 timeout，但计入总超时：
+        deadline（time.monotonic() 时刻）之前没有取得令牌时不执行调用，返回超时的结果。
+        """
+        import asyncio
+        backend = backend or self.backend_for(mode)
+        if self.scheduler is None:
+            return await self._run_backend(message, mode, dev_mode, english_ui, on_output, timeout, backend)
+
+        started = time.monotonic()
+        try:
+            queued = await self.scheduler.acquire(backend, self.priority,
+                                                  None if deadline is None else max(0.0, deadline - started))
+        except asyncio.TimeoutError:
+            queued = time.monotonic() - started
+            error_msg = self.get_ui_text("scheduler_timeout", english_ui).format(queued)
+            self.logger.error(error_msg)
+            if dev_mode:
+                self.colors.print_colored(error_msg, "red")
+            result = QwenResult(error_msg, ok=False, returncode=None, duration=queued, timed_out=True)
+            result.queued = queued
+            return result
+        if queued >= 1:
+            waited_text = self.get_ui_text("scheduler_waited", english_ui).format(self.priority, queued)
+            self.logger.info(waited_text)
+            if dev_mode:
+                self.colors.print_colored(waited_text, "gray")
+        if deadline is not None:
+            remaining = max(0.001, deadline - time.monotonic())
+            timeout = min(timeout, remaining) if timeout else remaining
+        result = await self._run_backend(message, mode, dev_mode, english_ui, on_output, timeout, backend)
+        result.queued = queued
+        backoff = self.scheduler.report(backend, self.is_quota_error(result))
+        if backoff:
+            backoff_text = self.get_ui_text("scheduler_backoff", english_ui).format(backend.name, backoff)
+            self.logger.warning(backoff_text)
+            if dev_mode:
+                self.colors.print_colored(backoff_text, "yellow")
+        return result
+
+    def log_child_usage(self, usage, english_ui=False):
+        """在桥接日志中记录一次调用的子进程资源使用，无法取得的项显示为 -"""
+        values = [usage.get(key) for key in ("user_cpu", "sys_cpu", "max_rss_kb",
+                                             "voluntary_switches", "involuntary_switches")]
+        values[:2] = [None if value is None else f"{value:.3f}" for value in values[:2]]
+        self.logger.info(self.get_ui_text("child_usage", english_ui).format(
+            *("-" if value is None else value for value in values)))
+
+    async def _run_backend(self, message, mode, dev_mode, english_ui, on_output, timeout, backend):
+        """执行一次后端调用并把各种失败转换为 QwenResult"""
+        import asyncio
+        # 提示词可能包含完整的规则和上下文，日志中只记录其大小
+        self.logger.info(self.get_ui_text("command_executing", english_ui).format(
+            backend.describe(message, mode, dev_mode)))
+        
+        started = time.monotonic()
+        output = self.new_output_buffer()
+        try:
+            returncode, stdout, stderr, first_output, spawn, usage = await asyncio.wait_for(
+                backend.run(message, mode, dev_mode, on_output, output), timeout or None)
+            duration = time.monotonic() - started
+            if self.profiler is not None:
+                # 回应刚读完，通常是一次调用中内存占用最高的时刻
+                self.profiler.checkpoint()
+            if usage:
+                self.log_child_usage(usage, english_ui)
+            
+            if returncode == 0:
+                self.logger.info(self.get_ui_text("command_success", english_ui))
+                return QwenResult(stdout, returncode=0, stderr=stderr, duration=duration,
+                                  first_output=first_output, spawn=spawn, usage=usage)
+            else:
+                output.close()
+                limit = (usage or {}).get("limit")
+                if limit:
+                    error_msg = self.get_ui_text("command_limit_exceeded", english_ui).format(
+                        self.get_ui_text(f"limit_{limit}", english_ui).format(self.child_limits.value(limit)))
+                else:
+                    error_msg = self.get_ui_text("command_failed", english_ui).format(stderr)
+                self.logger.error(error_msg)
+                if dev_mode:
+                    self.colors.print_colored(error_msg, "red")
+                return QwenResult(error_msg, ok=False, returncode=returncode, stderr=stderr, duration=duration,
+                                  first_output=first_output, spawn=spawn, usage=usage)
+                
+        except asyncio.TimeoutError:
+            output.close()
+            error_msg = self.get_ui_text("command_timeout", english_ui).format(timeout)
+            self.logger.error(error_msg)
+            if dev_mode:
+                self.colors.print_colored(error_msg, "red")
+            return QwenResult(error_msg, ok=False, returncode=None, duration=time.monotonic() - started,
+                              timed_out=True)
+        except OutputLimitExceeded as e:
+            output.close()
+            error_msg = self.get_ui_text("command_output_limit", english_ui).format(e.limit)
+            self.logger.error(error_msg)
+            if dev_mode:
+                self.colors.print_colored(error_msg, "red")
+            return QwenResult(error_msg, ok=False, returncode=None, duration=time.monotonic() - started)
+        except FileNotFoundError:
+            output.close()
+            error_msg = self.get_ui_text("command_not_found", english_ui)
+            self.logger.error(error_msg)
+            if dev_mode:
+                self.colors.print_colored(error_msg, "red")
+            return QwenResult(error_msg, ok=False, returncode=None, duration=time.monotonic() - started)
+        except Exception as e:
+            output.close()
+            error_msg = self.get_ui_text("command_error", english_ui).format(str(e))
+            self.logger.error(error_msg)
+            if dev_mode:
+                self.colors.print_colored(error_msg, "red")
+            return QwenResult(error_msg, ok=False, returncode=None, duration=time.monotonic() - started)
+
+    def hedge_delay(self):
+        """对冲请求的截止时间（秒）：最近调用首字节延迟的 hedge_percentile 百分位，样本不足时为 hedge_delay"""
+        defaults = ConfigManager.DEFAULT_CONFIG
+        delay = self.latency_tracker.percentile(
+            self.config.get("hedge_percentile", defaults["hedge_percentile"]),
+            self.config.get("hedge_min_samples", defaults["hedge_min_samples"]))
+        return self.config.get("hedge_delay", defaults["hedge_delay"]) if delay is None else delay
+
+    async def _execute_hedged(self, message, mode, dev_mode, english_ui, on_output, timeout, deadline=None):
+        """对冲请求：截止时间内没有输出时再发起一个相同的调用，采用先成功的结果并取消另一个
+
+        流式输出时先产生输出的调用获得输出流，另一个调用随即取消；非流式时采用先成功完成的调用。
+        """
+        import asyncio
+        delay = self.hedge_delay()
+        started = time.monotonic()
+        launched = [0.0]  # 各调用相对 started 的发起时间
+        owner = []        # 先产生输出的调用序号
+        has_output = asyncio.Event()
+
+        def forward(index):
+            def emit(text):
+                if not owner:
+                    owner.append(index)
+                    has_output.set()
+                if owner[0] == index and on_output:
+                    on_output(text)
+            return emit
+
+        tasks = [asyncio.ensure_future(
+            self._execute_process(message, mode, dev_mode, english_ui, forward(0), timeout, deadline=deadline))]
+        output_wait = asyncio.ensure_future(has_output.wait())
+        try:
+            done, _ = await asyncio.wait([tasks[0], output_wait], timeout=delay,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launched.append(time.monotonic() - started)
+                started_text = self.get_ui_text("hedge_started", english_ui).format(delay)
+                self.logger.info(started_text)
+                if dev_mode:
+                    self.colors.print_colored(started_text, "gray")
+                remaining = max(0.001, timeout - launched[1]) if timeout else 0
+                tasks.append(asyncio.ensure_future(self._execute_process(
+                    message, mode, dev_mode, english_ui, forward(1), remaining, backend=self.hedge_backend(mode),
+                    deadline=deadline)))
+
+            winner = None
+            pending = set(tasks)
+            while pending and winner is None:
+                watch = set(pending)
+                if on_output and not owner:
+                    watch.add(output_wait)
+                done, _ = await asyncio.wait(watch, return_when=asyncio.FIRST_COMPLETED)
+                if on_output and owner:
+                    # 输出流已交给先产生输出的调用
+                    winner = owner[0]
+                    break
+                for index, task in enumerate(tasks):
+                    if task in done and task in pending:
+                        pending.discard(task)
+                        if task.result().ok:
+                            winner = index
+                            break
+            finished = time.monotonic() - started
+            for index, task in enumerate(tasks):
+                if index != winner:
+                    task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            output_wait.cancel()
+            for task in tasks:
+                task.cancel()
+
+        # 两个调用都失败时采用原请求的结果
+        chosen = 0 if winner is None or not isinstance(results[winner], QwenResult) else winner
+        for index, other in enumerate(results):
+            if index != chosen and isinstance(other, QwenResult):
+                other.close()
+        result = results[chosen]
+        if result.first_output is not None:
+            result.first_output += launched[chosen]
+        result.duration += launched[chosen]
+        if len(tasks) > 1:
+            saved = None
+            if chosen == 1 and result.first_output is not None:
+                # 按历史上首字节延迟同样超过该时间的调用，估计原请求的首字节延迟
+                waited = delay if owner and owner[0] == 0 else max(delay, finished)
+                expected = self.latency_tracker.mean_above(waited)
+                saved = max(0.0, expected - result.first_output) if expected is not None else None
+            result.hedge = {"delay": delay, "winner": chosen, "saved": saved}
+            report = self.get_ui_text("hedge_report", english_ui).format(
+                chosen + 1, delay, "-" if saved is None else f"{saved:.2f}")
+            self.logger.info(report)
+            if dev_mode:
+                self.colors.print_colored(report, "gray")
+        return result
+
+    async def _execute_with_retry(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                                  timeout=None, total_timeout=None, retries=None, hedge=None, backend=None):
+        """带单次超时、总超时和指数退避重试的调用
+
+        非 0 退出码和单次超时会重试，找不到命令等错误不重试；退避时间加入随机抖动，
+        避免多个并发调用同时重试。已经把输出交给 on_output（显示到终端、写入上下文记录）的调用
+        不再重试，否则失败调用的部分输出会重复出现。hedge 为 None 时使用配置 hedge；
+        指定了 backend 时不发起对冲请求。
+        """
+        import asyncio
+        import random
+        hedge = self.config.get("hedge", False) if hedge is None else hedge
+        timeout = self.config.get("call_timeout", 0) if timeout is None else timeout
+        total_timeout = self.config.get("total_timeout", 0) if total_timeout is None else total_timeout
+        retries = self.config.get("retry_attempts", 0) if retries is None else retries
+        # 配额错误由调度器退避，重试不计入 retry_attempts，也不再额外等待
+        quota_retries = self.config.get("scheduler_quota_retries", 3) if self.scheduler is not None else 0
+        base = self.config.get("retry_backoff_base", 1.0)
+        cap = self.config.get("retry_backoff_max", 30.0)
+        deadline = time.monotonic() + total_timeout if total_timeout else None
+
+        if dev_mode:
+            self.colors.print_colored(self.get_ui_text("calling_qwen", english_ui), "magenta")
+
+        attempt = 0
+        quota_attempts = 0
+        while True:
+            attempt += 1
+            attempt_timeout = timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                attempt_timeout = min(timeout, remaining) if timeout else remaining
+            attempt_timeout = max(attempt_timeout, 0.001) if attempt_timeout else 0
+            emitted = []
+
+            def forward(text, emitted=emitted):
+                emitted.append(True)
+                on_output(text)
+            attempt_output = forward if on_output is not None else None
+            if hedge and mode == "ask" and backend is None:
+                result = await self._execute_hedged(message, mode, dev_mode, english_ui, attempt_output,
+                                                    attempt_timeout, deadline)
+            else:
+                result = await self._execute_process(message, mode, dev_mode, english_ui, attempt_output,
+                                                     attempt_timeout, backend=backend, deadline=deadline)
+            if mode == "ask" and result.ok and result.first_output is not None:
+                self.latency_tracker.add(result.first_output)
+            result.attempts = attempt
+            result.pooled = self.worker_pool is not None and (backend or self.backend_for(mode)) is self.cli_backend
+            if emitted:
+                # 部分输出已经显示并写入上下文记录，重试会让它重复出现
+                return result
+            if quota_attempts < quota_retries and self.is_quota_error(result):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return result
+                quota_attempts += 1
+                retries += 1
+                result.close()
+                continue
+            # 超过资源限制被终止的调用重试也会同样失败
+            retryable = not result.ok and not result.limit and (result.returncode not in (None, 0) or result.timed_out)
+            if not retryable or attempt > retries:
+                return result
+            delay = min(cap, base * (2 ** (attempt - 1)))
+            delay = random.uniform(delay / 2, delay)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                return result
+            retry_text = self.get_ui_text("command_retry", english_ui).format(attempt, delay)
+            self.logger.warning(retry_text)
+            if dev_mode:
+                self.colors.print_colored(retry_text, "yellow")
+            await asyncio.sleep(delay)
+
+    async def aexecute(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                       use_cache=True, timeout=None, total_timeout=None, retries=None, hedge=None, backend=None):
+        """异步调用 Qwen，返回 QwenResult
+
+        启用响应缓存时，ask 模式先查缓存；agent 模式的副作用正是调用目的，从不使用缓存。
+        timeout/total_timeout/retries/hedge 为 None 时使用配置中的
+        call_timeout/total_timeout/retry_attempts/hedge；backend 为 None 时使用当前模式的后端。
+        """
+        options = dict(timeout=timeout, total_timeout=total_timeout, retries=retries, hedge=hedge, backend=backend)
+        cache = self.response_cache if use_cache and mode != "agent" else None
+        if cache is None:
+            return await self._execute_with_retry(message, mode, dev_mode, english_ui, on_output, **options)
+
+        key = cache.make_key(message, mode, (backend or self.backend_for(mode)).identity())
+        cached = cache.get(key)
+        if cached is not None:
+            stats = cache.stats()
+            hit_text = self.get_ui_text("cache_hit", english_ui).format(stats["hits"], stats["misses"])
+            self.logger.info(hit_text)
+            if dev_mode:
+                self.colors.print_colored(hit_text, "gray")
+            if on_output:
+                on_output(cached)
+            return QwenResult(cached, duration=0.0, first_output=0.0, cached=True)
+
+        result = await self._execute_with_retry(message, mode, dev_mode, english_ui, on_output, **options)
+        # 已转存到磁盘的大输出不写入缓存，避免为此把完整文本读入内存
+        if result.ok and not result.spilled:
+            cache.put(key, result.output)
+        return result
+
+    async def acall(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                    use_cache=True, timeout=None, total_timeout=None, retries=None):
+        """异步调用 Qwen，返回输出文本（失败时为错误提示），可在同一事件循环中并发多个调用"""
+        result = await self.aexecute(message, mode, dev_mode, english_ui, on_output, use_cache,
+                                     timeout, total_timeout, retries)
+        return result.output
+
+    def execute(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                use_cache=True, timeout=None, total_timeout=None, retries=None, hedge=None):
+        """同步调用 Qwen，返回 QwenResult"""
+        import asyncio
+        return asyncio.run(self.aexecute(message, mode, dev_mode, english_ui, on_output, use_cache,
+                                         timeout, total_timeout, retries, hedge))
+
+    def call_qwen(self, message, mode="ask", dev_mode=False, english_ui=False, on_output=None,
+                  use_cache=True):
+        """调用 Qwen Code CLI，返回输出文本（失败时为错误提示）"""
+        return self.execute(message, mode, dev_mode, english_ui, on_output, use_cache).output
+
+    async def afanout(self, message, mode="ask", dev_mode=False, english_ui=False, timeout=None):
+        """把同一提示词并发发送给 fanout_backends 中的所有后端，按完成顺序返回 [(名称, QwenResult)]"""
+        import asyncio
+        timeout = self.config.get("call_timeout", 0) if timeout is None else timeout
+
+        async def call(name, backend):
+            return name, await self._execute_process(message, mode, dev_mode, english_ui, None, timeout,
+                                                     backend=backend)
+
+        results = []
+        for future in asyncio.as_completed([call(name, backend) for name, backend in self.fanout_backends()]):
+            results.append(await future)
+        return results
+
+    def run_fanout(self, prompt, message, mode="ask", dev_mode=False, english_ui=False, metrics=None):
+        """扇出调用：按完成顺序逐个显示各后端的回答，全部回答按后端分节写入日志和上下文
+
+        返回最先成功的结果（都失败时为最先完成的结果）；未配置 fanout_backends 时返回 None。
+        """
+        import asyncio
+        metrics = metrics or CallMetrics(mode)
+        if not self.fanout_backends():
+            self.colors.print_colored(self.get_ui_text("fanout_not_configured", english_ui), "yellow")
+            return None
+        results = asyncio.run(self.afanout(prompt, mode, dev_mode, english_ui))
+
+        self.display_response_title(dev_mode, english_ui)
+        for name, result in results:
+            self.colors.print_colored(self.get_ui_text("fanout_header", english_ui).format(name, result.duration),
+                                      "cyan")
+            for text in result.chunks():
+                self.colors.write_colored(text, "blue")
+            print()
+        successes = [(name, result) for name, result in results if result.ok]
+        if successes:
+            report = self.get_ui_text("fanout_report", english_ui).format(
+                successes[0][0], successes[0][1].duration, successes[-1][1].duration - successes[0][1].duration)
+            self.logger.info(report)
+            self.colors.print_colored(report, "gray")
+
+        def sections():
+            for name, result in results:
+                yield f"[{name}]\n"
+                for text in result.chunks():
+                    yield text
+                if not result.endswith("\n"):
+                    yield "\n"
+
+        fanout = [{"backend": name, "ok": result.ok, "duration_ms": round(result.duration * 1000, 3)}
+                  for name, result in results]
+        with metrics.span("write"):
+            self.record_output(mode, message, sections(), english_ui, ok=bool(successes), fanout=fanout)
+        metrics.update(fanout=fanout)
+        chosen = (successes or results)[0][1]
+        for _, result in results:
+            if result is not chosen:
+                result.close()
+        return chosen
+            
+    def display_header(self, english_ui=False):
+        """显示程序头部信息"""
+        title = self.get_ui_text("title", english_ui)
+        version = self.get_ui_text("version", english_ui)
+        working_dir = self.get_ui_text("working_dir", english_ui).format(self.work_dir)
+        
+        header = f"\n{title}\n{version}\n{working_dir}\n"
+        print(header)
+        
+    def display_response_title(self, dev_mode=False, english_ui=False):
+        """显示 Qwen 回应的标题"""
+        if dev_mode:
+            print("\n" + "="*60)
+            response_title = self.get_ui_text("qwen_response", english_ui)
+            self.colors.print_colored(response_title, "blue")
+            print("="*60)
+        else:
+            # 非开发者模式：简洁输出，只显示 "Qwen Code:" 前缀
+            qwen_title = self.get_ui_text("qwen_code", english_ui)
+            self.colors.print_colored(qwen_title, "blue")
+
+    def run_streaming(self, prompt, message, mode="ask", dev_mode=False, english_ui=False, use_cache=True,
+                      metrics=None, hedge=None):
+        """流式调用 Qwen：输出到达即显示并记入缓冲，调用结束后写入对话日志和上下文记忆
+
+        写入在 finally 中进行：调用被中断（Ctrl-C）时，已经显示的部分输出同样写入两处，
+        对话日志记录的 ok 为 false、returncode 为 130。
+        """
+        metrics = metrics or CallMetrics(mode)
+        self.display_response_title(dev_mode, english_ui)
+        streamed = self.new_output_buffer(limit=False)
+        result = None
+        try:
+            def on_output(text):
+                self.colors.write_colored(text, "blue")
+                streamed.write(text)
+
+            result = self.execute(prompt, mode, dev_mode, english_ui, on_output=on_output, use_cache=use_cache,
+                                  hedge=hedge)
+            if not result.ok:
+                # 错误提示同样写入日志和上下文，与非流式模式保持一致
+                self.colors.print_colored(result.output, "red")
+                streamed.write(result.output)
+            elif result.output_bytes and not result.endswith("\n"):
+                print()
+        finally:
+            interrupted = {} if result is not None else {"ok": False, "returncode": 130}
+            try:
+                with metrics.span("write"):
+                    self.record_output(mode, message, streamed.chunks(), english_ui, result=result, **interrupted)
+            finally:
+                streamed.close()
+
+        timing = self.get_ui_text("stream_timing", english_ui).format(
+            result.first_output if result.first_output is not None else result.duration, result.duration
+        )
+        self.logger.info(timing)
+        if dev_mode:
+            self.colors.print_colored(timing, "gray")
+        return result
+
+    def run(self, args):
+        """主运行方法；--profile、--profile-memory 或对应配置开启时在性能分析下执行"""
+        if self.start_profiler("call", args.profile, args.profile_memory) is None:
+            return self._run(args)
+        try:
+            return self._run(args)
+        finally:
+            self.stop_profiler(args.english_ui or self.config.get("default_english_ui", False))
+
+    def _run(self, args):
+        """执行一次调用"""
+        # 使用配置中的默认值（如果命令行参数未明确指定）
+        english_ui = args.english_ui or self.config.get("default_english_ui", False)
+        dev_mode = args.dev_mode or self.config.get("default_dev_mode", False)
+        stream = args.stream or self.config.get("default_stream", False)
+        agent_mode = args.mode == "agent" or (args.mode is None and self.config.get("default_agent_mode", False))
+        
+        # 重新配置日志系统（根据 dev_mode）
+        self.setup_logging(dev_mode)
+        
+        # 只在开发者模式显示头部信息
+        if dev_mode:
+            self.display_header(english_ui)
+            
+            # 显示模式信息
+            if agent_mode:
+                mode_text = self.get_ui_text("mode_agent", english_ui)
+            else:
+                mode_text = self.get_ui_text("mode_ask", english_ui)
             
             self.colors.print_colored(mode_text, "cyan")
         
@@ -499,8 +4505,24 @@ class QwenBridge:
             self.colors.print_colored(error_text, "red")
             return 1
         
-        # 获取上下文记忆
-        context_memory = self.get_context_memory(english_ui)
+        mode = "agent" if agent_mode else "ask"
+        self.session = args.session or ""
+        self.priority = args.priority
+        metrics = self.new_metrics(mode)
+        if self.session:
+            metrics.update(session=self.session)
+        
+        # 按预算组装协作规则、上下文记忆和当前消息
+        prompt, context_memory, context_stats = self.build_prompt(
+            message,
+            mode=mode,
+            english_ui=english_ui,
+            dev_mode=dev_mode
+        )
+        metrics.add_span("context_read", context_stats["read_seconds"])
+        metrics.add_span("context_assembly", context_stats["assembly_seconds"])
+        metrics.update(stream=stream, prompt_chars=len(prompt), prompt_bytes=len(prompt.encode("utf-8")),
+                       context_entries=context_stats["kept"], context_dropped=context_stats["dropped"])
         
         # 显示上下文信息
         if context_memory:
@@ -517,41 +4539,1792 @@ class QwenBridge:
                 start_text = self.get_ui_text("starting_new_conversation", english_ui)
                 self.colors.print_colored(start_text, "yellow")
             
-        # 调用 Qwen
-        response = self.call_qwen(
-            message,
-            mode="agent" if agent_mode else "ask",
-            dev_mode=dev_mode,
-            english_ui=english_ui
+        # --hedge 为本次调用开启对冲请求，未指定时使用配置 hedge
+        hedge = True if args.hedge else None
+        if args.fanout and mode == "ask":
+            result = self.run_fanout(prompt, message, mode, dev_mode, english_ui, metrics=metrics)
+            if result is None:
+                return 1
+        elif stream:
+            result = self.run_streaming(prompt, message, mode, dev_mode, english_ui,
+                                        use_cache=not args.no_cache, metrics=metrics, hedge=hedge)
+        else:
+            # 调用 Qwen
+            result = self.execute(
+                prompt,
+                mode=mode,
+                dev_mode=dev_mode,
+                english_ui=english_ui,
+                use_cache=not args.no_cache,
+                hedge=hedge
+            )
+            
+            # 显示响应（逐块输出，大输出不需要整体读入内存）
+            self.display_response_title(dev_mode, english_ui)
+            for text in result.chunks():
+                self.colors.write_colored(text, "blue")
+            print()
+            
+            # 记录日志
+            with metrics.span("write"):
+                self.record_result(mode, message, result, english_ui)
+        metrics.add_result(result)
+        self.record_metrics(metrics, dev_mode, english_ui)
+        result.close()
+        
+        # 显示完成信息
+        if dev_mode:
+            self.show_worker_pool_stats(english_ui)
+            complete_text = self.get_ui_text("bridge_completed", english_ui)
+            self.colors.print_colored(complete_text, "green")
+        
+        return 0
+
+
+def default_config_path(config_path=None):
+    """返回实际使用的配置文件路径：未指定时为当前目录下的 callqw-config.json"""
+    return Path(config_path) if config_path else Path.cwd() / "callqw-config.json"
+
+
+def daemon_socket_path(config_path=None, config=None):
+    """根据配置解析守护进程 socket 路径，相对路径基于配置文件所在目录"""
+    config_path = default_config_path(config_path)
+    if config is None:
+        config = {}
+        if config_path.exists():
+            try:
+                with open(config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except Exception:
+                config = {}
+    value = config.get("daemon_socket") or ConfigManager.DEFAULT_CONFIG["daemon_socket"]
+    path = Path(value)
+    return path if path.is_absolute() else config_path.parent / path
+
+
+class _SocketStream:
+    """把写入内容按 JSON 行帧转发到客户端的类文件对象"""
+
+    encoding = "utf-8"
+
+    def __init__(self, conn, channel):
+        self.conn = conn
+        self.channel = channel
+
+    def write(self, text):
+        if text:
+            frame = json.dumps({self.channel: text}, ensure_ascii=False) + "\n"
+            self.conn.sendall(frame.encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class BridgeDaemon:
+    """常驻的桥接守护进程
+
+    启动时构建一次 QwenBridge（配置、日志、上下文索引）并监听本地 Unix socket。
+    每个客户端连接由 fork 出的子进程处理，子进程直接继承已预热的桥接器，
+    输出按 JSON 行帧实时转发回客户端，并发请求互不阻塞。
+    """
+
+    def __init__(self, config_path=None, socket_path=None):
+        self.config_path = config_path
+        self.bridge = QwenBridge(config_path=config_path)
+        self.socket_path = Path(socket_path) if socket_path else daemon_socket_path(
+            config_path, self.bridge.config)
+        self.config_mtime = self._config_mtime()
+        self.parser = build_parser()
+        self.children = set()
+        # 已交给子进程的预热进程，由守护进程负责回收
+        self.handed_workers = []
+
+    def _config_mtime(self):
+        path = self.bridge.config_manager.config_path
+        return path.stat().st_mtime if path.exists() else None
+
+    def _warm_up(self):
+        """预先完成日志配置、上下文索引同步和执行所需模块的导入"""
+        import asyncio  # noqa: F401  fork 出的子进程直接复用已导入的模块
+        import subprocess  # noqa: F401
+        self.bridge.setup_logging()
+        len(self.bridge.context_store)
+        self.bridge.enable_worker_pool()
+
+    def _reap_children(self):
+        for pid in list(self.children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                self.children.discard(pid)
+        self.handed_workers = [worker for worker in self.handed_workers if worker.process.poll() is None]
+
+    def _reload_if_changed(self):
+        """配置文件被修改后重新构建桥接器"""
+        mtime = self._config_mtime()
+        if mtime != self.config_mtime:
+            if self.bridge.worker_pool is not None:
+                self.bridge.worker_pool.shutdown()
+            self.bridge = QwenBridge(config_path=self.config_path)
+            self._warm_up()
+            self.config_mtime = mtime
+            self.bridge.logger.info(f"配置文件已变更，守护进程重新加载: {self.bridge.config_manager.config_path}")
+
+    def _read_request(self, conn):
+        """读取客户端请求（一行 JSON）；客户端连接后立即发送，设置超时避免阻塞守护进程"""
+        conn.settimeout(5.0)
+        try:
+            return json.loads(conn.makefile("rb").readline().decode("utf-8"))
+        except (OSError, ValueError):
+            return None
+        finally:
+            conn.settimeout(None)
+
+    def _worker_command(self, request):
+        """根据请求参数预测将要执行的 CLI 命令行（不含提示词），用于从预热进程池中取出匹配的进程"""
+        config = self.bridge.config
+        mode = "ask"
+        dev_mode = config.get("default_dev_mode", False)
+        argv = request.get("argv", [])
+        try:
+            args, _ = self.parser.parse_known_args(argv)
+            dev_mode = args.dev_mode or dev_mode
+            agent_mode = args.mode == "agent" or (args.mode is None and config.get("default_agent_mode", False))
+            mode = "agent" if agent_mode else "ask"
+        except SystemExit:
+            pass
+        return self.bridge.build_command(None, mode, dev_mode)
+
+    def _watch_peer(self, conn, finished):
+        """在子进程中监视客户端连接：客户端在请求完成前断开（如 Ctrl-C）时终止 Qwen 进程组，
+        并向主线程发送 SIGINT 取消调用
+        """
+        import signal
+
+        def watch():
+            try:
+                while conn.recv(4096):
+                    pass
+            except OSError:
+                pass
+            if finished.is_set():
+                return
+            self.bridge.logger.warning(self.bridge.get_ui_text("daemon_client_gone"))
+            self.bridge.kill_children()
+            os.kill(os.getpid(), signal.SIGINT)
+        threading.Thread(target=watch, name="callqw-peer", daemon=True).start()
+
+    def _handle(self, conn, request):
+        """在子进程中处理一个客户端请求，返回退出码"""
+        if request is None:
+            return 1
+        if Path(request.get("cwd", "")) != self.bridge.work_dir:
+            # 工作目录不同，让客户端回退到进程内执行
+            conn.sendall(b'{"fallback": true}\n')
+            return 0
+        finished = threading.Event()
+        self._watch_peer(conn, finished)
+        sys.stdout = _SocketStream(conn, "o")
+        sys.stderr = _SocketStream(conn, "e")
+        code = 1
+        try:
+            args = self.parser.parse_args(request.get("argv", []))
+            code = self.bridge.run(args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except KeyboardInterrupt:
+            # 客户端已断开，调用被取消
+            code = 130
+        except Exception:
+            import traceback
+            sys.stderr.write(traceback.format_exc())
+        finally:
+            finished.set()
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        try:
+            conn.sendall((json.dumps({"exit": code}) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+        # 子进程以 os._exit 退出，需先等待日志归档和上下文压缩完成
+        self.bridge.log_rotator.wait()
+        self.bridge.wait_for_compaction()
+        return code
+
+    def serve_forever(self, english_ui=False):
+        """监听 socket 并处理请求，直到收到 Ctrl-C 或 SIGTERM"""
+        import socket
+        if not hasattr(socket, "AF_UNIX") or not hasattr(os, "fork"):
+            self.bridge.colors.print_colored(self.bridge.get_ui_text("daemon_unsupported", english_ui), "red")
+            return 1
+        if self.socket_path.exists():
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.socket_path))
+                self.bridge.colors.print_colored(
+                    self.bridge.get_ui_text("daemon_in_use", english_ui).format(self.socket_path), "red")
+                return 1
+            except OSError:
+                # 上次异常退出留下的 socket 文件
+                self.socket_path.unlink()
+            finally:
+                probe.close()
+
+        import signal
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        self._warm_up()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(self.socket_path))
+        os.chmod(self.socket_path, 0o600)
+        server.listen(64)
+        server.settimeout(1.0)
+        listening = self.bridge.get_ui_text("daemon_listening", english_ui).format(self.socket_path)
+        self.bridge.logger.info(listening)
+        self.bridge.colors.print_colored(listening, "green")
+        try:
+            while True:
+                self._reap_children()
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                self._reload_if_changed()
+                request = self._read_request(conn)
+                # 预热进程池：把与请求命令行匹配的就绪进程交给子进程
+                pool = self.bridge.worker_pool
+                worker_cmd = None
+                worker = None
+                if pool is not None and request is not None:
+                    worker_cmd = self._worker_command(request)
+                    worker = pool.take(worker_cmd)
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    if pool is not None:
+                        pool.adopt(worker)
+                    code = 1
+                    try:
+                        code = self._handle(conn, request)
+                    except Exception:
+                        pass
+                    finally:
+                        conn.close()
+                        os._exit(code if isinstance(code, int) else 1)
+                self.children.add(pid)
+                conn.close()
+                if worker is not None:
+                    # 关闭守护进程中的管道副本，子进程关闭 stdin 时 CLI 才能读到 EOF
+                    worker.close()
+                    self.handed_workers.append(worker)
+                if worker_cmd is not None:
+                    pool.prime(worker_cmd)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if self.bridge.worker_pool is not None:
+                self.bridge.worker_pool.shutdown()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            stopped = self.bridge.get_ui_text("daemon_stopped", english_ui)
+            self.bridge.logger.info(stopped)
+            self.bridge.colors.print_colored(stopped, "green")
+        return 0
+
+
+def forward_to_daemon(argv, config_path=None):
+    """把命令行参数转发给正在运行的守护进程
+
+    返回退出码；没有可用的守护进程（或守护进程要求回退）时返回 None，
+    由调用方在进程内执行。
+    """
+    path = daemon_socket_path(config_path)
+    if not path.exists():
+        return None
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(path))
+    except OSError:
+        client.close()
+        return None
+    with client:
+        request = {"argv": argv, "cwd": str(Path.cwd())}
+        try:
+            client.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+            with client.makefile("rb") as frames:
+                for line in frames:
+                    frame = json.loads(line.decode("utf-8"))
+                    if "o" in frame:
+                        sys.stdout.write(frame["o"])
+                        sys.stdout.flush()
+                    elif "e" in frame:
+                        sys.stderr.write(frame["e"])
+                        sys.stderr.flush()
+                    elif "exit" in frame:
+                        return frame["exit"]
+                    elif frame.get("fallback"):
+                        return None
+        except KeyboardInterrupt:
+            # 关闭连接后守护进程的子进程会终止正在执行的 Qwen 进程组
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return 130
+    english_ui = "--english-ui" in argv
+    print(Colors().colorize(UI_TEXTS["en" if english_ui else "zh"]["daemon_disconnected"], "red"))
+    return 1
+
+
+class BatchRunner:
+    """并发执行 JSONL 文件中的多条请求
+
+    每行一个 JSON 对象：message（或 prompt）、可选的 mode、session 和 id。
+    请求由有界线程池并发执行，最多只有 2 倍并发数的请求处于已读取未完成状态，
+    输入文件再大也不会一次性读入内存。
+    """
+
+    def __init__(self, bridge, concurrency=4, order="input", use_context=True,
+                 dev_mode=False, english_ui=False):
+        self.bridge = bridge
+        self.concurrency = max(1, concurrency)
+        self.order = order
+        self.use_context = use_context
+        self.dev_mode = dev_mode
+        self.english_ui = english_ui
+        self.record_lock = threading.Lock()
+
+    @staticmethod
+    def parse_item(line):
+        """解析一行请求，返回请求字典；格式错误时抛出 ValueError"""
+        item = json.loads(line)
+        if not isinstance(item, dict):
+            raise ValueError("request must be a JSON object")
+        message = item.get("message") or item.get("prompt")
+        if not message:
+            raise ValueError("missing 'message'")
+        if not isinstance(message, str):
+            raise ValueError("'message' must be a string")
+        mode = item.get("mode") or "ask"
+        if mode not in ("ask", "agent"):
+            raise ValueError(f"invalid mode: {mode}")
+        session = item.get("session")
+        if session:
+            ContextShard.validate(str(session))
+        return {"id": item.get("id"), "message": message, "mode": mode, "session": session}
+
+    @staticmethod
+    def item_id(line):
+        """从格式错误的请求中尽量取出 id，取不到时返回 None"""
+        try:
+            item = json.loads(line)
+        except ValueError:
+            return None
+        return item.get("id") if isinstance(item, dict) else None
+
+    def run_item(self, index, line):
+        """执行单条请求，返回结果记录；单条请求的任何错误都转换为 status 为 error 的记录"""
+        record = {"index": index}
+        started = datetime.now()
+        try:
+            item = self.parse_item(line)
+        except ValueError as e:
+            record.update(id=self.item_id(line), status="error",
+                          output=self.bridge.get_ui_text("batch_invalid_item", self.english_ui).format(e),
+                          returncode=None, duration=0.0, first_output=None)
+            return record
+        record.update(id=item["id"], mode=item["mode"], session=item["session"])
+        try:
+            result = self.execute_item(item, batch=True)
+        except Exception as e:
+            # 未预料的错误只影响这一条请求，不让它从线程池中抛出而中断整个批处理
+            error_text = self.bridge.get_ui_text("batch_item_error", self.english_ui).format(e)
+            self.bridge.logger.error(error_text)
+            record.update(status="error", output=error_text, returncode=None,
+                          started_at=started.strftime("%Y-%m-%d %H:%M:%S"),
+                          duration=round((datetime.now() - started).total_seconds(), 3), first_output=None)
+            return record
+        record.update(
+            status="ok" if result.ok else "error",
+            output=result.output,
+            returncode=result.returncode,
+            started_at=started.strftime("%Y-%m-%d %H:%M:%S"),
+            duration=round(result.duration, 3),
+            first_output=None if result.first_output is None else round(result.first_output, 3),
         )
-        
-        # 显示响应
-        if dev_mode:
-            print("\n" + "="*60)
-            response_title = self.get_ui_text("qwen_response", english_ui)
-            self.colors.print_colored(response_title, "blue")
-            print("="*60)
-            self.colors.print_colored(response, "blue")
+        result.close()
+        return record
+
+    def execute_item(self, item, **fields):
+        """执行一条已解析的请求，写入日志、上下文记忆和指标（附加 fields），返回 QwenResult（由调用方关闭）"""
+        # 每条请求使用自己的会话分片，未指定 session 时使用默认会话
+        session = str(item["session"]) if item["session"] else ""
+        metrics = self.bridge.new_metrics(item["mode"])
+        if session:
+            metrics.update(session=session)
+        if self.use_context:
+            prompt, _, context_stats = self.bridge.build_prompt(item["message"], item["mode"], self.english_ui,
+                                                                session=session)
+            metrics.add_span("context_read", context_stats["read_seconds"])
+            metrics.add_span("context_assembly", context_stats["assembly_seconds"])
         else:
-            # 非开发者模式：简洁输出，只显示 "Qwen Code:" 前缀
-            qwen_title = self.get_ui_text("qwen_code", english_ui)
-            self.colors.print_colored(qwen_title, "blue")
-            self.colors.print_colored(response, "blue")
-        
-        # 记录日志
-        self.log_conversation("agent" if agent_mode else "ask", message, response, english_ui)
-        self.update_context_memory(message, response, english_ui)
-        
-        # 显示完成信息
+            prompt = item["message"]
+        metrics.update(prompt_chars=len(prompt), prompt_bytes=len(prompt.encode("utf-8")), **fields)
+        result = self.bridge.execute(prompt, item["mode"], english_ui=self.english_ui)
+        with self.record_lock, metrics.span("write"):
+            self.bridge.record_result(item["mode"], item["message"], result, self.english_ui,
+                                      session=session, context=self.use_context, **fields)
+        metrics.add_result(result)
+        self.bridge.record_metrics(metrics)
+        return result
+
+    def run(self, input_path, output_path):
+        """执行整个批处理文件，返回 (成功数, 失败数)"""
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        with open(input_path, "r", encoding="utf-8") as f:
+            total = sum(1 for line in f if line.strip())
+        succeeded = failed = done = 0
+        pending_output = {}
+        next_index = 0
+
+        with open(input_path, "r", encoding="utf-8") as source, \
+                open(output_path, "w", encoding="utf-8") as sink, \
+                ThreadPoolExecutor(max_workers=self.concurrency, initializer=self.bridge.profile_thread) as pool:
+
+            def emit(record):
+                sink.write(json.dumps(record, ensure_ascii=False) + "\n")
+                sink.flush()
+
+            def collect(futures):
+                nonlocal succeeded, failed, done, next_index
+                for future in futures:
+                    record = future.result()
+                    done += 1
+                    if record["status"] == "ok":
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    if self.dev_mode:
+                        text = self.bridge.get_ui_text("batch_item_done", self.english_ui).format(
+                            done, total, record["index"], record["status"], record["duration"])
+                        self.bridge.colors.print_colored(text, "green" if record["status"] == "ok" else "red")
+                    if self.order == "completion":
+                        emit(record)
+                    else:
+                        pending_output[record["index"]] = record
+                        while next_index in pending_output:
+                            emit(pending_output.pop(next_index))
+                            next_index += 1
+
+            in_flight = set()
+            index = 0
+            for line in source:
+                if not line.strip():
+                    continue
+                # 背压：在途请求达到上限时先等待部分完成，再继续读取输入
+                while len(in_flight) >= self.concurrency * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                in_flight.add(pool.submit(self.run_item, index, line))
+                index += 1
+            while in_flight:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished)
+        return succeeded, failed
+
+
+class DirectoryWatcher:
+    """等待目录中出现新文件：Linux 上通过 ctypes 使用 inotify，其他平台按间隔检查目录的修改时间
+
+    轮询时每次只 stat 目录本身，目录内容变化（新增、移入、删除文件）时才需要重新列出目录。
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path, poll_interval=0.5, use_inotify=True):
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self.fd = None
+        self._mtime = None
+        if use_inotify and sys.platform.startswith("linux"):
+            self.fd = self._inotify()
+
+    def _inotify(self):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(str(self.path)), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    @property
+    def mechanism(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def wait(self, timeout):
+        """等待目录变化，最多 timeout 秒；返回目录中是否可能有新文件"""
+        if self.fd is not None:
+            import select
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return False
+            # 事件只用于唤醒，读空队列后由调用方重新列出目录
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                mtime = self.path.stat().st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class InboxWatcher:
+    """监视收件目录，用线程池处理放入其中的请求文件
+
+    目录结构：inbox/ 待处理，processing/ 处理中，outbox/ 回应，done/ 与 failed/ 已完成的请求。
+    请求文件为 .json（与 batch 的一行格式相同）或纯文本（整个文件是一条 ask 消息），
+    以 . 开头或以 .tmp 结尾的文件会被忽略，写入方应先写临时文件再重命名到 inbox/。
+
+    认领请求是一次 rename（多个监视进程同时运行时只有一个成功），随后在 processing/
+    写入 <文件名>.claim 记录认领者和处理次数。每个监视进程在运行期间持有自己的文件锁，
+    并定期更新认领文件的修改时间：认领者的锁可以被取得（进程已退出），或认领文件超过
+    stale_seconds 没有更新时，请求由其他监视进程接管；处理次数达到 max_attempts 时移入 failed/。
+    回应先写入 outbox/ 中的临时文件，完成后原子地重命名。
+    """
+
+    DIRECTORIES = ("inbox", "processing", "outbox", "done", "failed")
+    CLAIM_SUFFIX = ".claim"
+
+    def __init__(self, bridge, root, concurrency=4, poll_interval=0.5, stale_seconds=60.0, max_attempts=3,
+                 use_context=True, dev_mode=False, english_ui=False):
+        import socket
+        self.bridge = bridge
+        self.root = Path(root)
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.dev_mode = dev_mode
+        self.english_ui = english_ui
+        self.runner = BatchRunner(bridge, self.concurrency, use_context=use_context,
+                                  dev_mode=dev_mode, english_ui=english_ui)
+        for name in self.DIRECTORIES:
+            setattr(self, name, self.root / name)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.owner_lock = FileLock(self.root / ".watchers" / f"{self.owner}.lock")
+        self.recovery_lock = FileLock(self.root / ".watchers" / "recovery.lock")
+        self.active = set()
+        self.counts = {"done": 0, "failed": 0}
+        self._counts_lock = threading.Lock()
+
+    @staticmethod
+    def is_request(name):
+        return not name.startswith(".") and not name.endswith((".tmp", InboxWatcher.CLAIM_SUFFIX))
+
+    def pending(self):
+        """inbox/ 中等待处理的请求文件名，按修改时间先后排列"""
+        entries = []
+        for entry in os.scandir(str(self.inbox)):
+            if not self.is_request(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    entries.append((entry.stat().st_mtime, entry.name))
+            except OSError:
+                continue
+        return [name for _, name in sorted(entries)]
+
+    def _claim_path(self, name):
+        return self.processing / (name + self.CLAIM_SUFFIX)
+
+    def _write_claim(self, name, attempts):
+        claim = self._claim_path(name)
+        tmp = claim.with_name(f".{claim.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"owner": self.owner, "claimed": time.time(), "attempts": attempts}),
+                       encoding="utf-8")
+        os.replace(tmp, claim)
+
+    def claim(self, name):
+        """把请求从 inbox/ 移到 processing/；被其他监视进程抢先认领时返回 False"""
+        try:
+            os.rename(self.inbox / name, self.processing / name)
+        except FileNotFoundError:
+            return False
+        self._write_claim(name, 1)
+        return True
+
+    def heartbeat(self):
+        """更新处理中请求的认领文件修改时间"""
+        for name in list(self.active):
+            try:
+                os.utime(self._claim_path(name))
+            except OSError:
+                pass
+
+    def _owner_alive(self, owner):
+        """认领者是否仍在运行：能取得它的文件锁说明进程已退出，顺便清理遗留的锁文件"""
+        if owner == self.owner:
+            return True
+        lock = FileLock(self.root / ".watchers" / f"{owner}.lock")
+        if not lock.path.exists():
+            return False
+        if not lock.acquire(blocking=False):
+            return True
+        try:
+            lock.path.unlink()
+        except OSError:
+            pass
+        finally:
+            lock.release()
+        return False
+
+    def stale_claims(self):
+        """接管已中断的请求，返回 [(文件名, 处理次数)]"""
+        recovered = []
+        with self.recovery_lock:
+            now = time.time()
+            for entry in os.scandir(str(self.processing)):
+                name = entry.name
+                if not self.is_request(name) or name in self.active:
+                    continue
+                claim = self._claim_path(name)
+                try:
+                    info = json.loads(claim.read_text(encoding="utf-8"))
+                    updated = claim.stat().st_mtime
+                except (OSError, ValueError):
+                    # 认领后、写入认领文件前中断：按请求文件移入的时间判断
+                    info = {}
+                    try:
+                        updated = entry.stat().st_ctime
+                    except OSError:
+                        continue
+                stale = now - updated > self.stale_seconds
+                if not stale and info.get("owner") and not self._owner_alive(info["owner"]):
+                    stale = True
+                if not stale:
+                    continue
+                attempts = info.get("attempts", 1) + 1
+                self._write_claim(name, attempts)
+                recovered.append((name, attempts))
+        return recovered
+
+    def _write_outbox(self, name, chunks, suffix):
+        target = self.outbox / (Path(name).stem + suffix)
+        tmp = self.outbox / f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for text in chunks:
+                f.write(text)
+        os.replace(tmp, target)
+        return target
+
+    def _finish(self, name, ok, record, chunks):
+        """写入回应并把请求移入 done/ 或 failed/"""
+        if name.endswith(".json"):
+            record["status"] = "ok" if ok else "error"
+            record["output"] = "".join(chunks)
+            self._write_outbox(name, [json.dumps(record, ensure_ascii=False)], ".json")
+        else:
+            self._write_outbox(name, chunks, ".txt" if ok else ".error.txt")
+        os.replace(self.processing / name, (self.done if ok else self.failed) / name)
+        try:
+            self._claim_path(name).unlink()
+        except FileNotFoundError:
+            pass
+        with self._counts_lock:
+            self.counts["done" if ok else "failed"] += 1
+        if self.dev_mode:
+            text = self.bridge.get_ui_text("watch_item_done", self.english_ui).format(
+                name, "ok" if ok else "error", record.get("duration", 0.0))
+            self.bridge.colors.print_colored(text, "green" if ok else "red")
+
+    def process(self, name, attempts=1):
+        """处理一个已认领的请求"""
+        path = self.processing / name
+        record = {"request": name, "attempts": attempts}
+        try:
+            if attempts > self.max_attempts:
+                raise ValueError(self.bridge.get_ui_text("watch_too_many_attempts", self.english_ui).format(
+                    attempts - 1))
+            text = path.read_text(encoding="utf-8")
+            if name.endswith(".json"):
+                item = BatchRunner.parse_item(text)
+            else:
+                if not text.strip():
+                    raise ValueError("empty request")
+                item = {"id": None, "message": text.strip(), "mode": "ask", "session": None}
+        except (OSError, ValueError) as e:
+            self._finish(name, False, record, [self.bridge.get_ui_text("batch_invalid_item", self.english_ui).format(e)])
+            return
+        record.update(id=item["id"], mode=item["mode"], session=item["session"])
+        started = time.monotonic()
+        try:
+            result = self.runner.execute_item(item, watch=True)
+        except Exception as e:
+            # 请求本身引发的错误重试也会同样失败，直接移入 failed/
+            error_text = self.bridge.get_ui_text("batch_item_error", self.english_ui).format(e)
+            self.bridge.logger.error(error_text)
+            record.update(returncode=None, duration=round(time.monotonic() - started, 3), first_output=None)
+            self._finish(name, False, record, [error_text])
+            return
+        try:
+            record.update(returncode=result.returncode, duration=round(result.duration, 3),
+                          first_output=None if result.first_output is None else round(result.first_output, 3))
+            self._finish(name, result.ok, record, result.chunks())
+        finally:
+            result.close()
+
+    def _process(self, name, attempts):
+        try:
+            self.process(name, attempts)
+        except Exception as e:
+            # 未预料的错误只记录日志，请求留在 processing/ 中，超时后重试
+            self.bridge.logger.error(self.bridge.get_ui_text("watch_error", self.english_ui).format(name, e))
+        finally:
+            self.active.discard(name)
+
+    def status(self):
+        """各目录中的文件数（队列深度）"""
+        counts = {}
+        for name in self.DIRECTORIES:
+            try:
+                counts[name] = sum(1 for entry in os.scandir(str(getattr(self, name))) if self.is_request(entry.name))
+            except OSError:
+                counts[name] = 0
+        return counts
+
+    def write_status(self):
+        """把队列深度写入 <目录>/status.json，供写入请求的一方查看"""
+        status = self.status()
+        status.update(owner=self.owner, active=len(self.active), updated=datetime.now().isoformat(timespec="seconds"))
+        tmp = self.root / f".status.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(status, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.root / "status.json")
+
+    def run(self, once=False):
+        """监视并处理请求；once 为 True 时处理完当前积压的请求后返回。返回 (成功数, 失败数)"""
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        for name in self.DIRECTORIES:
+            getattr(self, name).mkdir(parents=True, exist_ok=True)
+        self.owner_lock.acquire()
+        # 清理已退出的监视进程留下的锁文件
+        for entry in os.scandir(str(self.owner_lock.path.parent)):
+            if entry.name.endswith(".lock") and entry.name != self.recovery_lock.path.name:
+                self._owner_alive(entry.name[:-len(".lock")])
+        watcher = DirectoryWatcher(self.inbox, self.poll_interval)
+        in_flight = set()
+        started_text = self.bridge.get_ui_text("watch_started", self.english_ui).format(
+            self.inbox, watcher.mechanism, self.concurrency)
+        self.bridge.logger.info(started_text)
+        if not once:
+            self.bridge.colors.print_colored(started_text, "green")
+
+        def submit(name, attempts):
+            self.active.add(name)
+            in_flight.add(pool.submit(self._process, name, attempts))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                last_check = 0.0
+                changed = True
+                while True:
+                    now = time.monotonic()
+                    if now - last_check >= min(self.poll_interval * 4, self.stale_seconds / 3):
+                        self.heartbeat()
+                        for name, attempts in self.stale_claims():
+                            submit(name, attempts)
+                        last_check = now
+                    backlog = False
+                    if changed:
+                        for name in self.pending():
+                            if len(in_flight) >= self.concurrency:
+                                backlog = True
+                                break
+                            if self.claim(name):
+                                submit(name, 1)
+                    self.write_status()
+                    if once and not in_flight and not backlog:
+                        break
+                    if len(in_flight) >= self.concurrency or (once and in_flight):
+                        finished, in_flight = wait(in_flight, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                        # 有请求完成时重新列出 inbox/，继续认领积压的请求
+                        changed = bool(finished) or watcher.wait(0)
+                    else:
+                        changed = watcher.wait(self.poll_interval)
+                        in_flight = {future for future in in_flight if not future.done()}
+        finally:
+            watcher.close()
+            try:
+                self.owner_lock.path.unlink()
+            except OSError:
+                pass
+            self.owner_lock.release()
+        return self.counts["done"], self.counts["failed"]
+
+
+class MapRunner:
+    """把同一条指令分发到一组文件上：按提示词预算把文件分块，有界并发地调用 Qwen，汇总为一份报告
+
+    超过预算的文件按行拆成多段。每个成功分块的回应保存在状态目录中，文件名为分块提示词的
+    摘要：中断或部分失败后重新运行相同的命令时，已成功的分块直接复用，内容有变化的分块
+    重新调用。全部分块成功后删除状态目录。
+    """
+
+    def __init__(self, bridge, instruction, mode="ask", budget=24000, concurrency=4, state_dir=None,
+                 use_cache=True, dev_mode=False, english_ui=False):
+        self.bridge = bridge
+        self.instruction = instruction
+        self.mode = mode
+        self.budget = budget
+        self.concurrency = max(1, concurrency)
+        self.state_dir = Path(state_dir) if state_dir else None
+        self.use_cache = use_cache
+        self.dev_mode = dev_mode
+        self.english_ui = english_ui
+        self.rules = bridge.get_mode_rules(mode)
+        self.measure = bridge.context_assembler.measure
+
+    @staticmethod
+    def collect_files(patterns, root):
+        """按 glob 模式（支持 **）收集 root 下的文件，去重后按路径排序"""
+        files = set()
+        for pattern in patterns:
+            files.update(path for path in Path(root).glob(pattern) if path.is_file())
+        return sorted(files)
+
+    @staticmethod
+    def read_text(path):
+        """读取文本文件；二进制或无法读取的文件返回 None"""
+        try:
+            data = Path(path).read_bytes()
+        except OSError:
+            return None
+        if b"\0" in data[:8192]:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def available(self):
+        """每个分块中可用于文件内容的预算"""
+        return max(1, self.budget - self.measure(self.rules) - self.measure(self.instruction))
+
+    def file_blocks(self, name, text):
+        """把一个文件格式化为提示词片段 [(标签, 片段)]；超过预算的文件按行拆成多段"""
+        available = self.available()
+        parts = []
+        current, size = [], 0
+        for line in text.splitlines(keepends=True):
+            line_size = self.measure(line)
+            if current and size + line_size > available:
+                parts.append(current)
+                current, size = [], 0
+            current.append(line)
+            size += line_size
+        parts.append(current)
+        blocks = []
+        start = 1
+        for part in parts:
+            end = start + len(part) - 1
+            label = name if len(parts) == 1 else f"{name}:{start}-{end}"
+            body = "".join(part)
+            if not body.endswith("\n"):
+                body += "\n"
+            blocks.append((label, f"### {label}\n```\n{body}```\n"))
+            start = end + 1
+        return blocks
+
+    def plan(self, files, root):
+        """把文件分成不超过预算的分块，返回 [[(标签, 片段), ...], ...]"""
+        available = self.available()
+        chunks = []
+        current, size = [], 0
+        for path in files:
+            text = self.read_text(path)
+            if text is None:
+                continue
+            name = Path(os.path.relpath(str(path), str(root))).as_posix()
+            for label, block in self.file_blocks(name, text):
+                block_size = self.measure(block)
+                if current and size + block_size > available:
+                    chunks.append(current)
+                    current, size = [], 0
+                current.append((label, block))
+                size += block_size
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def prompt(self, chunk):
+        parts = [self.rules] if self.rules else []
+        parts.append(self.instruction)
+        parts.append("".join(block for _, block in chunk))
+        return "\n\n".join(parts)
+
+    def _state_path(self, prompt):
+        import hashlib
+        digest = hashlib.sha1(f"{self.mode}\0{prompt}".encode("utf-8")).hexdigest()
+        return self.state_dir / f"{digest}.md" if self.state_dir else None
+
+    async def _run(self, chunks):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        outcomes = [None] * len(chunks)
+
+        async def call(index, chunk):
+            labels = [label for label, _ in chunk]
+            prompt = self.prompt(chunk)
+            state_path = self._state_path(prompt)
+            if state_path is not None and state_path.exists():
+                outcomes[index] = {"labels": labels, "ok": True, "reused": True, "path": state_path}
+                return
+            async with semaphore:
+                metrics = self.bridge.new_metrics(self.mode)
+                metrics.update(map=True, prompt_chars=len(prompt), prompt_bytes=len(prompt.encode("utf-8")))
+                result = await self.bridge.aexecute(prompt, self.mode, english_ui=self.english_ui,
+                                                    use_cache=self.use_cache)
+            metrics.add_result(result)
+            self.bridge.record_metrics(metrics)
+            outcome = {"labels": labels, "ok": result.ok, "reused": False, "duration": result.duration}
+            try:
+                if result.ok and state_path is not None:
+                    state_path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = state_path.with_name(f".{state_path.name}.{os.getpid()}.tmp")
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        for text in result.chunks():
+                            f.write(text)
+                    os.replace(tmp, state_path)
+                    outcome["path"] = state_path
+                else:
+                    outcome["output"] = result.output
+            finally:
+                result.close()
+            outcomes[index] = outcome
+            if self.dev_mode:
+                text = self.bridge.get_ui_text("map_chunk_done", self.english_ui).format(
+                    index + 1, len(chunks), "ok" if result.ok else "error", result.duration, ", ".join(labels))
+                self.bridge.colors.print_colored(text, "green" if result.ok else "red")
+
+        await asyncio.gather(*(call(index, chunk) for index, chunk in enumerate(chunks)))
+        return outcomes
+
+    def run(self, chunks):
+        """执行所有分块，返回每个分块的结果 {"labels", "ok", "reused", "path" 或 "output"}"""
+        import asyncio
+        return asyncio.run(self._run(chunks))
+
+    @staticmethod
+    def outcome_chunks(outcome, size=65536):
+        """逐块读取一个分块的回应（成功时从状态文件读取）"""
+        if "path" not in outcome:
+            yield outcome.get("output") or ""
+            return
+        with open(outcome["path"], "r", encoding="utf-8") as f:
+            while True:
+                text = f.read(size)
+                if not text:
+                    return
+                yield text
+
+    def report_chunks(self, outcomes):
+        """逐块产出汇总报告（Markdown）"""
+        ui = self.bridge.get_ui_text
+        failed = sum(1 for outcome in outcomes if not outcome["ok"])
+        yield f"# {self.instruction}\n\n"
+        yield ui("map_report_summary", self.english_ui).format(len(outcomes), len(outcomes) - failed, failed) + "\n"
+        for index, outcome in enumerate(outcomes):
+            status = "" if outcome["ok"] else " " + ui("map_report_failed", self.english_ui)
+            yield f"\n## {index + 1}/{len(outcomes)}{status}: {', '.join(outcome['labels'])}\n\n"
+            tail = ""
+            for text in self.outcome_chunks(outcome):
+                if text:
+                    tail = text[-1]
+                    yield text
+            if tail != "\n":
+                yield "\n"
+
+    def finish(self, outcomes, output_path):
+        """写入汇总报告；全部分块成功时删除状态目录"""
+        import shutil
+        output_path = Path(output_path)
+        tmp = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for text in self.report_chunks(outcomes):
+                f.write(text)
+        os.replace(tmp, output_path)
+        if self.state_dir is not None and all(outcome["ok"] for outcome in outcomes):
+            shutil.rmtree(str(self.state_dir), ignore_errors=True)
+
+
+class ReplayRunner:
+    """按对话日志中的真实请求回放负载，统计延迟分位数、吞吐量和错误率
+
+    请求按日志中的时间间隔（除以 speed）发出，speed 为 0 时不等待、只受并发数限制；
+    空闲间隔最长按 max_gap 秒计算。并发数已满时请求推迟发出，推迟的时间记为开始延后。
+    回放不写入对话日志、上下文记忆和指标文件。
+    """
+
+    HEADER_PATTERN = re.compile(r"^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] (?:模式|Mode): (\w+)$")
+    USER_PATTERN = re.compile(r"^(?:用户|User)/Leader Agent: ?(.*)$")
+    SEPARATOR = "-" * 50
+
+    def __init__(self, bridge, concurrency=4, speed=1.0, max_gap=60.0, use_context=True, use_cache=False,
+                 backend=None, dev_mode=False, english_ui=False):
+        self.bridge = bridge
+        self.concurrency = max(1, concurrency)
+        self.speed = speed
+        self.max_gap = max_gap
+        self.use_context = use_context
+        self.use_cache = use_cache
+        self.backend = backend
+        self.dev_mode = dev_mode
+        self.english_ui = english_ui
+
+    @classmethod
+    def parse_log(cls, lines):
+        """从对话日志的行中解析请求，产出 {"ts", "mode", "message", "session"}
+
+        支持文本格式的对话日志（条目以分隔线结束，消息可以有多行）和每行一个 JSON 对象的
+        结构化日志（字段 ts、mode、message、可选的 session）。
+        """
+        header = None
+        message = None
+        previous = cls.SEPARATOR
+        for line in lines:
+            if line.startswith("{"):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if isinstance(record, dict) and record.get("message") and record.get("ts"):
+                    try:
+                        ts = datetime.fromisoformat(record["ts"])
+                    except (TypeError, ValueError):
+                        continue
+                    yield {"ts": ts, "mode": record.get("mode") or "ask", "message": record["message"],
+                           "session": record.get("session") or ""}
+                    continue
+            if message is not None:
+                if line.startswith("Qwen: ") or line == cls.SEPARATOR:
+                    yield {"ts": header[0], "mode": header[1], "message": "\n".join(message), "session": ""}
+                    header = message = None
+                else:
+                    message.append(line)
+            elif header is not None:
+                match = cls.USER_PATTERN.match(line)
+                message = [match.group(1)] if match else None
+                header = header if match else None
+            elif previous == cls.SEPARATOR:
+                match = cls.HEADER_PATTERN.match(line)
+                if match:
+                    header = (datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"), match.group(2))
+            previous = line
+        if message is not None:
+            yield {"ts": header[0], "mode": header[1], "message": "\n".join(message), "session": ""}
+
+    def build_prompt(self, request):
+        if not self.use_context:
+            return request["message"]
+        return self.bridge.build_prompt(request["message"], request["mode"], self.english_ui,
+                                        session=request["session"])[0]
+
+    async def _replay(self, requests, sink):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        records = []
+        tasks = set()
+        started = time.monotonic()
+
+        async def call(index, request, scheduled):
+            try:
+                begin = time.monotonic()
+                result = await self.bridge.aexecute(self.build_prompt(request), request["mode"],
+                                                    english_ui=self.english_ui, use_cache=self.use_cache,
+                                                    backend=self.backend)
+                record = {
+                    "index": index,
+                    "ts": request["ts"].isoformat(),
+                    "mode": request["mode"],
+                    "status": "ok" if result.ok else "error",
+                    "returncode": result.returncode,
+                    "latency": round(time.monotonic() - begin, 3),
+                    "first_output": None if result.first_output is None else round(result.first_output, 3),
+                    "lag": round(max(0.0, begin - scheduled), 3),
+                    "response_bytes": result.output_bytes,
+                }
+                result.close()
+            finally:
+                semaphore.release()
+            records.append(record)
+            if sink is not None:
+                sink.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if self.dev_mode:
+                text = self.bridge.get_ui_text("replay_item_done", self.english_ui).format(
+                    index, record["status"], record["latency"], record["lag"])
+                self.bridge.colors.print_colored(text, "green" if result.ok else "red")
+
+        offset = 0.0
+        previous = None
+        for index, request in enumerate(requests):
+            if previous is not None and self.speed > 0:
+                gap = max(0.0, (request["ts"] - previous).total_seconds())
+                offset += min(gap, self.max_gap) / self.speed if self.max_gap else gap / self.speed
+            previous = request["ts"]
+            scheduled = started + offset
+            await asyncio.sleep(max(0.0, scheduled - time.monotonic()))
+            # 并发数已满时在这里等待，日志再长也只有 concurrency 个请求在途
+            await semaphore.acquire()
+            task = asyncio.ensure_future(call(index, request, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        return records, time.monotonic() - started
+
+    def run(self, requests, output_path=None):
+        """回放请求并返回统计报告；指定 output_path 时把每条请求的结果写入 JSONL 文件"""
+        import asyncio
+        sink = open(output_path, "w", encoding="utf-8") if output_path else None
+        try:
+            records, elapsed = asyncio.run(self._replay(requests, sink))
+        finally:
+            if sink is not None:
+                sink.close()
+        return self.summarize(records, elapsed)
+
+    @staticmethod
+    def summarize(records, elapsed):
+        """汇总回放结果：请求数、错误率、吞吐量以及延迟、首字节和开始延后的分位数（秒）"""
+        failed = sum(1 for record in records if record["status"] != "ok")
+
+        def distribution(key, ok_only=False):
+            values = sorted(record[key] for record in records
+                            if record[key] is not None and (not ok_only or record["status"] == "ok"))
+            return {name: LatencyTracker.nearest_rank(values, p)
+                    for name, p in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))}
+
+        return {
+            "requests": len(records),
+            "succeeded": len(records) - failed,
+            "failed": failed,
+            "error_rate": failed / len(records) if records else 0.0,
+            "elapsed": round(elapsed, 3),
+            "throughput": len(records) / elapsed if elapsed > 0 else 0.0,
+            "latency": distribution("latency", ok_only=True),
+            "first_output": distribution("first_output", ok_only=True),
+            "lag": distribution("lag"),
+        }
+
+
+def command_batch(argv):
+    """callqw batch：并发执行 JSONL 文件中的请求"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw batch",
+        description="并发执行 JSONL 文件中的请求（每行包含 message、可选的 mode/session/id）"
+    )
+    parser.add_argument("input", help="请求文件（JSONL）")
+    parser.add_argument("--output", "-o", type=str, default=None,
+                        help="结果文件（JSONL），默认为 <输入文件名>.results.jsonl")
+    parser.add_argument("--concurrency", "-j", type=int, default=4, help="最大并发数（默认 4）")
+    parser.add_argument("--order", choices=["input", "completion"], default="input",
+                        help="结果写入顺序：input（按输入顺序，默认）或 completion（按完成顺序）")
+    parser.add_argument("--priority", choices=RequestScheduler.PRIORITIES, default="batch",
+                        help="启用请求调度器（配置 scheduler）时的优先级，默认 batch，让交互式调用优先")
+    parser.add_argument("--no-context", action="store_true", help="不读取也不写入上下文记忆")
+    parser.add_argument("--profile", action="store_true", help="用 cProfile 分析整个批处理（配置 profile）")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="用 tracemalloc 记录峰值内存和分配最多的位置（配置 profile_memory）")
+    parser.add_argument("--dev-mode", action="store_true", help="启用开发者模式")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    bridge.priority = args.priority
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    dev_mode = args.dev_mode or bridge.config.get("default_dev_mode", False)
+    bridge.setup_logging(dev_mode)
+
+    input_path = Path(args.input)
+    output_path = Path(args.output) if args.output else input_path.with_name(input_path.stem + ".results.jsonl")
+    runner = BatchRunner(bridge, args.concurrency, args.order, not args.no_context, dev_mode, english_ui)
+    started = time.monotonic()
+    bridge.enable_worker_pool()
+    bridge.start_profiler("batch", args.profile, args.profile_memory)
+    try:
+        succeeded, failed = runner.run(input_path, output_path)
+    finally:
+        bridge.stop_profiler(english_ui)
         if dev_mode:
-            complete_text = self.get_ui_text("bridge_completed", english_ui)
-            self.colors.print_colored(complete_text, "green")
-        
+            bridge.show_worker_pool_stats(english_ui)
+        if bridge.worker_pool is not None:
+            bridge.worker_pool.shutdown()
+    summary = bridge.get_ui_text("batch_summary", english_ui).format(
+        succeeded, failed, time.monotonic() - started, output_path)
+    bridge.logger.info(summary)
+    bridge.colors.print_colored(summary, "green" if not failed else "yellow")
+    return 0 if not failed else 1
+
+
+def command_watch(argv):
+    """callqw watch：监视收件目录并处理放入其中的请求文件"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw watch",
+        description="监视 <目录>/inbox 中的请求文件（.json 或纯文本），处理后把回应写入 outbox/，"
+                    "请求移入 done/ 或 failed/；可以同时运行多个监视进程，中断的请求会被自动接管"
+    )
+    parser.add_argument("directory", help="收件目录的根目录（自动创建 inbox/processing/outbox/done/failed）")
+    parser.add_argument("--concurrency", "-j", type=int, default=4, help="最大并发数（默认 4）")
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+                        help="无法使用 inotify 时检查目录的间隔秒数（默认 0.5）")
+    parser.add_argument("--stale-seconds", type=float, default=60.0,
+                        help="认领超过多少秒没有更新时由其他监视进程接管（默认 60）")
+    parser.add_argument("--max-attempts", type=int, default=3, help="每个请求最多处理几次（默认 3）")
+    parser.add_argument("--once", action="store_true", help="处理完当前积压的请求后退出")
+    parser.add_argument("--status", action="store_true", help="只显示各目录中的文件数后退出")
+    parser.add_argument("--priority", choices=RequestScheduler.PRIORITIES, default="interactive",
+                        help="启用请求调度器（配置 scheduler）时的优先级（默认 interactive）")
+    parser.add_argument("--no-context", action="store_true", help="不读取也不写入上下文记忆")
+    parser.add_argument("--dev-mode", action="store_true", help="启用开发者模式")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    bridge.priority = args.priority
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    dev_mode = args.dev_mode or bridge.config.get("default_dev_mode", False)
+    watcher = InboxWatcher(bridge, args.directory, args.concurrency, args.poll_interval, args.stale_seconds,
+                           args.max_attempts, use_context=not args.no_context, dev_mode=dev_mode,
+                           english_ui=english_ui)
+    if args.status:
+        counts = watcher.status()
+        print(bridge.get_ui_text("watch_status", english_ui).format(
+            watcher.root, *(counts[name] for name in InboxWatcher.DIRECTORIES)))
         return 0
 
+    bridge.setup_logging(dev_mode)
+    bridge.enable_worker_pool()
+    try:
+        succeeded, failed = watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        succeeded, failed = watcher.counts["done"], watcher.counts["failed"]
+    finally:
+        if bridge.worker_pool is not None:
+            bridge.worker_pool.shutdown()
+    summary = bridge.get_ui_text("watch_summary", english_ui).format(succeeded, failed)
+    bridge.logger.info(summary)
+    bridge.colors.print_colored(summary, "green" if not failed else "yellow")
+    return 0 if not failed else 1
 
-def main():
-    """主函数"""
+
+def command_map(argv):
+    """callqw map：把同一条指令分发到 glob 匹配的每个文件上"""
+    import argparse
+    import hashlib
+    import shutil
+    parser = argparse.ArgumentParser(
+        prog="callqw map",
+        description="按提示词预算把 glob 匹配的文件分块，并发调用 Qwen 执行同一条指令，把结果汇总为一份报告；"
+                    "中断后重新运行相同的命令只会重新调用未成功的分块"
+    )
+    parser.add_argument("instruction", help="对每个分块执行的指令，例如 \"审查这些文件中的错误处理\"")
+    parser.add_argument("--glob", "-g", action="append", required=True,
+                        help="文件的 glob 模式（相对当前目录，支持 **），可以指定多次")
+    parser.add_argument("--mode", "-m", choices=["ask", "agent"], default="ask", help="工作模式（默认 ask）")
+    parser.add_argument("--budget", type=int, default=None,
+                        help="每个分块的提示词预算（单位同 context_budget_unit，默认使用配置 map_budget）")
+    parser.add_argument("--concurrency", "-j", type=int, default=4, help="最大并发数（默认 4）")
+    parser.add_argument("--output", "-o", type=str, default="callqw-map-report.md",
+                        help="汇总报告文件（默认 callqw-map-report.md）")
+    parser.add_argument("--fresh", action="store_true", help="忽略上次中断留下的结果，全部重新调用")
+    parser.add_argument("--no-cache", action="store_true", help="不使用响应缓存")
+    parser.add_argument("--no-context", action="store_true", help="不把汇总报告写入上下文记忆")
+    parser.add_argument("--priority", choices=RequestScheduler.PRIORITIES, default="batch",
+                        help="启用请求调度器（配置 scheduler）时的优先级，默认 batch")
+    parser.add_argument("--session", type=_session_arg, default=None, help="写入指定会话的对话日志和上下文记忆")
+    parser.add_argument("--dev-mode", action="store_true", help="启用开发者模式，逐块显示结果")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    bridge.priority = args.priority
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    dev_mode = args.dev_mode or bridge.config.get("default_dev_mode", False)
+    bridge.setup_logging(dev_mode)
+
+    root = Path.cwd()
+    files = MapRunner.collect_files(args.glob, root)
+    if not files:
+        bridge.colors.print_colored(bridge.get_ui_text("map_no_files", english_ui).format(" ".join(args.glob)),
+                                    "yellow")
+        return 1
+    # 同一指令、模式和 glob 的运行共用一个状态目录
+    run_key = hashlib.sha1("\0".join([args.mode, args.instruction] + args.glob).encode("utf-8")).hexdigest()[:16]
+    state_dir = bridge.logs_dir / "map-state" / run_key
+    if args.fresh:
+        shutil.rmtree(str(state_dir), ignore_errors=True)
+    budget = args.budget or bridge.config.get("map_budget", ConfigManager.DEFAULT_CONFIG["map_budget"])
+    runner = MapRunner(bridge, args.instruction, args.mode, budget, args.concurrency, state_dir,
+                       use_cache=not args.no_cache, dev_mode=dev_mode, english_ui=english_ui)
+    chunks = runner.plan(files, root)
+    plan_text = bridge.get_ui_text("map_plan", english_ui).format(len(files), len(chunks), budget)
+    bridge.logger.info(plan_text)
+    bridge.colors.print_colored(plan_text, "cyan")
+
+    started = time.monotonic()
+    bridge.enable_worker_pool()
+    try:
+        outcomes = runner.run(chunks)
+    finally:
+        if bridge.worker_pool is not None:
+            bridge.worker_pool.shutdown()
+    runner.finish(outcomes, args.output)
+
+    # 汇总报告作为一条记录写入对话日志和上下文记忆，而不是每个分块一条
+    message = f"map {' '.join(args.glob)}: {args.instruction}"
+    failed = sum(1 for outcome in outcomes if not outcome["ok"])
+    report_path = Path(args.output)
+    bridge.record_output(args.mode, message, MapRunner.outcome_chunks({"path": report_path}), english_ui,
+                         session=args.session, context=not args.no_context, ok=not failed, map=len(outcomes))
+
+    reused = sum(1 for outcome in outcomes if outcome["reused"])
+    summary = bridge.get_ui_text("map_summary", english_ui).format(
+        len(outcomes) - failed, failed, reused, time.monotonic() - started, report_path)
+    bridge.logger.info(summary)
+    bridge.colors.print_colored(summary, "green" if not failed else "yellow")
+    if failed:
+        bridge.colors.print_colored(bridge.get_ui_text("map_resume_hint", english_ui), "yellow")
+    return 0 if not failed else 1
+
+
+def command_replay(argv):
+    """callqw replay：按对话日志中的真实请求回放负载并报告延迟分位数"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw replay",
+        description="解析对话日志（包括已轮转的归档），按原始时间间隔或指定倍速回放其中的请求，"
+                    "报告 p50/p95/p99 延迟、吞吐量和错误率"
+    )
+    parser.add_argument("logs", nargs="*", help="对话日志文件（默认为当前会话的对话日志）")
+    parser.add_argument("--session", type=_session_arg, default=None, help="回放指定会话的对话日志")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="回放倍速：2 表示请求间隔缩短一半，0 表示不等待、只受并发数限制（默认 1）")
+    parser.add_argument("--max-gap", type=float, default=60.0,
+                        help="请求之间的空闲间隔最长按多少秒计算，0 表示不限制（默认 60）")
+    parser.add_argument("--concurrency", "-j", type=int, default=4, help="最大并发数（默认 4）")
+    parser.add_argument("--limit", "-n", type=int, default=0, help="最多回放多少条请求（默认全部）")
+    parser.add_argument("--since", type=str, default=None, help="只回放该时间之后的请求（ISO 格式，如 2024-05-01）")
+    parser.add_argument("--backend", type=str, default=None,
+                        help="回放使用的后端：cli、openai 或 fanout_backends 中的名称（默认与普通调用相同）")
+    parser.add_argument("--include-agent", action="store_true",
+                        help="同时回放 agent 模式的请求（会再次修改文件，默认跳过）")
+    parser.add_argument("--raw", action="store_true", help="只发送原始消息，不附加协作规则和上下文记忆")
+    parser.add_argument("--use-cache", action="store_true", help="允许使用响应缓存（默认不使用）")
+    parser.add_argument("--priority", choices=RequestScheduler.PRIORITIES, default="batch",
+                        help="启用请求调度器（配置 scheduler）时的优先级，默认 batch")
+    parser.add_argument("--output", "-o", type=str, default=None, help="把每条请求的结果写入 JSONL 文件")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出统计报告")
+    parser.add_argument("--dev-mode", action="store_true", help="启用开发者模式，逐条显示结果")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    bridge.priority = args.priority
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    dev_mode = args.dev_mode or bridge.config.get("default_dev_mode", False)
+    bridge.setup_logging(dev_mode)
+    # 与 callqw log 相同：换算为 Unix 时间比较，带时区的参数和不带时区的日志时间戳都可以使用
+    try:
+        since = ConversationJournal.epoch(args.since) if args.since else None
+    except ValueError as e:
+        bridge.colors.print_colored(bridge.get_ui_text("log_invalid_time", english_ui).format(e), "red")
+        return 2
+
+    backend = None
+    if args.backend:
+        backends = dict(bridge.fanout_backends())
+        if args.backend in backends:
+            backend = backends[args.backend]
+        elif args.backend in ("cli", "openai"):
+            backend = bridge.make_backend({"type": args.backend})
+        else:
+            bridge.colors.print_colored(
+                bridge.get_ui_text("replay_unknown_backend", english_ui).format(args.backend), "red")
+            return 2
+
+    # 默认读取结构化对话日志，只有旧版本留下的文本日志时读取文本日志
+    shard = bridge.shard(args.session)
+    default_log = shard.journal.path if shard.journal.path.exists() else shard.conversation_log
+    paths = [Path(path) for path in args.logs] or [default_log]
+
+    def requests():
+        count = 0
+        for path in paths:
+            lines = (line for _, line in bridge.log_rotator.iter_lines(path))
+            for request in ReplayRunner.parse_log(lines):
+                if request["mode"] not in ("ask", "agent"):
+                    continue
+                if request["mode"] == "agent" and not args.include_agent:
+                    continue
+                if since is not None and request["ts"].timestamp() < since:
+                    continue
+                if args.session and not request["session"]:
+                    request["session"] = args.session
+                yield request
+                count += 1
+                if args.limit and count >= args.limit:
+                    return
+
+    runner = ReplayRunner(bridge, args.concurrency, args.speed, args.max_gap, use_context=not args.raw,
+                          use_cache=args.use_cache, backend=backend, dev_mode=dev_mode, english_ui=english_ui)
+    bridge.enable_worker_pool()
+    try:
+        report = runner.run(requests(), args.output)
+    finally:
+        if bridge.worker_pool is not None:
+            bridge.worker_pool.shutdown()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0 if report["requests"] else 1
+    if not report["requests"]:
+        bridge.colors.print_colored(bridge.get_ui_text("replay_no_requests", english_ui), "yellow")
+        return 1
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    print(bridge.get_ui_text("replay_report", english_ui).format(
+        report["requests"], report["succeeded"], report["failed"], report["error_rate"],
+        report["elapsed"], report["throughput"]))
+    for key, label in (("latency", "replay_label_latency"), ("first_output", "replay_label_ttfb"),
+                       ("lag", "replay_label_lag")):
+        stats = report[key]
+        print(bridge.get_ui_text("replay_latency", english_ui).format(
+            bridge.get_ui_text(label, english_ui), seconds(stats["p50"]), seconds(stats["p95"]),
+            seconds(stats["p99"]), seconds(stats["max"])))
+    return 0
+
+
+def command_serve(argv):
+    """callqw serve：启动常驻守护进程"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw serve",
+        description="启动常驻的桥接守护进程，callqw 客户端会自动把请求转发给它"
+    )
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket 路径（默认使用配置项 daemon_socket）")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    args = parser.parse_args(argv)
+    daemon = BridgeDaemon(config_path=args.config, socket_path=args.socket)
+    english_ui = args.english_ui or daemon.bridge.config.get("default_english_ui", False)
+    return daemon.serve_forever(english_ui)
+
+
+def command_cache(argv):
+    """callqw cache：查看或清空响应缓存"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="callqw cache", description="查看或清空响应缓存")
+    parser.add_argument("action", choices=["stats", "clear"], help="stats：显示统计信息；clear：清空缓存")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    cache = bridge.response_cache
+    if cache is None:
+        bridge.colors.print_colored(bridge.get_ui_text("cache_disabled", english_ui), "yellow")
+        return 1
+    if args.action == "clear":
+        cache.clear()
+        bridge.colors.print_colored(bridge.get_ui_text("cache_cleared", english_ui), "green")
+    else:
+        stats = cache.stats()
+        bridge.colors.print_colored(bridge.get_ui_text("cache_stats", english_ui).format(
+            stats["entries"], stats["bytes"], stats["max_bytes"], stats["hits"], stats["misses"],
+            stats["evictions"]), "cyan")
+    return 0
+
+
+def command_context(argv):
+    """callqw context：查看 SQLite 上下文记忆的统计信息或检索相关记录"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="callqw context", description="检索上下文记忆（需要 sqlite 后端）")
+    sub = parser.add_subparsers(dest="action", required=True)
+    search = sub.add_parser("search", help="检索与查询相关的历史对话")
+    search.add_argument("query", help="查询内容，例如“认证模块的登录问题”")
+    search.add_argument("--limit", "-n", type=int, default=5, help="最多显示的记录数（默认 5）")
+    search.add_argument("--days", type=float, default=None, help="只检索最近 N 天的记录")
+    stats = sub.add_parser("stats", help="显示记录数和大小")
+    for sub_parser in (search, stats):
+        sub_parser.add_argument("--session", type=_session_arg, default=None, help="会话 ID（默认会话时省略）")
+        sub_parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+        sub_parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    store = bridge.shard(args.session).context_store
+    if not isinstance(store, SQLiteContextStore):
+        bridge.colors.print_colored(bridge.get_ui_text("context_sqlite_required", english_ui), "yellow")
+        return 1
+    if args.action == "stats":
+        stats = store.stats()
+        bridge.colors.print_colored(bridge.get_ui_text("context_stats", english_ui).format(
+            stats["turns"], stats["message_bytes"], stats["response_bytes"], stats["fts"]), "cyan")
+        return 0
+    since = time.time() - args.days * 86400 if args.days else None
+    results = store.search(args.query, args.limit, since=since)
+    if not results:
+        bridge.colors.print_colored(bridge.get_ui_text("context_no_match", english_ui), "yellow")
+        return 1
+    for _, _, text in results:
+        print(text.strip() + "\n")
+    return 0
+
+
+def command_sessions(argv):
+    """callqw sessions：列出所有会话及其大小和最后活动时间"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="callqw sessions", description="列出会话的上下文记忆大小和最后活动时间")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    sessions = bridge.list_sessions()
+    if args.json:
+        print(json.dumps(sessions, ensure_ascii=False, indent=2))
+        return 0
+    row = bridge.get_ui_text("sessions_header", english_ui)
+    bridge.colors.print_colored(row.format(*bridge.get_ui_text("sessions_columns", english_ui)), "cyan")
+    for info in sessions:
+        last = info["last_activity"]
+        print(row.format(
+            info["session"] or bridge.get_ui_text("session_default", english_ui),
+            info["turns"],
+            info["bytes"],
+            datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M:%S") if last else "-"
+        ))
+    return 0
+
+
+def command_compact(argv):
+    """callqw compact：立即检查并压缩上下文记忆，报告节省的字节数"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="callqw compact",
+                                     description="按内容哈希去重、合并连续的失败记录并截断过长的回应")
+    parser.add_argument("--session", type=_session_arg, default=None, help="会话 ID（默认会话时省略）")
+    parser.add_argument("--all", action="store_true", help="压缩所有会话")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出报告")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    sessions = [info["session"] for info in bridge.list_sessions()] if args.all else [args.session or ""]
+    reports = []
+    for session in sessions:
+        report = bridge.shard(session).compactor.compact(full=True)
+        report["session"] = session
+        reports.append(report)
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return 0
+    for report in reports:
+        name = report["session"] or bridge.get_ui_text("session_default", english_ui)
+        if report["compacted"]:
+            text = bridge.get_ui_text("compact_report", english_ui).format(
+                name, report["turns_before"], report["turns_after"], report["duplicates"],
+                report["errors_collapsed"], report["trimmed"], report["bytes_before"], report["bytes_after"],
+                report["saved"])
+            bridge.colors.print_colored(text, "green")
+        else:
+            bridge.colors.print_colored(
+                bridge.get_ui_text("compact_nothing", english_ui).format(name, report["checked"]), "cyan")
+    return 0
+
+
+def command_log(argv):
+    """callqw log：按时间、模式、会话或文本查询结构化对话日志"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw log",
+        description="查询结构化对话日志（JSONL）：按时间范围通过稀疏索引定位，查看最近的记录时从文件末尾向前读取"
+    )
+    parser.add_argument("--since", type=str, default=None, help="起始时间（ISO 格式，如 2024-05-01 或 2024-05-01T09:30）")
+    parser.add_argument("--until", type=str, default=None, help="结束时间（ISO 格式）")
+    parser.add_argument("--mode", "-m", choices=["ask", "agent"], default=None, help="只显示指定模式的记录")
+    parser.add_argument("--status", choices=["ok", "error"], default=None, help="只显示成功或失败的记录")
+    parser.add_argument("--grep", "-g", type=str, default=None, help="按正则表达式匹配消息或回应")
+    parser.add_argument("--ignore-case", "-i", action="store_true", help="--grep 忽略大小写")
+    parser.add_argument("--tail", "-n", type=int, default=None,
+                        help="只显示最近 N 条匹配的记录（未指定 --since/--until 时默认 20）")
+    parser.add_argument("--archives", action="store_true", help="同时读取已轮转的归档（顺序扫描）")
+    parser.add_argument("--session", type=_session_arg, default=None, help="查询指定会话的对话日志")
+    parser.add_argument("--json", action="store_true", help="输出原始 JSONL 记录")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    journal = bridge.shard(args.session).journal
+    try:
+        since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+        until = datetime.fromisoformat(args.until).timestamp() if args.until else None
+    except ValueError as e:
+        bridge.colors.print_colored(bridge.get_ui_text("log_invalid_time", english_ui).format(e), "red")
+        return 2
+    matcher = re.compile(args.grep, re.IGNORECASE if args.ignore_case else 0) if args.grep else None
+
+    def matches(record):
+        if args.mode and record.get("mode") != args.mode:
+            return False
+        if args.status and record.get("ok", True) != (args.status == "ok"):
+            return False
+        if until is not None and journal.epoch(record["ts"]) > until:
+            return False
+        if matcher is not None and not (matcher.search(record.get("message") or "")
+                                        or matcher.search(record.get("response") or "")):
+            return False
+        return True
+
+    tail = args.tail if args.tail is not None else (None if since or until else 20)
+    if args.archives:
+        import collections
+        found = collections.deque(maxlen=tail) if tail else []
+        for _, line in bridge.log_rotator.iter_lines(journal.path):
+            record = journal.parse(line)
+            if record is not None and (since is None or journal.epoch(record["ts"]) >= since) and matches(record):
+                found.append(record)
+        records = list(found)
+    elif tail:
+        records = journal.tail(tail, matches, since=since)
+    else:
+        records = (record for record in journal.records(since, until) if matches(record))
+
+    shown = 0
+    for record in records:
+        shown += 1
+        if args.json:
+            print(json.dumps(record, ensure_ascii=False))
+        else:
+            sys.stdout.write(ConversationJournal.render(record, english_ui))
+    if not shown:
+        bridge.colors.print_colored(bridge.get_ui_text("log_no_records", english_ui), "yellow")
+        return 1
+    return 0
+
+
+def command_search(argv):
+    """callqw search：在当前日志和已压缩的归档中搜索"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="callqw search",
+        description="按正则表达式搜索日志，透明读取 gzip/zstd 压缩的归档和当前日志"
+    )
+    parser.add_argument("pattern", help="正则表达式（--fixed 时为普通字符串）")
+    parser.add_argument("--log", choices=["conversation", "journal", "bridge", "metrics", "all"],
+                        default="conversation",
+                        help="要搜索的日志（默认 conversation；journal 为结构化对话日志）")
+    parser.add_argument("--ignore-case", "-i", action="store_true", help="忽略大小写")
+    parser.add_argument("--fixed", "-F", action="store_true", help="按普通字符串匹配")
+    parser.add_argument("--session", type=_session_arg, default=None, help="搜索指定会话的对话日志")
+    parser.add_argument("--english-ui", action="store_true", help="使用英文界面")
+    parser.add_argument("--config", "-c", type=str, default=None, help="配置文件路径")
+    args = parser.parse_args(argv)
+
+    bridge = QwenBridge(config_path=args.config)
+    english_ui = args.english_ui or bridge.config.get("default_english_ui", False)
+    logs = {
+        "conversation": bridge.shard(args.session).conversation_log,
+        "journal": bridge.shard(args.session).journal.path,
+        "bridge": bridge.bridge_log,
+        "metrics": bridge.config_path_option("metrics_file"),
+    }
+    names = list(logs) if args.log == "all" else [args.log]
+    pattern = re.escape(args.pattern) if args.fixed else args.pattern
+    matcher = re.compile(pattern, re.IGNORECASE if args.ignore_case else 0)
+    found = 0
+    for name in names:
+        if logs[name] is None:
+            continue
+        for segment, line in bridge.log_rotator.iter_lines(logs[name]):
+            if matcher.search(line):
+                found += 1
+                print(f"{bridge.colors.colorize(segment, 'gray')}: {line}")
+    if not found:
+        bridge.colors.print_colored(bridge.get_ui_text("search_no_match", english_ui), "yellow")
+        return 1
+    return 0
+
+
+# 子命令：第一个参数匹配时分派到对应函数，其余情况按普通消息处理
+COMMANDS = {
+    "serve": command_serve,
+    "batch": command_batch,
+    "replay": command_replay,
+    "watch": command_watch,
+    "map": command_map,
+    "cache": command_cache,
+    "search": command_search,
+    "log": command_log,
+    "context": command_context,
+    "sessions": command_sessions,
+    "compact": command_compact,
+}
+
+
+def build_parser():
+    """构建主命令的参数解析器"""
+    import argparse
     parser = argparse.ArgumentParser(
         description="Leader Agent 与 Qwen Code 的协作桥接器 (Python 版本)",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -591,6 +6364,56 @@ def main():
         help="启用开发者模式"
     )
     
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="流式输出：Qwen 的输出到达即显示"
+    )
+    
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="本次调用不使用响应缓存"
+    )
+    
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="对冲请求：截止时间内没有输出时再发起一个相同的调用，采用先成功的结果（仅 ask 模式）"
+    )
+    
+    parser.add_argument(
+        "--fanout",
+        action="store_true",
+        help="把消息同时发送给配置 fanout_backends 中的所有后端，并列显示全部回答（仅 ask 模式）"
+    )
+    
+    parser.add_argument(
+        "--priority",
+        choices=RequestScheduler.PRIORITIES,
+        default="interactive",
+        help="启用请求调度器（配置 scheduler）时的优先级：interactive（默认）或 batch"
+    )
+    
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="用 cProfile 分析桥接器本身，把 .pstats 和折叠栈写入 profile_dir（配置 profile）"
+    )
+    
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="用 tracemalloc 记录峰值内存和分配最多的位置（配置 profile_memory）"
+    )
+    
+    parser.add_argument(
+        "--session",
+        type=_session_arg,
+        default=None,
+        help="会话 ID：每个会话使用独立的上下文记忆和对话日志"
+    )
+    
     parser.add_argument(
         "--english-ui",
         action="store_true",
@@ -607,15 +6430,60 @@ def main():
     parser.add_argument(
         "--version", "-v",
         action="version",
-        version="Qwen Bridge Python Version 1.0.0"
+        version=VERSION_TEXT
     )
     
-    args = parser.parse_args()
+    return parser
+
+
+def _session_arg(value):
+    """argparse 类型函数：校验会话 ID"""
+    import argparse
+    try:
+        return ContextShard.validate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _peek_config_arg(argv):
+    """不构建参数解析器，直接从参数列表中取出 --config/-c 的值"""
+    for i, arg in enumerate(argv):
+        if arg in ("--config", "-c") and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith("--config="):
+            return arg.split("=", 1)[1]
+        if arg.startswith("-c") and len(arg) > 2 and not arg.startswith("--"):
+            return arg[2:]
+    return None
+
+
+def main(argv=None):
+    """主函数"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    # 快速路径：显示版本无需构建参数解析器
+    if "--version" in argv or "-v" in argv:
+        print(VERSION_TEXT)
+        return 0
+
+    # 优先把原始参数交给正在运行的守护进程处理（由守护进程解析），
+    # 设置 CALLQW_NO_DAEMON 可强制进程内执行
+    if not os.environ.get("CALLQW_NO_DAEMON"):
+        code = forward_to_daemon(argv, _peek_config_arg(argv))
+        if code is not None:
+            return code
+
+    args = build_parser().parse_args(argv)
     
     # 创建桥接器实例并运行
     bridge = QwenBridge(config_path=args.config)
-    return bridge.run(args)
-
+    try:
+        return bridge.run(args)
+    except KeyboardInterrupt:
+        # Qwen 子进程树已在取消时终止
+        return 130
 
 if __name__ == "__main__":
     sys.exit(main())